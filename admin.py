@@ -3,6 +3,13 @@ import os
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session
 from functools import wraps
 from dotenv import load_dotenv
+from analysis_cache import analysis_cache
+import digest
+import webhook_outbox
+import analysis_stats
+import metrics
+import vendor_templates
+from settings import load_all_settings, save_all_settings
 
 # Load environment variables
 load_dotenv(override=True)
@@ -13,27 +20,13 @@ ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'AppMast3r.')
 
 admin_bp = Blueprint('admin', __name__)
 
-# Use absolute path for settings file
-SETTINGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'settings.json')
-
 def load_settings():
-    """Load settings from JSON file"""
-    if os.path.exists(SETTINGS_FILE):
-        with open(SETTINGS_FILE, 'r') as f:
-            return json.load(f)
-    return {
-        'credit_card_emails': {},
-        'additional_recipients': [],
-        'settings': {
-            'emails_enabled': True,
-            'zapier_enabled': True
-        }
-    }
+    """Load settings from the shared settings store"""
+    return load_all_settings()
 
 def save_settings(settings):
     """Save settings to JSON file"""
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(settings, f, indent=4)
+    save_all_settings(settings)
 
 def login_required(f):
     @wraps(f)
@@ -68,7 +61,41 @@ def admin_dashboard():
     return render_template('admin.html',
                          credit_cards=settings['credit_card_emails'],
                          recipients=settings['additional_recipients'],
-                         settings=settings['settings'])
+                         settings=settings['settings'],
+                         cache_stats=analysis_cache.stats(),
+                         cache_entries=get_cache_entries(),
+                         digest_recipients=settings.get('digest_recipients', []),
+                         pending_digests=digest.pending_digests(),
+                         outbox_stats=webhook_outbox.outbox_stats(),
+                         dead_letters=get_dead_letters(),
+                         route_stats=analysis_stats.get_route_stats(),
+                         tier_stats=analysis_stats.get_stats('tier'),
+                         escalation_stats=analysis_stats.get_stats('escalation'),
+                         latency=metrics.get_dashboard(),
+                         vendor_templates=vendor_templates.list_templates(),
+                         template_fields=vendor_templates.RESULT_FIELDS)
+
+def get_cache_entries():
+    """Recent analysis cache entries with a short summary of each result"""
+    entries = analysis_cache.recent_entries()
+    for entry in entries:
+        try:
+            result = json.loads(entry['result'])
+            entry['summary'] = f"{result.get('vendor', 'N/A')} - {result.get('invoice_number', 'N/A')}"
+        except (json.JSONDecodeError, AttributeError):
+            entry['summary'] = 'N/A'
+    return entries
+
+def get_dead_letters():
+    """Undeliverable webhook events with a short summary of each payload"""
+    events = webhook_outbox.dead_letters()
+    for event in events:
+        try:
+            payload = json.loads(event['payload'])
+            event['summary'] = f"{payload.get('vendor', 'N/A')} - {payload.get('invoice_number', 'N/A')}"
+        except (json.JSONDecodeError, AttributeError):
+            event['summary'] = 'N/A'
+    return events
 
 @admin_bp.route('/admin/settings', methods=['POST'])
 @login_required
@@ -113,3 +140,78 @@ def update_recipients():
     settings['additional_recipients'] = [email for email in recipients if email]
     save_settings(settings)
     return redirect(url_for('admin.admin_dashboard'))
+
+@admin_bp.route('/admin/cache/invalidate', methods=['POST'])
+@login_required
+def invalidate_cache_entry():
+    """Remove one entry from the analysis cache"""
+    file_hash = request.form.get('file_hash', '').strip()
+    if file_hash and analysis_cache.invalidate(file_hash):
+        flash(f'Cache entry {file_hash} removed', 'success')
+    else:
+        flash(f'No cache entry found for {file_hash}', 'danger')
+    return redirect(url_for('admin.admin_dashboard'))
+
+@admin_bp.route('/admin/digest', methods=['POST'])
+@login_required
+def update_digest_recipients():
+    """Choose which recipients get a digest instead of an email per receipt"""
+    settings = load_settings()
+    settings['digest_recipients'] = [email for email in request.form.getlist('digest_recipients[]') if email]
+    save_settings(settings)
+    return redirect(url_for('admin.admin_dashboard'))
+
+@admin_bp.route('/admin/digest/flush', methods=['POST'])
+@login_required
+def flush_digests():
+    """Send every pending digest now"""
+    sent = digest.flush_all()
+    flash(f'Sent {sent} queued receipt(s)', 'success')
+    return redirect(url_for('admin.admin_dashboard'))
+
+@admin_bp.route('/admin/webhooks/retry', methods=['POST'])
+@login_required
+def retry_webhooks():
+    """Requeue one dead webhook event, or all of them"""
+    event_id = request.form.get('event_id', type=int)
+    count = webhook_outbox.retry_dead_letter(event_id)
+    flash(f'Requeued {count} webhook event(s)', 'success')
+    return redirect(url_for('admin.admin_dashboard'))
+
+@admin_bp.route('/admin/webhooks/delete', methods=['POST'])
+@login_required
+def delete_webhook():
+    """Discard a dead webhook event"""
+    event_id = request.form.get('event_id', type=int)
+    if event_id and webhook_outbox.delete_dead_letter(event_id):
+        flash(f'Webhook event {event_id} deleted', 'success')
+    else:
+        flash(f'No dead webhook event {event_id}', 'danger')
+    return redirect(url_for('admin.admin_dashboard'))
+
+@admin_bp.route('/admin/templates', methods=['POST'])
+@login_required
+def save_vendor_template():
+    """Add or replace a vendor extraction template"""
+    name = request.form.get('name', '').strip()
+    fields = {field: request.form.get(f'field_{field}', '').strip()
+              for field in vendor_templates.RESULT_FIELDS}
+    fields = {field: pattern for field, pattern in fields.items() if pattern}
+    try:
+        vendor_templates.save_template(name, request.form.get('vendor', '').strip(),
+                                       request.form.get('match_pattern', '').strip(), fields)
+        flash(f'Template {name} saved', 'success')
+    except vendor_templates.TemplateError as e:
+        flash(str(e), 'danger')
+    return redirect(url_for('admin.admin_dashboard'))
+
+@admin_bp.route('/admin/templates/delete', methods=['POST'])
+@login_required
+def delete_vendor_template():
+    """Remove a vendor extraction template"""
+    name = request.form.get('name', '')
+    if vendor_templates.delete_template(name):
+        flash(f'Template {name} deleted', 'success')
+    else:
+        flash(f'No template named {name}', 'danger')
+    return redirect(url_for('admin.admin_dashboard'))
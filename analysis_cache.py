@@ -0,0 +1,112 @@
+import os
+import time
+import logging
+from db import get_connection, get_db_path
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_CACHE_FILE = os.getenv('ANALYSIS_CACHE_FILE', get_db_path('analysis_cache.db'))
+# Least recently used entries beyond this count are evicted
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv('ANALYSIS_CACHE_MAX_ENTRIES', 5000))
+ANALYSIS_CACHE_ENABLED = os.getenv('ANALYSIS_CACHE_ENABLED', 'true').lower() == 'true'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis_cache (
+    file_hash TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_used ON analysis_cache (last_used);
+CREATE TABLE IF NOT EXISTS analysis_cache_stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO analysis_cache_stats (name, value) VALUES ('hits', 0), ('misses', 0);
+"""
+
+
+class AnalysisCache:
+    """Persistent cache of parsed analysis results keyed by file content hash"""
+
+    def __init__(self, path=ANALYSIS_CACHE_FILE, max_entries=ANALYSIS_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+
+    def _conn(self):
+        return get_connection(self.path, SCHEMA)
+
+    def get(self, file_hash):
+        """
+        Look up a cached analysis result.
+
+        Args:
+            file_hash (str): MD5 of the file contents.
+        Returns:
+            str: Cached JSON result, or None on a miss.
+        """
+        conn = self._conn()
+        row = conn.execute(
+            'SELECT result FROM analysis_cache WHERE file_hash = ?', (file_hash,)
+        ).fetchone()
+        if row is None:
+            conn.execute("UPDATE analysis_cache_stats SET value = value + 1 WHERE name = 'misses'")
+            return None
+
+        conn.execute(
+            'UPDATE analysis_cache SET last_used = ?, hits = hits + 1 WHERE file_hash = ?',
+            (time.time(), file_hash)
+        )
+        conn.execute("UPDATE analysis_cache_stats SET value = value + 1 WHERE name = 'hits'")
+        return row['result']
+
+    def put(self, file_hash, result):
+        """Store an analysis result and evict the least recently used entries"""
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            'INSERT OR REPLACE INTO analysis_cache (file_hash, result, created_at, last_used, hits) '
+            'VALUES (?, ?, ?, ?, 0)',
+            (file_hash, result, now, now)
+        )
+        conn.execute(
+            'DELETE FROM analysis_cache WHERE file_hash IN ('
+            '  SELECT file_hash FROM analysis_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?'
+            ')',
+            (self.max_entries,)
+        )
+
+    def invalidate(self, file_hash):
+        """Remove one entry. Returns True if it existed."""
+        cursor = self._conn().execute('DELETE FROM analysis_cache WHERE file_hash = ?', (file_hash,))
+        return cursor.rowcount > 0
+
+    def recent_entries(self, limit=20):
+        """Most recently used entries for the admin dashboard"""
+        rows = self._conn().execute(
+            'SELECT file_hash, result, created_at, last_used, hits FROM analysis_cache '
+            'ORDER BY last_used DESC LIMIT ?',
+            (limit,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def stats(self):
+        """Entry count, hits, misses and hit rate"""
+        conn = self._conn()
+        counters = {row['name']: row['value'] for row in
+                    conn.execute('SELECT name, value FROM analysis_cache_stats')}
+        entries = conn.execute('SELECT COUNT(*) FROM analysis_cache').fetchone()[0]
+        hits = counters.get('hits', 0)
+        misses = counters.get('misses', 0)
+        lookups = hits + misses
+        return {
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / lookups, 3) if lookups else 0.0
+        }
+
+
+analysis_cache = AnalysisCache()
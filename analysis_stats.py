@@ -0,0 +1,76 @@
+import os
+import logging
+from db import get_connection, get_db_path
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_STATS_FILE = os.getenv('ANALYSIS_STATS_FILE', get_db_path('analysis_stats.db'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis_stats (
+    category TEXT NOT NULL,
+    name TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    total_seconds REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (category, name)
+);
+"""
+
+
+def _conn():
+    return get_connection(ANALYSIS_STATS_FILE, SCHEMA)
+
+
+def record(category, name, seconds=0.0):
+    """
+    Count one analysis decision and its latency.
+
+    Args:
+        category (str): What was decided, e.g. 'route'.
+        name (str): The outcome, e.g. 'text' or 'vision'.
+        seconds (float): Time the analysis took.
+    """
+    try:
+        _conn().execute(
+            'INSERT INTO analysis_stats (category, name, count, total_seconds) VALUES (?, ?, 1, ?) '
+            'ON CONFLICT (category, name) DO UPDATE SET count = count + 1, '
+            'total_seconds = total_seconds + excluded.total_seconds',
+            (category, name, seconds)
+        )
+    except Exception as e:
+        logger.error(f"Error recording analysis stats: {str(e)}")
+
+
+def get_stats(category):
+    """
+    Counts and average latency of every outcome in a category.
+
+    Returns:
+        dict: name -> {'count', 'share', 'avg_seconds'}
+    """
+    rows = _conn().execute(
+        'SELECT name, count, total_seconds FROM analysis_stats WHERE category = ? ORDER BY name',
+        (category,)
+    ).fetchall()
+    total = sum(row['count'] for row in rows)
+    return {
+        row['name']: {
+            'count': row['count'],
+            'share': round(row['count'] / total, 3) if total else 0.0,
+            'avg_seconds': round(row['total_seconds'] / row['count'], 2) if row['count'] else 0.0
+        }
+        for row in rows
+    }
+
+
+def get_route_stats():
+    """Routing between templates, the text layer and vision, with the time saved versus vision"""
+    routes = get_stats('route')
+    vision = routes.get('vision')
+    saved = 0.0
+    if vision:
+        for name in ('template', 'text'):
+            route = routes.get(name)
+            if route:
+                saved += (vision['avg_seconds'] - route['avg_seconds']) * route['count']
+    return {'routes': routes, 'seconds_saved': round(saved, 1)}
@@ -1,39 +1,39 @@
 import os
-import base64
-from flask import Flask, request, render_template, jsonify
-from werkzeug.utils import secure_filename
-from openai import OpenAI
-from pdf2image import convert_from_path
-import tempfile
-import json
-import requests
-from config import CREDIT_CARD_EMAILS, ADDITIONAL_RECIPIENTS
-from gmail_service import get_gmail_service, create_message_with_attachment, send_message, logger
 from dotenv import load_dotenv
 load_dotenv(override=True)
+from logging_setup import setup_logging, request_id_var
+# Configure logging before the other modules log anything
+setup_logging()
+from flask import Flask, request, render_template, jsonify, url_for, Response, g, session
+from werkzeug.utils import secure_filename
+import json
+import hmac
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from gmail_service import get_gmail_service, check_gmail_service, create_message_stream, send_message_stream
 from upload_to_drive import upload_file_to_drive
-from settings import get_settings
+from receipt_file import ReceiptFile, as_receipt_file
+from settings import get_settings, get_credit_card_emails, get_additional_recipients, get_delivery_mode
 from admin import admin_bp
+from jobs import job_queue, run_stages
+from concurrency import gevent_active
+import digest
+import resilience
+from webhook_outbox import enqueue_webhook, dispatcher as webhook_dispatcher
+from analysis_cache import analysis_cache, ANALYSIS_CACHE_ENABLED
+from image_processing import POPPLER_PATH, IMAGE_DETAIL, encode_image_bytes, prepare_file_for_vision
+from pdf_text import get_text_layer
+from vendor_templates import extract_with_templates
+from model_routing import analyze_with_tiers, MODEL_TIERS, TEXT_MODEL_TIERS
+import analysis_stats
+import metrics
+import uuid
 import logging
 import sys
-import httpx  # Import httpx library
-from debug_credentials import debug_credentials
-
-print("=== Starting application initialization ===")
-print(f"Python version: {sys.version}")
-print(f"Current directory: {os.getcwd()}")
-print(f"Directory contents: {os.listdir('.')}")
-
-# Debug credentials first
-debug_credentials()
-
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+
 logger = logging.getLogger(__name__)
+logger.info(f"=== Starting application initialization (Python {sys.version.split()[0]}) ===")
 
 # Validate required environment variables
 required_env_vars = [
@@ -55,108 +55,113 @@ logger.info("All required environment variables are present")
 
 app = Flask(__name__)
 logger.info("Flask app initialized")
-# Get absolute path for uploads folder
-app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
-# Set poppler path based on environment
-if os.name == 'nt':  # Windows
-    POPPLER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'poppler', 'poppler-24.08.0', 'Library', 'bin')
-else:  # Linux
-    POPPLER_PATH = '/usr/bin'  # Default location for poppler-utils on Linux
-
 logger.info(f"Using POPPLER_PATH: {POPPLER_PATH}")
 
-# Ensure upload folder exists with proper permissions
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Uploads are kept in memory, or in a private temp file when larger than INGEST_MAX_MEMORY (receipt_file.py)
+
+# OpenAI API root; benchmark_load.py points it at a local stand-in
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+
+# OpenAI client of this process, built on first use so importing the app stays fast
+_openai_client = None
+_openai_client_pid = None
+_openai_client_lock = threading.Lock()
 
-# Initialize OpenAI client
-client = OpenAI(
-    api_key=os.getenv('OPENAI_API_KEY'),
-    base_url="https://api.openai.com/v1",  # Explicitly set base URL
-    http_client=httpx.Client(trust_env=False)  # Disable automatic proxy detection
-)
+def get_openai_client():
+    """Get this process's OpenAI client, creating it on first use"""
+    global _openai_client, _openai_client_pid
+    with _openai_client_lock:
+        # A forked worker must not reuse the parent's connections
+        if _openai_client is None or _openai_client_pid != os.getpid():
+            import httpx
+            from openai import OpenAI
+            _openai_client = OpenAI(
+                api_key=os.getenv('OPENAI_API_KEY'),
+                base_url=OPENAI_BASE_URL,
+                http_client=httpx.Client(trust_env=False),  # Disable automatic proxy detection
+                max_retries=0  # Retries and rate limiting are handled by resilience.call
+            )
+            _openai_client_pid = os.getpid()
+        return _openai_client
+
+def warm_up():
+    """
+    Import the slow client libraries without creating any client.
+
+    gunicorn.conf.py calls this in the master when GUNICORN_PRELOAD is set,
+    so every worker, including ones restarted after a timeout, is forked
+    with the modules already loaded. No connection or thread is opened.
+    """
+    start = time.time()
+    import httpx
+    import openai
+    import googleapiclient.discovery
+    import googleapiclient.http
+    import google.oauth2.service_account
+    import pdf2image
+    logger.info(f"Preloaded client libraries in {time.time() - start:.2f}s")
 
 # Register blueprints with proper URL prefix
 app.register_blueprint(admin_bp, url_prefix='/admin')
 app.secret_key = 'inv-processor-secret-key-2024'  # Fixed secret key for sessions
 
-def encode_image(image_path):
-    """
-    Encode an image file to base64 string.
-    
-    Args:
-        image_path (str): Path to the image file.
-    Returns:
-        str: Base64 encoded string of the image.
+@app.before_first_request
+def start_background_threads():
     """
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    Start sending due digests and webhooks, including ones queued before a restart.
 
-def convert_pdf_to_image(pdf_path):
-    """
-    Convert first page of PDF to image
-    
-    Args:
-        pdf_path (str): Path to PDF file
-    Returns:
-        str: Path to the converted image
+    gunicorn.conf.py calls this when each worker boots, so events left by a
+    worker that died are retried without waiting for a request. The first
+    request starts them under any other server.
     """
-    try:
-        print(f"Converting PDF: {pdf_path}")
-        print(f"Poppler path: {POPPLER_PATH}")
-        
-        # Convert PDF to image using local poppler
-        images = convert_from_path(pdf_path, first_page=1, last_page=1, poppler_path=POPPLER_PATH)
-        
-        if images:
-            # Save the first page as image
-            image_path = os.path.join(os.path.dirname(pdf_path), 
-                                    os.path.splitext(os.path.basename(pdf_path))[0] + '.jpg')
-            print(f"Saving image to: {image_path}")
-            images[0].save(image_path, 'JPEG')
-            return image_path
-        return None
-    except Exception as e:
-        print(f"Error converting PDF: {str(e)}")
-        raise
+    digest.start_flusher()
+    webhook_dispatcher.start()
 
-def analyze_image(file_path):
-    """
-    Send an encoded image to GPT-4 for analysis
-    
-    Args:
-        file_path (str): Path to the image file.
-    """
-    try:
-        print(f"Processing file: {file_path}")
-        
-        # Check if file exists
-        if not os.path.exists(file_path):
-            raise Exception(f"File not found: {file_path}")
-        
-        # Check if file is PDF
-        if file_path.lower().endswith('.pdf'):
-            image_path = convert_pdf_to_image(file_path)
-            if image_path is None:
-                raise Exception("Failed to convert PDF to image")
-            # Use the image for analysis but keep the original PDF
-            original_file_path = file_path
-            file_path = image_path
+@app.before_request
+def set_request_id():
+    """Tag the request's log records with the caller's X-Request-ID or a new id"""
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16]
+    g.request_id_token = request_id_var.set(g.request_id)
+    g.request_start = time.perf_counter()
 
-        # First encode the image
-        base64_image = encode_image(file_path)
-        
-        # Send to GPT-4 for analysis
-        response = client.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": """Extract the following from this invoice and return ONLY a JSON object:
+@app.after_request
+def add_request_id_header(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    if 'request_start' in g:
+        # The rule, not the path, so /jobs/<job_id> is a single series
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        if response.mimetype == 'text/event-stream':
+            # Returning a stream takes no time; measure until the client is done with it
+            start = g.request_start
+            response.call_on_close(lambda: metrics.observe(
+                'http_stream_seconds', time.perf_counter() - start, endpoint=endpoint))
+        else:
+            metrics.observe('http_request_seconds', time.perf_counter() - g.request_start,
+                            endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+@app.teardown_request
+def clear_request_id(error=None):
+    if 'request_id_token' in g:
+        request_id_var.reset(g.pop('request_id_token'))
+
+# Stages reported on /jobs/<id> for each uploaded receipt
+RECEIPT_STAGES = ('saved', 'drive_upload', 'analysis', 'email', 'zapier')
+
+# Receipts of one batch processed at the same time, kept low for the OpenAI and Gmail rate limits
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 3))
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', 50))
+
+# Bearer token for scraping /metrics; without it only a logged-in admin can read them
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# Serve /metrics to anyone, e.g. when it is only reachable from a private network
+METRICS_PUBLIC = os.getenv('METRICS_PUBLIC', 'false').lower() == 'true'
+
+# Prompt sent with every invoice
+ANALYSIS_PROMPT = """Extract the following from this invoice and return ONLY a JSON object:
                             {
                                 "invoice_number": "any invoice/order number",
                                 "date": "any date found",
@@ -174,44 +179,227 @@ def analyze_image(file_path):
                             2. Use "N/A" if not found
                             3. Remove currency symbols from amount
                             4. Include ONLY last 4 digits of credit card"""
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
+
+# Prepended to the prompt when a PDF has several pages
+MULTI_PAGE_PROMPT = ("The images are pages 1 to {pages} of the same invoice. Combine them into a single "
+                     "result: use the final total for amount and list the items from every page.\n\n")
+
+# Prepended to the prompt when the invoice is sent as its PDF text layer
+TEXT_LAYER_PROMPT = ("The invoice below was extracted from the text layer of a PDF, with the page "
+                     "layout kept. Use all of its pages.\n\n")
+
+def complete_chat(content, model, progress=None):
+    """
+    Run a single-message chat completion.
+
+    Args:
+        content: Message content, a string or a list of parts.
+        model (str): Chat model to use.
+        progress (callable): If given, the reply is streamed and each piece
+            is passed to progress('delta', {'text': ...}) as it arrives.
+    Returns:
+        str: The model's full reply.
+    """
+    messages = [{"role": "user", "content": content}]
+    if progress is None:
+        response = resilience.call('openai', get_openai_client().chat.completions.create,
+                                   model=model, messages=messages, max_tokens=1500)
+        record_token_usage(model, response.usage)
+        return response.choices[0].message.content
+
+    # include_usage makes the API send a last chunk with the token counts
+    stream = resilience.call('openai', get_openai_client().chat.completions.create,
+                             model=model, messages=messages, max_tokens=1500, stream=True,
+                             extra_body={'stream_options': {'include_usage': True}})
+    parts = []
+    for chunk in stream:
+        text = chunk.choices[0].delta.content if chunk.choices else None
+        if text:
+            parts.append(text)
+            progress('delta', {'text': text})
+        record_token_usage(model, getattr(chunk, 'usage', None))
+    return ''.join(parts)
+
+def record_token_usage(model, usage):
+    """Add the prompt and completion tokens of a response.usage to the metrics"""
+    if not usage:
+        return
+    if not isinstance(usage, dict):
+        usage = {'prompt_tokens': getattr(usage, 'prompt_tokens', 0),
+                 'completion_tokens': getattr(usage, 'completion_tokens', 0)}
+    for kind in ('prompt', 'completion'):
+        tokens = usage.get(f'{kind}_tokens') or 0
+        if tokens:
+            metrics.inc('openai_tokens_total', tokens, model=model, type=kind)
+
+def request_text_analysis(text, model="gpt-4-turbo", progress=None):
+    """
+    Send the text layer of an invoice to the model, without any image.
+
+    Args:
+        text (str): Text extracted from the PDF.
+        model (str): Chat model to use.
+        progress (callable): Receives the streamed reply, see complete_chat.
+    Returns:
+        str: The model's reply.
+    """
+    logger.info(f"Sending {len(text)} characters of PDF text to {model}")
+    metrics.observe('payload_bytes', len(text.encode('utf-8')), kind='openai_text_request')
+    return complete_chat(f"{TEXT_LAYER_PROMPT}{ANALYSIS_PROMPT}\n\nInvoice text:\n{text}", model, progress)
+
+def clean_analysis_content(content):
+    """Strip markdown code fences from a model reply"""
+    if "```json" in content:
+        content = content.replace("```json", "").replace("```", "").strip()
+    return content
+
+def is_valid_json(content):
+    """True if a model reply parses as JSON"""
+    try:
+        json.loads(content)
+        return True
+    except (TypeError, json.JSONDecodeError):
+        return False
+
+def request_analysis(images, model="gpt-4-turbo", progress=None):
+    """
+    Send prepared invoice images to the vision model.
+
+    Args:
+        images (list): (jpeg_bytes, info) tuples from prepare_file_for_vision.
+        model (str): Chat model to use.
+        progress (callable): Receives the streamed reply, see complete_chat.
+    Returns:
+        str: The model's reply.
+    """
+    prompt = ANALYSIS_PROMPT
+    if len(images) > 1:
+        prompt = MULTI_PAGE_PROMPT.format(pages=len(images)) + prompt
+    content = [{"type": "text", "text": prompt}]
+    with metrics.timer('operation_seconds', operation='base64_encode'):
+        content.extend(
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/jpeg;base64,{encode_image_bytes(image_bytes)}",
+                    "detail": info.get('detail', IMAGE_DETAIL)
                 }
-            ],
-            max_tokens=1500
+            }
+            for image_bytes, info in images
         )
+    metrics.observe('payload_bytes', sum(len(part['image_url']['url']) for part in content[1:]),
+                     kind='openai_image_request')
+    logger.info(f"Sending {len(images)} image(s), {sum(len(image_bytes) for image_bytes, _ in images)} bytes, to {model}")
+    return complete_chat(content, model, progress)
 
-        # Output GPT-4's analysis
-        print("\nReceipt Analysis:")
-        content = response.choices[0].message.content
+def analyze_image(file_path, progress=None):
+    """
+    Send an encoded image to GPT-4 for analysis
+    
+    Args:
+        file_path (str or ReceiptFile): The uploaded file.
+        progress (callable): Optional progress(event, data) callback, e.g.
+            Job.emit, receiving 'rendered' and streamed 'delta' events.
+    """
+    try:
+        receipt = as_receipt_file(file_path)
+        logger.info(f"Processing file: {receipt.name}")
         
-        # Clean up markdown formatting if present
-        if "```json" in content:
-            content = content.replace("```json", "").replace("```", "").strip()
+        # Check if file exists
+        if receipt.closed:
+            raise Exception(f"File already released: {receipt.name}")
+        if not receipt.in_memory and not os.path.exists(receipt.path):
+            raise Exception(f"File not found: {receipt.path}")
+
+        # Return the cached result if this exact file was analyzed before
+        file_hash = None
+        if ANALYSIS_CACHE_ENABLED:
+            try:
+                file_hash = receipt.md5
+                cached_result = analysis_cache.get(file_hash)
+                if cached_result is not None:
+                    logger.info(f"Analysis cache hit for {file_hash}")
+                    metrics.inc('analysis_cache_total', result='hit')
+                    return cached_result, file_path
+                metrics.inc('analysis_cache_total', result='miss')
+            except Exception as e:
+                logger.error(f"Error reading analysis cache: {str(e)}")
         
+        start = time.time()
+        route = 'vision'
+        content = None
+
+        # PDFs with a text layer are analysed from their text, which costs far fewer tokens
+        with metrics.timer('operation_seconds', operation='text_layer'):
+            text = get_text_layer(receipt)
+        if text:
+            # Known vendor layouts are extracted locally without any model call
+            with metrics.timer('operation_seconds', operation='template_match'):
+                template_result, template_name = extract_with_templates(text)
+            if template_result:
+                content = json.dumps(template_result)
+                route = 'template'
+        if text and content is None:
+            if progress:
+                progress('route', {'route': 'text'})
+            content, model = analyze_with_tiers(
+                lambda model: clean_analysis_content(request_text_analysis(text, model, progress)),
+                TEXT_MODEL_TIERS, progress
+            )
+            if is_valid_json(content):
+                route = 'text'
+            else:
+                logger.warning(f"Text layer analysis of {receipt.name} returned invalid JSON, using vision")
+                route = 'text_fallback'
+                content = None
+
+        if content is None:
+            if progress:
+                progress('route', {'route': 'vision'})
+            # Render PDF pages and downscale images in memory; the original file is kept as the attachment
+            with metrics.timer('operation_seconds', operation='prepare_images'):
+                images = prepare_file_for_vision(receipt)
+            if not images:
+                raise Exception("Failed to convert PDF to image")
+            if progress:
+                progress('rendered', {'pages': len(images)})
+
+            # Send every page in one request, to the cheapest model whose reply passes the checks
+            content, model = analyze_with_tiers(
+                lambda model: clean_analysis_content(request_analysis(images, model, progress)),
+                MODEL_TIERS, progress
+            )
+
+        elapsed = time.time() - start
+        analysis_stats.record('route', route, elapsed)
+        logger.info(f"Analysed {receipt.name} via {route} in {elapsed:.2f}s")
+
         # Validate it's proper JSON
         try:
             json.loads(content)  # Test if it's valid JSON
-            print(content)
-            return content, original_file_path if 'original_file_path' in locals() else file_path
+            logger.debug(f"Receipt analysis: {content}")
+            if file_hash:
+                try:
+                    analysis_cache.put(file_hash, content)
+                except Exception as e:
+                    logger.error(f"Error writing analysis cache: {str(e)}")
+            return content, file_path
         except json.JSONDecodeError as e:
             error_msg = f"Invalid JSON response: {e}"
-            print(error_msg)
-            return error_msg, original_file_path if 'original_file_path' in locals() else file_path
+            logger.error(error_msg)
+            metrics.inc('errors_total', source='analysis', reason='invalid_json')
+            return error_msg, file_path
     except Exception as e:
         error_msg = f"Error analyzing image: {e}"
-        print(error_msg)
-        return error_msg, original_file_path if 'original_file_path' in locals() else file_path
+        logger.error(error_msg)
+        metrics.inc('errors_total', source='analysis', reason=type(e).__name__)
+        return error_msg, file_path
 
 def send_email(recipient_email, subject, body, attachment_path, cc=None):
     """
     Send email with attachment using Gmail API
+
+    attachment_path may be a path or a ReceiptFile.
     """
     try:
         # Check if emails are enabled
@@ -234,8 +422,8 @@ def send_email(recipient_email, subject, body, attachment_path, cc=None):
             raise ValueError("GMAIL_SENDER_EMAIL environment variable not set")
         logger.info(f"Sender email: {sender_email}")
 
-        # Create message with attachment
-        message = create_message_with_attachment(
+        # Create message with attachment, streamed so the file is never fully in memory
+        stream, size = create_message_stream(
             sender_email,
             recipient_email,
             cc=cc,
@@ -245,7 +433,7 @@ def send_email(recipient_email, subject, body, attachment_path, cc=None):
         )
         
         # Send message
-        result = send_message(service, 'me', message)
+        result = send_message_stream(service, 'me', stream, size)
         success = result is not None and 'id' in result
         
         if success:
@@ -293,7 +481,7 @@ def zapier_webhook():
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', credit_cards=get_credit_card_emails())
 
 @app.route('/analyze', methods=['POST'])
 def analyze():
@@ -305,23 +493,240 @@ def analyze():
         return jsonify({'error': 'No file selected'}), 400
 
     try:
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        print(f"Saving file to: {filepath}")
-        file.save(filepath)
-        
-        result, attachment_path = analyze_image(filepath)
-        
-        # Clean up the uploaded file
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        # The upload is released when the block ends, even if the analysis fails
+        with ReceiptFile.from_upload(file, secure_filename(file.filename)) as receipt:
+            logger.info(f"Received file: {receipt}")
+            result, attachment_path = analyze_image(receipt)
         
         return jsonify({'result': result})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def run_analysis(job, receipt):
+    """Analyse an uploaded file for /analyze/stream. Executed by a job worker."""
+    try:
+        results, errors = run_stages(job, {'analysis': lambda: analyze_image(receipt, progress=job.emit)})
+        if 'analysis' in errors:
+            raise errors['analysis']
+        result, attachment_path = results['analysis']
+        return {'result': result}
+    finally:
+        receipt.close()
+
+@app.route('/analyze/stream', methods=['POST'])
+def analyze_stream():
+    """Like /analyze, but streams progress and the model's output as Server-Sent Events"""
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file uploaded'}), 400
+
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+
+    # Refuse before doing any work; the client can use /analyze instead
+    if not _sse_slots.acquire(blocking=False):
+        return too_many_streams_response(analyze_url=url_for('analyze'))
+    try:
+        receipt = ReceiptFile.from_upload(file, secure_filename(file.filename))
+        try:
+            job = job_queue.submit(run_analysis, receipt, stages=('saved', 'analysis'))
+        except Exception:
+            receipt.close()
+            raise
+    except Exception:
+        _sse_slots.release()
+        raise
+    job.finish_stage('saved')
+    return event_stream_response(job, slot_acquired=True)
+
+def format_analysis(result_dict):
+    """Format parsed analysis results for the email body"""
+    formatted_analysis = "\n".join([
+        "=== Analysis Results ===",
+        f"Invoice Number: {result_dict.get('invoice_number', 'N/A')}",
+        f"Date: {result_dict.get('date', 'N/A')}",
+        f"Amount: ${result_dict.get('amount', 'N/A')}",
+        f"Customer Name: {result_dict.get('customer_name', 'N/A')}",
+        f"Vendor: {result_dict.get('vendor', 'N/A')}",
+        f"Credit Card: {result_dict.get('credit_card', 'N/A')}",
+        f"Payment Method: {result_dict.get('payment_method', 'N/A')}",
+        f"Billing Address: {result_dict.get('billing_address', 'N/A')}",
+        "\nItems/Services:",
+        "----------------"
+    ])
+
+    # Add items if present
+    items = result_dict.get('description_of_items_or_services', [])
+    if isinstance(items, list):
+        formatted_analysis += "\n" + "\n".join(f"- {item}" for item in items)
+    else:
+        formatted_analysis += f"\n{items}"
+    return formatted_analysis
+
+def parse_analysis(analysis_result):
+    """
+    Parse the JSON returned by analyze_image.
+
+    Args:
+        analysis_result (str): Raw analysis text.
+    Returns:
+        dict: Parsed analysis fields.
+    """
+    # Remove markdown formatting if present
+    clean_result = analysis_result
+    if "```json" in clean_result:
+        clean_result = clean_result.replace("```json", "").replace("```", "").strip()
+    return json.loads(clean_result)
+
+def process_receipt(job, receipt, filename, credit_card, expense_reason, user_name,
+                    recipient_email, emails_enabled, zapier_enabled):
+    """
+    Run the receipt pipeline for an uploaded file. Executed by a job worker.
+
+    The Drive upload and the analysis run together, then the email is sent
+    and the Zapier event is added to the webhook outbox once the analysis
+    is available.
+
+    Args:
+        job (Job): Job used to report stage progress.
+        receipt (ReceiptFile): The upload; it is closed when the job ends.
+        filename (str): Secure file name of the upload.
+    Returns:
+        dict: Final result reported on /jobs/<id>.
+    """
+    try:
+        # Upload to Google Drive and analyze the file at the same time
+        logger.info("Starting Drive upload and file analysis...")
+        results, errors = run_stages(job, {
+            'drive_upload': lambda: upload_file_to_drive(receipt, filename),
+            'analysis': lambda: analyze_image(receipt, progress=job.emit)
+        })
+
+        # Continue with the process even if Drive upload fails
+        drive_file_id = results.get('drive_upload')
+        if drive_file_id:
+            logger.info(f"File uploaded to Google Drive with ID: {drive_file_id}")
+        else:
+            error = errors.get('drive_upload', 'no file id returned')
+            logger.error(f"Error uploading to Google Drive: {str(error)}")
+            job.fail_stage('drive_upload', error)
+
+        if 'analysis' in errors:
+            raise errors['analysis']
+        analysis_result, attachment_path = results['analysis']
+        logger.info(f"Analysis result: {analysis_result}")
+
+        # Parse and format the analysis result
+        try:
+            result_dict = parse_analysis(analysis_result)
+            formatted_analysis = format_analysis(result_dict)
+        except Exception as e:
+            logger.error(f"Error formatting analysis: {str(e)}")
+            job.fail_stage('analysis', analysis_result)
+            # Nothing is emailed or sent to Zapier without an analysis
+            raise Exception(f"Could not read the receipt analysis: {analysis_result}")
+
+        # Prepare email content
+        subject = f"Expense Receipt - {result_dict.get('invoice_number', 'N/A')} - {result_dict.get('vendor', 'N/A')}"
+        body = f"""
+An invoice has been processed and sent to BMO.
+
+User: {user_name}
+Credit Card: {credit_card}
+Reason: {expense_reason}
+
+{formatted_analysis}
+"""
+
+        # Convert CC list to a comma-separated string
+        cc_string = ', '.join(get_additional_recipients())
+
+        # Create Google Drive link
+        drive_link = f"https://drive.google.com/file/d/{drive_file_id}/view" if drive_file_id else ''
+
+        notify_stages, notify_details = {}, {}
+
+        # Send email with CC if enabled, or add the receipt to the recipient's digest
+        digest_mode = emails_enabled and get_delivery_mode(recipient_email) == 'digest'
+        if digest_mode:
+            digest_summary = {
+                'user_name': user_name,
+                'credit_card': credit_card,
+                'expense_reason': expense_reason,
+                'analysis': result_dict,
+                'drive_link': drive_link
+            }
+            notify_stages['email'] = lambda: digest.queue_receipt(recipient_email, digest_summary, attachment_path, filename)
+            notify_details['email'] = f'Queued for the digest to {recipient_email}'
+        elif emails_enabled:
+            def email_stage():
+                if not send_email(recipient_email, subject, body, attachment_path, cc=cc_string):
+                    raise Exception('Failed to send email')
+            notify_stages['email'] = email_stage
+        else:
+            logger.info("Email notifications are disabled - skipping email send")
+            job.skip_stage('email', 'Email notifications are disabled')
+
+        # Send data to Zapier if enabled
+        zapier_webhook_url = os.getenv('ZAPIER_WEBHOOK_URL')
+        if zapier_enabled and zapier_webhook_url:
+            webhook_data = {
+                'invoice_number': result_dict.get('invoice_number', 'N/A'),
+                'date': result_dict.get('date', 'N/A'),
+                'amount': result_dict.get('amount', 'N/A'),
+                'customer_name': result_dict.get('customer_name', 'N/A'),
+                'vendor': result_dict.get('vendor', 'N/A'),
+                'credit_card': result_dict.get('credit_card', 'N/A'),
+                'description_of_items_or_services': result_dict.get('description_of_items_or_services', 'N/A'),
+                'billing_address': result_dict.get('billing_address', 'N/A'),
+                'payment_method': result_dict.get('payment_method', 'N/A'),
+                'google_drive_url': drive_link,
+                'selected_credit_card': credit_card,
+                'expense_reason': expense_reason,
+                'user_name': user_name
+            }
+            # Only stored here; the webhook dispatcher delivers it with retries
+            notify_stages['zapier'] = lambda: enqueue_webhook(zapier_webhook_url, webhook_data)
+            notify_details['zapier'] = 'Queued for delivery'
+        elif zapier_enabled:
+            logger.warning("Zapier webhook URL not found in environment variables")
+            job.skip_stage('zapier', 'Zapier webhook URL not configured')
+        else:
+            job.skip_stage('zapier', 'Zapier integration is disabled')
+
+        results, errors = run_stages(job, notify_stages, notify_details)
+
+        # Continue even if Zapier fails
+        if 'zapier' in errors:
+            logger.error(f"Error in Zapier integration: {str(errors['zapier'])}")
+
+        if 'email' in errors:
+            logger.error(f"Failed to send email: {str(errors['email'])}")
+            raise errors['email']
+
+        # Return success with status message
+        status_message = "Receipt processed successfully."
+        if digest_mode:
+            status_message += " (Email queued for the next digest)"
+        if not emails_enabled:
+            status_message += " (Email notifications are disabled)"
+        if not zapier_enabled:
+            status_message += " (Zapier integration is disabled)"
+
+        return {
+            'message': status_message,
+            'analysis': result_dict,
+            'drive_link': drive_link,
+            'email_sent': emails_enabled and not digest_mode,
+            'email_digest': digest_mode
+        }
+    finally:
+        # Release the upload's memory or temp file
+        receipt.close()
+
 @app.route('/upload', methods=['POST'])
 def upload():
+    """Save the receipt, queue it for processing and return the job id"""
     try:
         logger.info("=== Starting Upload Process ===")
         
@@ -350,174 +755,240 @@ def upload():
         if file.filename == '':
             logger.error("No file selected")
             return jsonify({'error': 'No file selected'}), 400
-            
-        if file:
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            logger.info(f"File saved to: {filepath}")
-            
-            # Upload to Google Drive
-            try:
-                drive_file_id = upload_file_to_drive(filepath, filename)
-                logger.info(f"File uploaded to Google Drive with ID: {drive_file_id}")
-            except Exception as e:
-                logger.error(f"Error uploading to Google Drive: {str(e)}")
-                drive_file_id = None
-                # Continue with the process even if Drive upload fails
-            
-            # Analyze the file using existing analyzer
-            logger.info("Starting file analysis...")
-            analysis_result, attachment_path = analyze_image(filepath)
-            logger.info(f"Analysis result: {analysis_result}")
-            
-            # Parse and format the analysis result
-            try:
-                # Remove markdown formatting if present
-                clean_result = analysis_result
-                if "```json" in clean_result:
-                    clean_result = clean_result.replace("```json", "").replace("```", "").strip()
-                
-                # Parse the JSON
-                result_dict = json.loads(clean_result)
-                
-                # Format the analysis results nicely
-                formatted_analysis = "\n".join([
-                    "=== Analysis Results ===",
-                    f"Invoice Number: {result_dict.get('invoice_number', 'N/A')}",
-                    f"Date: {result_dict.get('date', 'N/A')}",
-                    f"Amount: ${result_dict.get('amount', 'N/A')}",
-                    f"Customer Name: {result_dict.get('customer_name', 'N/A')}",
-                    f"Vendor: {result_dict.get('vendor', 'N/A')}",
-                    f"Credit Card: {result_dict.get('credit_card', 'N/A')}",
-                    f"Payment Method: {result_dict.get('payment_method', 'N/A')}",
-                    f"Billing Address: {result_dict.get('billing_address', 'N/A')}",
-                    "\nItems/Services:",
-                    "----------------"
-                ])
-                
-                # Add items if present
-                items = result_dict.get('description_of_items_or_services', [])
-                if isinstance(items, list):
-                    formatted_analysis += "\n" + "\n".join(f"- {item}" for item in items)
-                else:
-                    formatted_analysis += f"\n{items}"
-                
-            except Exception as e:
-                logger.error(f"Error formatting analysis: {str(e)}")
-                formatted_analysis = analysis_result  # Use original if parsing fails
-            
-            # Get recipient email from credit card mapping
-            recipient_email = CREDIT_CARD_EMAILS.get(credit_card)
-            if not recipient_email:
-                logger.error(f"Invalid credit card selected: {credit_card}")
-                return jsonify({'error': 'Invalid credit card selected'}), 400
-            
-            # Prepare email content
-            subject = f"Expense Receipt - {result_dict.get('invoice_number', 'N/A')} - {result_dict.get('vendor', 'N/A')}"
-            body = f"""
-An invoice has been processed and sent to BMO.
 
-User: {user_name}
-Credit Card: {credit_card}
-Reason: {expense_reason}
+        # Get recipient email from credit card mapping
+        recipient_email = get_credit_card_emails().get(credit_card)
+        if not recipient_email:
+            logger.error(f"Invalid credit card selected: {credit_card}")
+            return jsonify({'error': 'Invalid credit card selected'}), 400
 
-{formatted_analysis}
-"""
-            
-            # Convert CC list to a comma-separated string
-            cc_string = ', '.join(ADDITIONAL_RECIPIENTS)
-            
-            # Send email with CC if enabled
-            if emails_enabled:
-                email_sent = send_email(recipient_email, subject, body, attachment_path, cc=cc_string)
-                if not email_sent:
-                    logger.error("Failed to send email")
-                    return jsonify({'error': 'Failed to send email'}), 500
-            else:
-                logger.info("Email notifications are disabled - skipping email send")
-                
-            # Create Google Drive link
-            drive_link = f"https://drive.google.com/file/d/{drive_file_id}/view" if drive_file_id else ''
-            
-            # Send data to Zapier if enabled
-            try:
-                if zapier_enabled:
-                    zapier_webhook_url = os.getenv('ZAPIER_WEBHOOK_URL')
-                    if zapier_webhook_url:
-                        logger.info(f"Sending data to Zapier webhook: {zapier_webhook_url}")
-                        webhook_data = {
-                            'invoice_number': result_dict.get('invoice_number', 'N/A'),
-                            'date': result_dict.get('date', 'N/A'),
-                            'amount': result_dict.get('amount', 'N/A'),
-                            'customer_name': result_dict.get('customer_name', 'N/A'),
-                            'vendor': result_dict.get('vendor', 'N/A'),
-                            'credit_card': result_dict.get('credit_card', 'N/A'),
-                            'description_of_items_or_services': result_dict.get('description_of_items_or_services', 'N/A'),
-                            'billing_address': result_dict.get('billing_address', 'N/A'),
-                            'payment_method': result_dict.get('payment_method', 'N/A'),
-                            'google_drive_url': drive_link,
-                            'selected_credit_card': credit_card,
-                            'expense_reason': expense_reason,
-                            'user_name': user_name
-                        }
-                        
-                        try:
-                            response = requests.post(zapier_webhook_url, json=webhook_data, timeout=10)
-                            if response.status_code != 200:
-                                logger.error(f"Failed to send data to Zapier. Status code: {response.status_code}, Response: {response.text}")
-                            else:
-                                logger.info("Successfully sent data to Zapier")
-                        except requests.exceptions.RequestException as req_err:
-                            logger.error(f"Request to Zapier failed: {str(req_err)}")
-                    else:
-                        logger.warning("Zapier webhook URL not found in environment variables")
-            except Exception as e:
-                logger.error(f"Error in Zapier integration: {str(e)}")
-                # Continue even if Zapier fails
-            
-            # Clean up files
-            try:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                if os.path.exists(attachment_path) and attachment_path != filepath:
-                    os.remove(attachment_path)
-            except Exception as e:
-                logger.error(f"Error cleaning up files: {str(e)}")
-            
-            # Return success with status message
-            status_message = "Receipt processed successfully."
-            if not emails_enabled:
-                status_message += " (Email notifications are disabled)"
-            if not zapier_enabled:
-                status_message += " (Zapier integration is disabled)"
-                
-            return jsonify({
-                'message': status_message,
-                'analysis': result_dict,
-                'drive_link': drive_link,
-                'email_sent': emails_enabled
-            })
+        # Each request owns its upload, so receipts with the same name never clash
+        filename = secure_filename(file.filename)
+        receipt = ReceiptFile.from_upload(file, filename)
+        logger.info(f"File received: {receipt}")
+
+        try:
+            job = job_queue.submit(
+                process_receipt, receipt, filename, credit_card, expense_reason, user_name,
+                recipient_email, emails_enabled, zapier_enabled,
+                stages=RECEIPT_STAGES
+            )
+        except Exception:
+            receipt.close()
+            raise
+        job.finish_stage('saved')
+
+        return jsonify({
+            'job_id': job.id,
+            'status_url': url_for('job_status', job_id=job.id),
+            'events_url': url_for('job_events', job_id=job.id)
+        }), 202
             
     except Exception as e:
         logger.error(f"Error in upload process: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def process_batch(job, receipt_jobs):
+    """
+    Run the receipt jobs of a batch, at most BATCH_CONCURRENCY at a time.
+
+    Args:
+        job (Job): The batch job.
+        receipt_jobs (list): Jobs created for each file of the batch.
+    Returns:
+        dict: Counts of processed and failed receipts.
+    """
+    job.start_stage('receipts')
+    with ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch') as pool:
+        list(pool.map(job_queue.run_job, receipt_jobs))
+
+    failed = [receipt_job for receipt_job in receipt_jobs if receipt_job.status == 'failed']
+    job.finish_stage('receipts', {'processed': len(receipt_jobs), 'failed': len(failed)})
+    return {
+        'message': f"Processed {len(receipt_jobs) - len(failed)} of {len(receipt_jobs)} receipts.",
+        'processed': len(receipt_jobs) - len(failed),
+        'failed': len(failed)
+    }
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Save several receipts that share the same form fields and queue them as one batch"""
+    try:
+        logger.info("=== Starting Batch Upload Process ===")
+
+        settings = get_settings()
+        emails_enabled = settings.get('emails_enabled', True)
+        zapier_enabled = settings.get('zapier_enabled', True)
+
+        files = [f for f in request.files.getlist('files') if f.filename]
+        credit_card = request.form.get('credit_card')
+        expense_reason = request.form.get('expense_reason')
+        user_name = request.form.get('user_name')
+
+        if not files:
+            logger.error("No files uploaded")
+            return jsonify({'error': 'No files uploaded'}), 400
+
+        if len(files) > BATCH_MAX_FILES:
+            logger.error(f"Too many files in batch: {len(files)}")
+            return jsonify({'error': f'A batch can contain at most {BATCH_MAX_FILES} files'}), 400
+
+        if not credit_card or not expense_reason or not user_name:
+            logger.error("Missing credit card, expense reason, or user name")
+            return jsonify({'error': 'Missing credit card, expense reason, or user name'}), 400
+
+        recipient_email = get_credit_card_emails().get(credit_card)
+        if not recipient_email:
+            logger.error(f"Invalid credit card selected: {credit_card}")
+            return jsonify({'error': 'Invalid credit card selected'}), 400
+
+        receipt_jobs = []
+        receipts = []
+        used_names = set()
+        try:
+            for file in files:
+                # Names in the same batch stay distinct in Drive and the email attachments
+                filename = secure_filename(file.filename)
+                base, ext = os.path.splitext(filename)
+                counter = 1
+                while filename in used_names:
+                    counter += 1
+                    filename = f"{base}_{counter}{ext}"
+                used_names.add(filename)
+
+                receipt = ReceiptFile.from_upload(file, filename)
+                receipts.append(receipt)
+                logger.info(f"File received: {receipt}")
+
+                receipt_job = job_queue.create(
+                    process_receipt, receipt, filename, credit_card, expense_reason, user_name,
+                    recipient_email, emails_enabled, zapier_enabled,
+                    stages=RECEIPT_STAGES
+                )
+                receipt_job.finish_stage('saved', {'filename': filename})
+                receipt_jobs.append(receipt_job)
+
+            batch_job = job_queue.create(process_batch, receipt_jobs, stages=('receipts',))
+            batch_job.children = receipt_jobs
+            job_queue.enqueue(batch_job)
+        except Exception:
+            # Nothing was queued, so no job will release these
+            for receipt in receipts:
+                receipt.close()
+            raise
+
+        return jsonify({
+            'job_id': batch_job.id,
+            'status_url': url_for('job_status', job_id=batch_job.id),
+            'events_url': url_for('job_events', job_id=batch_job.id),
+            'jobs': [
+                {
+                    'filename': receipt_job.stages['saved']['detail']['filename'],
+                    'job_id': receipt_job.id,
+                    'status_url': url_for('job_status', job_id=receipt_job.id),
+                    'events_url': url_for('job_events', job_id=receipt_job.id)
+                }
+                for receipt_job in receipt_jobs
+            ]
+        }), 202
+
+    except Exception as e:
+        logger.error(f"Error in batch upload process: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report stage progress and the final result of a queued receipt"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+# Seconds between keep-alive comments on an idle event stream
+SSE_KEEPALIVE_SECONDS = 15
+# Event streams one worker serves at once. Under gthread each holds one of the
+# GUNICORN_THREADS threads while open; refused clients poll status_url instead
+SSE_MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS', 1000 if gevent_active() else
+                                max(int(os.getenv('GUNICORN_THREADS', 16)) // 2, 1)))
+# Longest an event stream stays open; the browser then polls status_url
+SSE_MAX_SECONDS = float(os.getenv('SSE_MAX_SECONDS', 300))
+
+_sse_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+def format_sse(event_id, event, data):
+    """One Server-Sent Events message"""
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_job_events(job, last_id=0, max_seconds=None):
+    """Yield a job's events as SSE messages until it has finished or max_seconds have passed"""
+    deadline = time.monotonic() + (SSE_MAX_SECONDS if max_seconds is None else max_seconds)
+    # Flush the headers and give the browser a first byte right away
+    yield ": connected\n\n"
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        events = job.wait_for_events(last_id, min(SSE_KEEPALIVE_SECONDS, remaining))
+        for event_id, event, data in events:
+            yield format_sse(event_id, event, data)
+            last_id = event_id
+        if not events:
+            if job.done:
+                return
+            yield ": keep-alive\n\n"
+
+def too_many_streams_response(**body):
+    """503 telling the client to poll instead of opening another event stream"""
+    metrics.inc('errors_total', source='sse', reason='too_many_streams')
+    body['error'] = 'Too many open event streams'
+    return jsonify(body), 503, {'Retry-After': str(SSE_KEEPALIVE_SECONDS)}
+
+def event_stream_response(job, slot_acquired=False):
+    """
+    Streaming response for a job, resuming after the browser's Last-Event-ID.
+
+    Each stream takes one of SSE_MAX_STREAMS slots until the client
+    disconnects or SSE_MAX_SECONDS pass; without a free slot the client
+    gets a 503 with the job's status_url to poll.
+
+    Args:
+        job (Job or StoredJob): The job to follow.
+        slot_acquired (bool): The caller already took a slot for this stream.
+    """
+    if not slot_acquired and not _sse_slots.acquire(blocking=False):
+        return too_many_streams_response(job_id=job.id, status_url=url_for('job_status', job_id=job.id))
+    last_id = request.headers.get('Last-Event-ID', type=int) or 0
+    response = Response(stream_job_events(job, last_id), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Stop proxies from buffering the stream
+    })
+    response.call_on_close(_sse_slots.release)
+    return response
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Stream stage progress, the model's output and the final result of a job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return event_stream_response(job)
+
 @app.route('/authorize_gmail')
 def authorize_gmail():
     """Test Gmail service account connection"""
     try:
         logger.info("Testing Gmail service account connection...")
         
-        # Try to get Gmail service using service account
+        # Verify the cached Gmail client with a profile lookup
         try:
-            service = get_gmail_service()
-            if service:
-                logger.info("Successfully verified Gmail service account credentials")
-                return jsonify({
-                    'message': 'Gmail service account connection successful',
-                    'email': os.environ.get('GMAIL_SENDER_EMAIL', 'Unknown')
-                })
+            health = check_gmail_service()
+            logger.info("Successfully verified Gmail service account credentials")
+            return jsonify({
+                'message': 'Gmail service account connection successful',
+                'email': health['email'] or os.environ.get('GMAIL_SENDER_EMAIL', 'Unknown'),
+                'token_valid': health['token_valid'],
+                'token_expiry': health['token_expiry']
+            })
         except Exception as e:
             error_msg = f"Error verifying service account credentials: {str(e)}"
             logger.error(error_msg)
@@ -528,7 +999,17 @@ def authorize_gmail():
         logger.error(error_msg)
         return jsonify({'error': error_msg}), 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Latency histograms and counters of all workers in the Prometheus text format"""
+    authorization = request.headers.get('Authorization', '')
+    token_ok = bool(METRICS_TOKEN) and hmac.compare_digest(authorization.encode(), f'Bearer {METRICS_TOKEN}'.encode())
+    if not (METRICS_PUBLIC or token_ok or session.get('admin_logged_in')):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     logger.info(f"Starting application on port {os.environ.get('PORT', 8080)}")
     port = int(os.environ.get('PORT', 8080))
+    start_background_threads()
     app.run(host='0.0.0.0', port=port)
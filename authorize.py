@@ -1,9 +1,8 @@
-from google.oauth2 import service_account
 import os
 import json
 import logging
+import threading
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 SCOPES = [
@@ -14,7 +13,75 @@ SCOPES = [
     'https://www.googleapis.com/auth/gmail.readonly'
 ]
 
+# Root URL used for every Google API instead of the one in the discovery
+# documents, e.g. the local stand-in started by benchmark_load.py
+GOOGLE_API_ENDPOINT = os.getenv('GOOGLE_API_ENDPOINT')
+
+# Credentials are parsed once per process and shared; google-auth refreshes
+# the access token only when it has expired
+_credentials = None
+_credentials_lock = threading.Lock()
+
+# API clients are cached per thread because httplib2 is not thread-safe
+_services = threading.local()
+
 def get_credentials():
+    """Get the cached delegated service account credentials"""
+    global _credentials
+    if _credentials is None:
+        with _credentials_lock:
+            if _credentials is None:
+                _credentials = load_credentials()
+    return _credentials
+
+def get_service(api_name, api_version):
+    """
+    Get this thread's cached Google API client.
+
+    The client is built from the discovery document bundled with
+    google-api-python-client, so building it makes no HTTP request.
+
+    Args:
+        api_name (str): API name, e.g. 'gmail' or 'drive'.
+        api_version (str): API version, e.g. 'v1'.
+    Returns:
+        Resource: Authorized API client.
+    """
+    pid = os.getpid()
+    if getattr(_services, 'pid', None) != pid:
+        # Never reuse connections inherited from a parent process
+        _services.pid = pid
+        _services.clients = {}
+
+    key = (api_name, api_version)
+    service = _services.clients.get(key)
+    if service is None:
+        # Imported on first use; googleapiclient is slow to import
+        from googleapiclient.discovery import build
+        logger.info(f"Building {api_name} {api_version} client for thread {threading.current_thread().name}")
+        if GOOGLE_API_ENDPOINT:
+            service = build_with_endpoint(api_name, api_version, GOOGLE_API_ENDPOINT)
+        else:
+            service = build(api_name, api_version, credentials=get_credentials(),
+                            static_discovery=True, cache_discovery=False)
+        _services.clients[key] = service
+    return service
+
+def build_with_endpoint(api_name, api_version, endpoint):
+    """
+    Build a client whose requests, media uploads included, all go to endpoint.
+
+    client_options' api_endpoint only moves the media upload URLs to the new
+    host and keeps https, so the root URL of the bundled discovery document
+    is replaced instead.
+    """
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.discovery_cache import get_static_doc
+    document = json.loads(get_static_doc(api_name, api_version))
+    document['rootUrl'] = endpoint
+    return build_from_document(document, credentials=get_credentials())
+
+def load_credentials():
     logger.info("Starting credentials retrieval process...")
     
     # Get the sender email for delegation
@@ -37,6 +104,7 @@ def get_credentials():
         
         # Create service account credentials
         logger.info("Creating service account credentials...")
+        from google.oauth2 import service_account
         credentials = service_account.Credentials.from_service_account_info(
             credentials_dict,
             scopes=SCOPES
@@ -52,11 +120,13 @@ def get_credentials():
         
     except json.JSONDecodeError as e:
         logger.error(f"Invalid JSON in GOOGLE_CREDENTIALS: {e}")
-        logger.error(f"First 100 chars of credentials: {creds_json[:100]}...")
+        logger.error(f"GOOGLE_CREDENTIALS is {len(creds_json)} characters long")
         raise ValueError(f"Invalid JSON in GOOGLE_CREDENTIALS: {e}")
     except Exception as e:
         logger.error(f"Failed to create service account credentials: {e}")
         raise RuntimeError(f"Failed to create service account credentials: {e}")
 
 if __name__ == "__main__":
+    from logging_setup import setup_logging
+    setup_logging(level='DEBUG', log_format='text')
     get_credentials()
\ No newline at end of file
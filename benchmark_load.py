@@ -0,0 +1,507 @@
+"""
+Load-test the app offline against local stand-ins for every external service.
+
+Starts fake_services.py in this process and the app under gunicorn (with
+gunicorn.conf.py, as in production) pointed at it, then drives /upload,
+/analyze and /upload/batch at each concurrency level with a corpus of
+receipts. /upload and batch requests are timed until their job has
+finished, read from the job's event stream. Reports throughput,
+p50/p95/p99 latency and the peak RSS of the gunicorn processes.
+
+Without --corpus a corpus is generated: receipt photos of two sizes, a
+PNG screenshot, a scanned PDF and a PDF with a text layer (PDFs need
+poppler, as in production). The analysis cache is off unless --cache is
+given, since the corpus repeats. The API rate limits are lifted unless
+--keep-rate-limits is given, so the numbers show the app and not the
+limiter.
+
+With --output the results are written as JSON; a later run given that file
+as --baseline fails when p95 latency, throughput or peak RSS is more than
+--tolerance worse.
+
+Jobs are kept in DATA_DIR/jobs.db, which all gunicorn workers share, so
+with --workers above 1 any worker can serve a job's event stream.
+
+Usage:
+    python benchmark_load.py [--scenarios upload,analyze,batch] [--concurrency 1,8,32] [--requests 40]
+        [--workers 1] [--worker-class gthread] [--openai-latency 2.0] [--error-rate 0.0]
+        [--corpus DIR] [--output results.json] [--baseline results.json]
+"""
+import io
+import os
+import sys
+import json
+import time
+import socket
+import random
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from fake_services import FakeServices, add_arguments, behaviours_from_args, service_account_info
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = ('upload', 'analyze', 'batch')
+SUPPORTED_EXTENSIONS = {'.pdf': 'application/pdf', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png'}
+
+CREDIT_CARD = 'Bench Card'
+BENCH_SETTINGS = {
+    'credit_card_emails': {CREDIT_CARD: 'finance@example.com'},
+    'additional_recipients': [],
+    'digest_recipients': [],
+    'settings': {'emails_enabled': True, 'zapier_enabled': True}
+}
+FORM = {'credit_card': CREDIT_CARD, 'expense_reason': 'Load test', 'user_name': 'Bench'}
+
+# Seconds to wait for the app to answer after starting gunicorn
+STARTUP_TIMEOUT = 60
+# Seconds a single request or job may take
+REQUEST_TIMEOUT = 300
+
+RECEIPT_LINES = [
+    'BENCH SUPPLIES LTD', '1 Test Street, Springfield', '', 'Invoice: INV-10042', 'Date: 2024-03-14', '',
+    'Printer paper          2 x 12.50', 'Toner cartridge            89.90', 'Delivery                    13.50',
+    '', 'TOTAL                     128.40', 'VISA **** 4242'
+]
+
+
+def receipt_image(width, height, noise=24):
+    """A receipt photo: text on paper with sensor noise, so JPEG sizes are realistic"""
+    from PIL import Image, ImageDraw
+    image = Image.new('L', (width, height), 235)
+    image = Image.blend(image, Image.effect_noise((width, height), noise), 0.3)
+    draw = ImageDraw.Draw(image)
+    step = height // (len(RECEIPT_LINES) + 4)
+    for index, line in enumerate(RECEIPT_LINES):
+        draw.text((width // 10, step * (index + 2)), line, fill=20)
+    return image.convert('RGB')
+
+
+def encode_image(image, image_format, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+
+def text_pdf(lines):
+    """A one-page PDF with a text layer, written by hand so no PDF library is needed"""
+    text = ' '.join(f"({line.replace('(', '[').replace(')', ']')}) '" for line in lines)
+    stream = f'BT /F1 11 Tf 72 760 Td 14 TL {text} ET'.encode()
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R '
+        b'/Resources << /Font << /F1 5 0 R >> >> >>',
+        b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>',
+    ]
+    pdf = io.BytesIO()
+    pdf.write(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(pdf.tell())
+        pdf.write(b'%d 0 obj\n%s\nendobj\n' % (number, body))
+    xref = pdf.tell()
+    pdf.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    for offset in offsets:
+        pdf.write(b'%010d 00000 n \n' % offset)
+    pdf.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref))
+    return pdf.getvalue()
+
+
+def generate_corpus():
+    """(filename, content, mime type) tuples of typical uploads"""
+    photo = receipt_image(1200, 1800)
+    large_photo = receipt_image(3000, 4000)
+    screenshot = receipt_image(900, 1400, noise=0)
+    return [
+        ('receipt_photo.jpg', encode_image(photo, 'JPEG', quality=90), 'image/jpeg'),
+        ('receipt_photo_large.jpg', encode_image(large_photo, 'JPEG', quality=92), 'image/jpeg'),
+        ('receipt_screenshot.png', encode_image(screenshot, 'PNG'), 'image/png'),
+        ('receipt_scan.pdf', encode_image(photo, 'PDF', resolution=150), 'application/pdf'),
+        ('invoice_text.pdf', text_pdf(RECEIPT_LINES), 'application/pdf'),
+    ]
+
+
+def load_corpus(corpus_dir):
+    corpus = []
+    for name in sorted(os.listdir(corpus_dir)):
+        mime_type = SUPPORTED_EXTENSIONS.get(os.path.splitext(name)[1].lower())
+        if mime_type:
+            with open(os.path.join(corpus_dir, name), 'rb') as f:
+                corpus.append((name, f.read(), mime_type))
+    if not corpus:
+        raise SystemExit(f"No receipts in {corpus_dir}")
+    return corpus
+
+
+def percentile(values, quantile):
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[round(quantile * 100) - 1]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def read_rss_kb(pid, field):
+    """VmRSS or VmHWM of a process in kB, or None if it has exited"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def child_pids(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+class RssSampler(threading.Thread):
+    """
+    Samples the resident memory of the gunicorn master and its workers.
+
+    peak_total_kb is the highest sum seen since the last reset();
+    worker_peaks_kb keeps each worker's own high-water mark (VmHWM).
+    Linux only; elsewhere every figure stays empty.
+    """
+
+    def __init__(self, master_pid, interval=0.1):
+        super().__init__(name='rss-sampler', daemon=True)
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peak_total_kb = 0
+        self.worker_peaks_kb = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            total = read_rss_kb(self.master_pid, 'VmRSS') or 0
+            for pid in child_pids(self.master_pid):
+                total += read_rss_kb(pid, 'VmRSS') or 0
+                peak = read_rss_kb(pid, 'VmHWM')
+                if peak:
+                    self.worker_peaks_kb[pid] = max(peak, self.worker_peaks_kb.get(pid, 0))
+            self.peak_total_kb = max(self.peak_total_kb, total)
+
+    def reset(self):
+        self.peak_total_kb = 0
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def start_app(args, fakes, work_dir):
+    """Start gunicorn on a free port and wait until the app answers"""
+    import requests
+    data_dir = os.path.join(work_dir, 'data')
+    os.makedirs(data_dir)
+    settings_file = os.path.join(work_dir, 'settings.json')
+    with open(settings_file, 'w') as f:
+        json.dump(BENCH_SETTINGS, f)
+
+    env = dict(os.environ)
+    env.update({
+        'DATA_DIR': data_dir,
+        'SETTINGS_FILE': settings_file,
+        'APP_SETTINGS': json.dumps(BENCH_SETTINGS),
+        'LOG_LEVEL': args.log_level,
+        'LOG_FILES_ENABLED': 'false',
+        'ADMIN_USERNAME': 'bench',
+        'ADMIN_PASSWORD': 'bench',
+        'OPENAI_API_KEY': 'sk-bench',
+        'OPENAI_BASE_URL': fakes.openai_base_url,
+        'GMAIL_SENDER_EMAIL': 'bench@example.com',
+        'GOOGLE_CREDENTIALS': json.dumps(service_account_info(fakes.token_uri)),
+        'GOOGLE_API_ENDPOINT': fakes.google_api_endpoint,
+        'ZAPIER_WEBHOOK_URL': fakes.zapier_url,
+        'ANALYSIS_CACHE_ENABLED': 'true' if args.cache else 'false',
+        'GUNICORN_WORKER_CLASS': args.worker_class,
+    })
+    if not args.keep_rate_limits:
+        for api in ('OPENAI', 'GMAIL', 'DRIVE'):
+            env[f'{api}_RATE_LIMIT'] = '1000000'
+            env[f'{api}_RATE_BURST'] = '1000'
+
+    port = free_port()
+    log_path = os.path.join(work_dir, 'app.log')
+    log_file = open(log_path, 'w')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+         '--workers', str(args.workers), '--timeout', '120'],
+        cwd=APP_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"gunicorn exited with {process.returncode}, see {log_path}")
+        try:
+            requests.get(base_url + '/', timeout=1)
+            return process, base_url, log_path
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"The app did not start within {STARTUP_TIMEOUT}s, see {log_path}")
+
+
+class LoadClient:
+    """Runs scenario requests, one requests.Session (keep-alive connection) per thread"""
+
+    def __init__(self, base_url, corpus, batch_size):
+        self.base_url = base_url
+        self.corpus = corpus
+        self.batch_size = batch_size
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        if not hasattr(self._local, 'session'):
+            import requests
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def pick(self, index):
+        return self.corpus[index % len(self.corpus)]
+
+    def run(self, scenario, index):
+        """
+        Run one request of a scenario.
+
+        Returns:
+            dict: seconds (until the job finished), submit_seconds (until
+            the response), ok and, for failures, error.
+        """
+        start = time.perf_counter()
+        try:
+            ok, error, submitted = getattr(self, scenario)(index, start)
+        except Exception as e:
+            ok, error, submitted = False, type(e).__name__, None
+        seconds = time.perf_counter() - start
+        return {'seconds': seconds, 'submit_seconds': submitted or seconds, 'ok': ok, 'error': error}
+
+    def analyze(self, index, start):
+        name, content, mime_type = self.pick(index)
+        response = self.session.post(self.base_url + '/analyze', files={'file': (name, content, mime_type)},
+                                     timeout=REQUEST_TIMEOUT)
+        if response.status_code != 200:
+            return False, f'http_{response.status_code}', None
+        try:
+            result = json.loads(response.json()['result'])
+        except (TypeError, ValueError):
+            return False, 'analysis_error', None
+        return isinstance(result, dict), None, None
+
+    def upload(self, index, start):
+        name, content, mime_type = self.pick(index)
+        response = self.session.post(self.base_url + '/upload', files={'file': (name, content, mime_type)},
+                                     data=FORM, timeout=REQUEST_TIMEOUT)
+        submitted = time.perf_counter() - start
+        if response.status_code != 202:
+            return False, f'http_{response.status_code}', submitted
+        ok, error = self.wait_for_job(response.json()['events_url'])
+        return ok, error, submitted
+
+    def batch(self, index, start):
+        files = [('files', self.pick(index + offset)) for offset in range(self.batch_size)]
+        response = self.session.post(self.base_url + '/upload/batch', files=files, data=FORM,
+                                     timeout=REQUEST_TIMEOUT)
+        submitted = time.perf_counter() - start
+        if response.status_code != 202:
+            return False, f'http_{response.status_code}', submitted
+        ok, error = self.wait_for_job(response.json()['events_url'])
+        return ok, error, submitted
+
+    def wait_for_job(self, events_url):
+        """
+        Read a job's event stream to the end.
+
+        Returns:
+            tuple: (ok, error). A failed stage or failed batch receipt
+            counts as an error even when the job itself completed.
+        """
+        response = self.session.get(self.base_url + events_url, stream=True, timeout=REQUEST_TIMEOUT)
+        if response.status_code != 200:
+            # 404: the job is unknown, 503: no free event stream slot
+            return False, 'job_not_found' if response.status_code == 404 else f'http_{response.status_code}'
+        ok, error, event = False, 'no_result', None
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith('event: '):
+                    event = line[7:]
+                elif line.startswith('data: '):
+                    data = json.loads(line[6:])
+                    if event == 'stage' and data.get('status') == 'failed':
+                        error = f"stage_{data['name']}"
+                    elif event == 'error':
+                        ok, error = False, 'job_failed'
+                    elif event == 'result':
+                        if isinstance(data, dict) and data.get('failed'):
+                            ok, error = False, 'batch_receipt_failed'
+                        elif error == 'no_result':
+                            ok, error = True, None
+        return ok, error
+
+
+def run_level(client, sampler, scenario, concurrency, requests_count):
+    """Run requests_count requests of a scenario with concurrency clients"""
+    sampler.reset()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(lambda index: client.run(scenario, index), range(requests_count)))
+    elapsed = time.perf_counter() - start
+
+    succeeded = [outcome for outcome in outcomes if outcome['ok']]
+    latencies = [outcome['seconds'] for outcome in succeeded]
+    errors = {}
+    for outcome in outcomes:
+        if not outcome['ok']:
+            errors[outcome['error']] = errors.get(outcome['error'], 0) + 1
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'requests': requests_count,
+        'errors': sum(errors.values()),
+        'error_reasons': errors,
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(succeeded) / elapsed, 3) if elapsed else None,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'submit_p50': percentile([outcome['submit_seconds'] for outcome in succeeded], 0.50),
+        'peak_rss_mb': round(sampler.peak_total_kb / 1024, 1) if sampler.peak_total_kb else None,
+    }
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Regressions of p95, throughput and peak RSS against an earlier run"""
+    previous = {(row['scenario'], row['concurrency']): row for row in baseline['results']}
+    regressions = []
+    for row in results:
+        before = previous.get((row['scenario'], row['concurrency']))
+        if not before:
+            continue
+        checks = (
+            ('p95', row['p95'], before['p95'], 1 + tolerance, 'higher'),
+            ('throughput', row['throughput'], before['throughput'], 1 - tolerance, 'lower'),
+            ('peak_rss_mb', row['peak_rss_mb'], before['peak_rss_mb'], 1 + tolerance, 'higher'),
+        )
+        for name, value, reference, factor, worse in checks:
+            if value is None or not reference:
+                continue
+            if (worse == 'higher' and value > reference * factor) or (worse == 'lower' and value < reference * factor):
+                regressions.append(f"{row['scenario']} x{row['concurrency']}: {name} {value} vs {reference}")
+    return regressions
+
+
+def format_seconds(value):
+    return f'{value:7.2f}' if value is not None else '      -'
+
+
+def print_report(results, sampler, fakes):
+    print(f"{'scenario':10s} {'conc':>4s} {'reqs':>5s} {'errors':>6s} {'req/s':>7s} "
+          f"{'p50':>7s} {'p95':>7s} {'p99':>7s} {'submit':>7s} {'RSS MB':>7s}")
+    for row in results:
+        rss = f"{row['peak_rss_mb']:7.1f}" if row['peak_rss_mb'] else '      -'
+        print(f"{row['scenario']:10s} {row['concurrency']:4d} {row['requests']:5d} {row['errors']:6d} "
+              f"{row['throughput']:7.2f} {format_seconds(row['p50'])} {format_seconds(row['p95'])} "
+              f"{format_seconds(row['p99'])} {format_seconds(row['submit_p50'])} {rss}")
+        if row['error_reasons']:
+            print(f"{'':16s}errors: {', '.join(f'{k} ({v})' for k, v in sorted(row['error_reasons'].items()))}")
+    if sampler.worker_peaks_kb:
+        peaks = ', '.join(f'{kb / 1024:.0f}' for kb in sampler.worker_peaks_kb.values())
+        print(f"Peak RSS per worker (MB): {peaks}")
+    print("Fake service calls: " + ', '.join(
+        f"{name} {stats['calls']} ({stats['errors']} failed)" for name, stats in fakes.stats.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma-separated scenarios to run')
+    parser.add_argument('--concurrency', default='1,8,32', help='Comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=40, help='Requests per scenario and level')
+    parser.add_argument('--warmup', type=int, default=2, help='Unmeasured requests per scenario before the levels')
+    parser.add_argument('--batch-size', type=int, default=5, help='Files per /upload/batch request')
+    parser.add_argument('--corpus', help='Folder of receipts to upload instead of the generated ones')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn workers')
+    parser.add_argument('--worker-class', default=os.getenv('GUNICORN_WORKER_CLASS', 'gthread'),
+                        help='gthread or gevent (see gunicorn.conf.py)')
+    parser.add_argument('--cache', action='store_true', help='Keep the analysis cache on')
+    parser.add_argument('--keep-rate-limits', action='store_true', help='Keep the API rate limits of resilience.py')
+    parser.add_argument('--log-level', default='WARNING', help="The app's LOG_LEVEL")
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Fail if worse than the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed regression against the baseline')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the injected latency and failures')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(',')]
+    random.seed(args.seed)
+
+    corpus = load_corpus(args.corpus) if args.corpus else generate_corpus()
+    print(f"Corpus: {', '.join(f'{name} ({len(content) // 1024} KB)' for name, content, _ in corpus)}")
+
+    work_dir = tempfile.mkdtemp(prefix='load-bench-')
+    with FakeServices(behaviours=behaviours_from_args(args)) as fakes:
+        process, base_url, log_path = start_app(args, fakes, work_dir)
+        sampler = RssSampler(process.pid)
+        sampler.start()
+        print(f"App on {base_url} ({args.workers} {args.worker_class} workers), log in {log_path}")
+        try:
+            client = LoadClient(base_url, corpus, args.batch_size)
+            for scenario in scenarios:
+                for index in range(args.warmup):
+                    client.run(scenario, index)
+            results = []
+            for concurrency in levels:
+                for scenario in scenarios:
+                    results.append(run_level(client, sampler, scenario, concurrency, args.requests))
+        finally:
+            sampler.stop()
+            process.terminate()
+            process.wait(timeout=30)
+        print_report(results, sampler, fakes)
+
+    report = {
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'worker_peak_rss_mb': [round(kb / 1024, 1) for kb in sampler.worker_peaks_kb.values()],
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Regressions beyond {args.tolerance:.0%} of {args.baseline}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} of {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Measure what logging costs the thread that logs.
+
+Compares the previous setup (a console handler and two synchronous
+FileHandlers, one with a filter lowercasing every message) with the
+queue-based setup in logging_setup.py. Reports the time per logger.info
+call spent in the calling thread and what that adds to an upload that
+logs LINES_PER_UPLOAD lines. Log files are written to a temp directory
+and console output goes to /dev/null.
+
+Usage:
+    python benchmark_logging.py [--calls 20000] [--lines-per-upload 60]
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+# Rough number of lines an upload logs at INFO
+LINES_PER_UPLOAD = 60
+
+
+def time_calls(logger, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        logger.info(f"Stage drive_upload finished in {i / 1000:.2f}s")
+    return (time.perf_counter() - start) / calls
+
+
+def reset_root():
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+
+
+def synchronous_setup(log_dir, devnull):
+    """The handlers gmail_service.py used to install"""
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = logging.FileHandler(os.path.join(log_dir, 'all_processes.log'))
+    email_handler = logging.FileHandler(os.path.join(log_dir, 'email.log'))
+    email_handler.addFilter(lambda record: 'email' in record.getMessage().lower())
+    console_handler = logging.StreamHandler(devnull)
+    root = logging.getLogger()
+    for handler in (file_handler, email_handler, console_handler):
+        handler.setFormatter(formatter)
+        root.addHandler(handler)
+    root.setLevel(logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--lines-per-upload', type=int, default=LINES_PER_UPLOAD)
+    args = parser.parse_args()
+
+    log_dir = tempfile.mkdtemp(prefix='log-bench-')
+    devnull = open(os.devnull, 'w')
+    logger = logging.getLogger('benchmark')
+
+    synchronous_setup(log_dir, devnull)
+    sync_cost = time_calls(logger, args.calls)
+    reset_root()
+
+    # Point the queue listener's console handler at /dev/null too
+    os.environ['LOG_DIR'] = log_dir
+    sys.stdout, real_stdout = devnull, sys.stdout
+    import logging_setup
+    logging_setup.LOG_DIR = log_dir
+    handler = logging_setup.setup_logging(level='INFO')
+    # Measure the cost of queueing every record, not of dropping them
+    handler.max_size = args.calls + 1
+    queued_cost = time_calls(logger, args.calls)
+    logging_setup.stop_logging()
+    sys.stdout = real_stdout
+
+    print(f"{args.calls} calls, {args.lines_per_upload} lines per upload")
+    for name, cost in (('synchronous handlers', sync_cost), ('queue + listener', queued_cost)):
+        print(f"  {name:22s} {cost * 1e6:7.1f} us/call  {cost * args.lines_per_upload * 1e3:6.2f} ms/upload")
+    print(f"  dropped by a full queue: {handler.dropped}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Compare vision preprocessing presets on a folder of sample receipts.
+
+For every file and preset this sends the prepared images to the model and
+records the payload size, the request latency and how many fields agree
+with the 'original' preset (the unmodified image), so the defaults in
+image_processing.py can be chosen with data.
+
+Usage:
+    python benchmark_preprocessing.py SAMPLES_DIR [--presets original,default,compact] [--csv results.csv]
+"""
+import os
+import csv
+import sys
+import time
+import argparse
+from image_processing import prepare_file_for_vision
+
+# Keyword arguments for prepare_file_for_vision
+PRESETS = {
+    'original': {'preprocess': False},
+    'default': {},
+    'compact': {'max_side': 1536, 'quality': 70},
+    'grayscale': {'grayscale': True},
+    'low_detail': {'max_side': 1024, 'detail': 'low'},
+}
+
+FIELDS = [
+    'invoice_number', 'date', 'amount', 'vendor', 'credit_card',
+    'customer_name', 'payment_method', 'billing_address'
+]
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.jpg', '.jpeg', '.png')
+
+
+def normalise(value):
+    """Loose comparison form of an extracted value"""
+    return ' '.join(str(value).lower().replace(',', '').split())
+
+
+def field_agreement(result, reference):
+    """Fraction of FIELDS that match the reference result"""
+    if not result or not reference:
+        return 0.0
+    matches = sum(1 for field in FIELDS
+                  if normalise(result.get(field, 'N/A')) == normalise(reference.get(field, 'N/A')))
+    return matches / len(FIELDS)
+
+
+def run_preset(file_path, preset):
+    """Prepare and analyse one file with a preset"""
+    from app import request_analysis, parse_analysis
+
+    start = time.time()
+    images = prepare_file_for_vision(file_path, **PRESETS[preset])
+    prepare_time = time.time() - start
+    payload = sum(len(image_bytes) for image_bytes, _ in images)
+
+    start = time.time()
+    content = request_analysis(images)
+    latency = time.time() - start
+    try:
+        result = parse_analysis(content)
+    except ValueError:
+        result = None
+    return {
+        'preset': preset,
+        'file': os.path.basename(file_path),
+        'payload_bytes': payload,
+        'prepare_seconds': round(prepare_time, 3),
+        'latency_seconds': round(latency, 3),
+        'result': result
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('samples_dir', help='Folder of sample receipts')
+    parser.add_argument('--presets', default=','.join(PRESETS), help='Comma-separated presets to compare')
+    parser.add_argument('--csv', help='Write per-file rows to this CSV file')
+    args = parser.parse_args()
+
+    presets = [p.strip() for p in args.presets.split(',') if p.strip()]
+    unknown = [p for p in presets if p not in PRESETS]
+    if unknown:
+        print(f"Unknown presets: {', '.join(unknown)}")
+        sys.exit(1)
+    if 'original' not in presets:
+        presets.insert(0, 'original')
+
+    files = sorted(os.path.join(args.samples_dir, f) for f in os.listdir(args.samples_dir)
+                   if f.lower().endswith(SUPPORTED_EXTENSIONS))
+    if not files:
+        print(f"No receipts found in {args.samples_dir}")
+        sys.exit(1)
+
+    rows = []
+    for file_path in files:
+        reference = None
+        for preset in presets:
+            row = run_preset(file_path, preset)
+            if preset == 'original':
+                reference = row['result']
+            row['agreement'] = round(field_agreement(row['result'], reference), 3)
+            rows.append(row)
+            print(f"{row['file']:<40} {preset:<12} {row['payload_bytes']:>10} bytes "
+                  f"{row['latency_seconds']:>7.2f}s agreement {row['agreement']:.0%}")
+
+    print("\n=== Summary ===")
+    print(f"{'preset':<12} {'avg bytes':>12} {'avg latency':>12} {'agreement':>10}")
+    for preset in presets:
+        preset_rows = [r for r in rows if r['preset'] == preset]
+        count = len(preset_rows)
+        print(f"{preset:<12} {sum(r['payload_bytes'] for r in preset_rows) / count:>12.0f} "
+              f"{sum(r['latency_seconds'] for r in preset_rows) / count:>11.2f}s "
+              f"{sum(r['agreement'] for r in preset_rows) / count:>10.0%}")
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['file', 'preset', 'payload_bytes', 'prepare_seconds',
+                                                   'latency_seconds', 'agreement'], extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"\nWrote {len(rows)} rows to {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
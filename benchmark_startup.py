@@ -0,0 +1,121 @@
+"""
+Measure how long a fresh process takes to import the app.
+
+Each run imports app.py in a new interpreter, as a gunicorn worker does
+at boot, and reports the median and slowest wall time. The slowest
+modules come from python -X importtime. The script fails when the median
+is over the budget, or when one of the slow client libraries (which must
+only be imported on first use) is loaded at import time.
+
+Required environment variables that are missing get placeholder values,
+since the app only checks that they are set.
+
+Usage:
+    python benchmark_startup.py [--runs 5] [--budget 0.5] [--top 10]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+# Seconds a worker may spend importing the app (median of the runs)
+STARTUP_BUDGET_SECONDS = float(os.getenv('STARTUP_BUDGET_SECONDS', 0.5))
+
+# Modules that must not be loaded by importing the app
+LAZY_MODULES = ['openai', 'httpx', 'googleapiclient', 'google.oauth2', 'pdf2image', 'requests']
+
+REQUIRED_ENV_VARS = [
+    'ADMIN_USERNAME', 'ADMIN_PASSWORD', 'OPENAI_API_KEY',
+    'GMAIL_SENDER_EMAIL', 'APP_SETTINGS', 'GOOGLE_CREDENTIALS'
+]
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CHECK_SCRIPT = (
+    "import sys, json, app; "
+    f"print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))"
+)
+
+
+def child_env():
+    env = dict(os.environ)
+    for var in REQUIRED_ENV_VARS:
+        env.setdefault(var, '{}' if var in ('APP_SETTINGS', 'GOOGLE_CREDENTIALS') else 'placeholder')
+    # Keep the app's startup logging out of the measurement output
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    return env
+
+
+def time_import(env):
+    """Wall time of one fresh interpreter importing the app"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import app'], cwd=APP_DIR, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def interpreter_time(env):
+    """Wall time of a fresh interpreter doing nothing, subtracted from the import times"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], cwd=APP_DIR, env=env, check=True)
+    return time.perf_counter() - start
+
+
+def slowest_imports(env, top):
+    """(cumulative seconds, module) of the slowest top-level imports of app.py"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=APP_DIR, env=env,
+                            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Direct imports of app.py are indented by exactly three spaces
+        if name.startswith('   ') and not name.startswith('    '):
+            modules.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def loaded_lazy_modules(env):
+    result = subprocess.run([sys.executable, '-c', CHECK_SCRIPT], cwd=APP_DIR, env=env, check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET_SECONDS,
+                        help='Import time budget in seconds (STARTUP_BUDGET_SECONDS)')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to list')
+    args = parser.parse_args()
+
+    env = child_env()
+    baseline = min(interpreter_time(env) for _ in range(3))
+    times = [time_import(env) - baseline for _ in range(max(args.runs, 1))]
+    median = statistics.median(times)
+
+    print(f"Import time of app over {len(times)} runs: median {median:.3f}s, max {max(times):.3f}s "
+          f"(interpreter start {baseline:.3f}s excluded, budget {args.budget:.3f}s)")
+    print("\nSlowest imports:")
+    for seconds, name in slowest_imports(env, args.top):
+        print(f"  {seconds:8.3f}s  {name}")
+
+    failed = False
+    loaded = loaded_lazy_modules(env)
+    if loaded:
+        print(f"\nFAIL: loaded at import time: {', '.join(loaded)}")
+        failed = True
+    if median > args.budget:
+        print(f"\nFAIL: median import time {median:.3f}s is over the {args.budget:.3f}s budget")
+        failed = True
+    if not failed:
+        print("\nOK")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
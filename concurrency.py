@@ -0,0 +1,59 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Native threads for CPU-heavy work (PDF rendering, image encoding) when running under gevent
+CPU_THREADS = int(os.getenv('CPU_THREADS', 4))
+
+
+def gevent_active():
+    """True when the gevent worker has monkey-patched the standard library"""
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+_cpu_pool = None
+_cpu_pool_lock = threading.Lock()
+
+
+def get_cpu_pool():
+    """Pool of native threads; only used under gevent"""
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+            _cpu_pool = NativeThreadPoolExecutor(max_workers=CPU_THREADS)
+        return _cpu_pool
+
+
+def run_cpu_bound(func, *args, **kwargs):
+    """
+    Run CPU-heavy work without stalling other requests.
+
+    Under gevent every request shares one OS thread, so func runs on a
+    native thread while only the calling greenlet waits. Otherwise the
+    caller is already a real thread and func is called directly. func
+    must not start subprocesses: gevent's subprocess module only works
+    on the main thread.
+    """
+    if not gevent_active():
+        return func(*args, **kwargs)
+    return get_cpu_pool().submit(func, *args, **kwargs).result()
+
+
+def map_cpu_bound(func, items, max_workers):
+    """
+    Apply func to every item in parallel, for CPU-heavy work.
+
+    Args:
+        func (callable): Called once per item.
+        items (list): Items to process.
+        max_workers (int): Threads to use outside gevent.
+    Returns:
+        list: Results in the order of items.
+    """
+    if gevent_active():
+        return list(get_cpu_pool().map(func, items))
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        return list(pool.map(func, items))
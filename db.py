@@ -0,0 +1,50 @@
+import os
+import sqlite3
+import threading
+
+# Directory holding the SQLite databases used by the app
+DATA_DIR = os.getenv('DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+
+_local = threading.local()
+
+
+def get_db_path(name):
+    """Absolute path of a database file inside DATA_DIR"""
+    return os.path.join(DATA_DIR, name)
+
+
+def get_connection(path, schema=None):
+    """
+    Get this thread's connection to a SQLite database.
+
+    Connections are opened once per thread and path, in WAL mode so that
+    readers in other gunicorn workers are never blocked by a writer.
+
+    Args:
+        path (str): Path to the database file.
+        schema (str): SQL script creating the tables, run when the
+            connection is first opened.
+    Returns:
+        sqlite3.Connection: Connection in autocommit mode.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    # A forked worker must not reuse the parent's connections
+    pid = os.getpid()
+    if getattr(_local, 'pid', pid) != pid:
+        connections.clear()
+    _local.pid = pid
+
+    conn = connections.get(path)
+    if conn is None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        if schema:
+            conn.executescript(schema)
+        connections[path] = conn
+    return conn
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime
+from db import get_connection, get_db_path
+from settings import get_settings, get_additional_recipients
+from receipt_file import as_receipt_file
+
+logger = logging.getLogger(__name__)
+
+DIGEST_STORE_FILE = os.getenv('DIGEST_STORE_FILE', get_db_path('digest.db'))
+# Copies of the attachments waiting for a digest
+DIGEST_SPOOL_DIR = os.getenv('DIGEST_SPOOL_DIR', get_db_path('digest_spool'))
+# A recipient's digest is sent once its oldest receipt has waited this long
+DIGEST_INTERVAL_MINUTES = float(os.getenv('DIGEST_INTERVAL_MINUTES', 60))
+# ... or as soon as this many receipts or attachment bytes are waiting.
+# Base64 grows attachments by a third, so 18MB stays under Gmail's 25MB limit.
+DIGEST_MAX_RECEIPTS = int(os.getenv('DIGEST_MAX_RECEIPTS', 25))
+DIGEST_MAX_BYTES = int(os.getenv('DIGEST_MAX_BYTES', 18 * 1024 * 1024))
+# How often the background flusher looks for due digests
+DIGEST_CHECK_SECONDS = float(os.getenv('DIGEST_CHECK_SECONDS', 60))
+# Receipts claimed by a worker that died mid-send are released after this
+DIGEST_CLAIM_TIMEOUT = 600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digest_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    attachment_path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    file_size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    claimed_by TEXT,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_digest_items_recipient ON digest_items (recipient, claimed_by);
+"""
+
+_flusher = None
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def _conn():
+    return get_connection(DIGEST_STORE_FILE, SCHEMA)
+
+
+def queue_receipt(recipient, summary, attachment_path, filename):
+    """
+    Add a processed receipt to a recipient's next digest.
+
+    The attachment is copied into the spool, so the upload can be released
+    as usual. The digest is sent right away once the recipient has
+    DIGEST_MAX_RECEIPTS receipts or DIGEST_MAX_BYTES of attachments waiting.
+
+    Args:
+        recipient (str): Email address the digest goes to.
+        summary (dict): user_name, credit_card, expense_reason, analysis and drive_link.
+        attachment_path (str or ReceiptFile): File to attach.
+        filename (str): Attachment name shown in the email.
+    Returns:
+        int: Id of the queued item.
+    """
+    os.makedirs(DIGEST_SPOOL_DIR, exist_ok=True)
+    spool_path = os.path.join(DIGEST_SPOOL_DIR, f"{uuid.uuid4().hex}_{filename}")
+    as_receipt_file(attachment_path).save_as(spool_path)
+
+    cursor = _conn().execute(
+        'INSERT INTO digest_items (recipient, summary, attachment_path, filename, file_size, created_at) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        (recipient, json.dumps(summary), spool_path, filename, os.path.getsize(spool_path), time.time())
+    )
+    logger.info(f"Queued {filename} for the digest to {recipient}")
+    start_flusher()
+
+    count, size = _conn().execute(
+        'SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM digest_items '
+        'WHERE recipient = ? AND claimed_by IS NULL', (recipient,)
+    ).fetchone()
+    if count >= DIGEST_MAX_RECEIPTS or size >= DIGEST_MAX_BYTES:
+        logger.info(f"Digest threshold reached for {recipient} ({count} receipts, {size} bytes)")
+        flush_recipient(recipient)
+    return cursor.lastrowid
+
+
+def pending_digests():
+    """Receipts waiting per recipient, for the admin dashboard"""
+    rows = _conn().execute(
+        'SELECT recipient, COUNT(*) AS receipts, SUM(file_size) AS bytes, MIN(created_at) AS oldest '
+        'FROM digest_items GROUP BY recipient ORDER BY oldest'
+    ).fetchall()
+    digests = []
+    for row in rows:
+        entry = dict(row)
+        entry['oldest'] = datetime.fromtimestamp(entry['oldest']).strftime('%Y-%m-%d %H:%M')
+        entry['due'] = datetime.fromtimestamp(row['oldest'] + DIGEST_INTERVAL_MINUTES * 60).strftime('%Y-%m-%d %H:%M')
+        digests.append(entry)
+    return digests
+
+
+def due_recipients(now=None):
+    """Recipients whose oldest waiting receipt is older than the interval"""
+    cutoff = (now or time.time()) - DIGEST_INTERVAL_MINUTES * 60
+    rows = _conn().execute(
+        'SELECT recipient FROM digest_items WHERE claimed_by IS NULL '
+        'GROUP BY recipient HAVING MIN(created_at) <= ?', (cutoff,)
+    ).fetchall()
+    return [row['recipient'] for row in rows]
+
+
+def _claim(recipient):
+    """
+    Take the next batch of a recipient's receipts for sending.
+
+    A batch stays within DIGEST_MAX_RECEIPTS and DIGEST_MAX_BYTES (a single
+    larger file goes alone). Claims are made in one transaction, so two
+    workers never send the same receipt.
+    """
+    token = uuid.uuid4().hex
+    conn = _conn()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('UPDATE digest_items SET claimed_by = NULL, claimed_at = NULL WHERE claimed_at < ?',
+                     (time.time() - DIGEST_CLAIM_TIMEOUT,))
+        rows = conn.execute(
+            'SELECT * FROM digest_items WHERE recipient = ? AND claimed_by IS NULL ORDER BY id LIMIT ?',
+            (recipient, DIGEST_MAX_RECEIPTS)
+        ).fetchall()
+        batch, size = [], 0
+        for row in rows:
+            if batch and size + row['file_size'] > DIGEST_MAX_BYTES:
+                break
+            batch.append(dict(row))
+            size += row['file_size']
+        conn.executemany('UPDATE digest_items SET claimed_by = ?, claimed_at = ? WHERE id = ?',
+                         [(token, time.time(), item['id']) for item in batch])
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return batch
+
+
+def format_digest_body(items):
+    """Itemised plain-text body of a digest"""
+    lines = [f"{len(items)} invoice(s) have been processed and sent to BMO.", ""]
+    for number, item in enumerate(items, 1):
+        summary = json.loads(item['summary'])
+        analysis = summary.get('analysis') or {}
+        lines.append(f"{number}. {analysis.get('vendor', 'N/A')} - Invoice {analysis.get('invoice_number', 'N/A')} - "
+                     f"{analysis.get('amount', 'N/A')} ({analysis.get('date', 'N/A')})")
+        lines.append(f"   User: {summary.get('user_name', 'N/A')}")
+        lines.append(f"   Credit Card: {summary.get('credit_card', 'N/A')}")
+        lines.append(f"   Reason: {summary.get('expense_reason', 'N/A')}")
+        lines.append(f"   Attachment: {item['filename']}")
+        if summary.get('drive_link'):
+            lines.append(f"   Google Drive: {summary['drive_link']}")
+        lines.append("")
+    return '\n'.join(lines)
+
+
+def send_digest(recipient, items):
+    """
+    Send one digest email with every receipt attached.
+
+    Returns:
+        bool: True if Gmail accepted the message.
+    """
+    from gmail_service import get_gmail_service, create_message_stream, send_message_stream
+
+    sender_email = os.getenv('GMAIL_SENDER_EMAIL')
+    if not sender_email:
+        raise ValueError("GMAIL_SENDER_EMAIL environment variable not set")
+
+    subject = f"Expense Receipts Digest - {len(items)} receipt(s) - {datetime.now().strftime('%Y-%m-%d')}"
+    stream, size = create_message_stream(
+        sender_email,
+        recipient,
+        cc=', '.join(get_additional_recipients()),
+        subject=subject,
+        message_text=format_digest_body(items),
+        attachments=[(item['attachment_path'], item['filename']) for item in items]
+    )
+    result = send_message_stream(get_gmail_service(), 'me', stream, size)
+    return result is not None and 'id' in result
+
+
+def flush_recipient(recipient):
+    """
+    Send everything waiting for a recipient, in as many digests as needed.
+
+    Sent receipts are removed with their spooled attachments; a failed
+    batch is released and retried on the next flush.
+
+    Returns:
+        int: Number of receipts sent.
+    """
+    if not get_settings().get('emails_enabled', True):
+        logger.info(f"Email notifications are disabled - keeping the digest to {recipient} queued")
+        return 0
+
+    sent = 0
+    while True:
+        items = _claim(recipient)
+        if not items:
+            return sent
+        ids = [(item['id'],) for item in items]
+        try:
+            success = send_digest(recipient, items)
+        except Exception as e:
+            logger.error(f"Error sending digest to {recipient}: {str(e)}")
+            success = False
+        if not success:
+            _conn().executemany('UPDATE digest_items SET claimed_by = NULL, claimed_at = NULL WHERE id = ?', ids)
+            logger.error(f"Digest to {recipient} failed; {len(items)} receipts stay queued")
+            return sent
+
+        _conn().executemany('DELETE FROM digest_items WHERE id = ?', ids)
+        for item in items:
+            try:
+                os.remove(item['attachment_path'])
+            except OSError as e:
+                logger.error(f"Error removing spooled file {item['attachment_path']}: {str(e)}")
+        sent += len(items)
+        logger.info(f"Sent digest of {len(items)} receipts to {recipient}")
+
+
+def flush_due():
+    """Send the digests whose interval has elapsed"""
+    for recipient in due_recipients():
+        flush_recipient(recipient)
+
+
+def flush_all():
+    """Send every pending digest now, e.g. from the admin dashboard"""
+    recipients = [row['recipient'] for row in
+                  _conn().execute('SELECT DISTINCT recipient FROM digest_items').fetchall()]
+    return sum(flush_recipient(recipient) for recipient in recipients)
+
+
+def _flush_loop():
+    while True:
+        time.sleep(DIGEST_CHECK_SECONDS)
+        try:
+            flush_due()
+        except Exception as e:
+            logger.error(f"Error flushing digests: {str(e)}")
+
+
+def start_flusher():
+    """Start the background thread sending due digests, once per process"""
+    global _flusher, _flusher_pid
+    with _flusher_lock:
+        if _flusher is not None and _flusher.is_alive() and _flusher_pid == os.getpid():
+            return
+        _flusher = threading.Thread(target=_flush_loop, name='digest-flusher', daemon=True)
+        _flusher.start()
+        _flusher_pid = os.getpid()
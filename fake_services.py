@@ -0,0 +1,373 @@
+"""
+Local stand-ins for the external services the app calls.
+
+One HTTP server answers for the OpenAI chat completions API, the Google
+OAuth token endpoint, Gmail messages.send, Drive files.create and the
+Zapier webhook, so /upload can be load-tested without spending money or
+sending mail. Each service has its own latency and error rate.
+
+Point the app at it with:
+    OPENAI_BASE_URL      <url>/v1
+    GOOGLE_API_ENDPOINT  <url>/
+    ZAPIER_WEBHOOK_URL   <url>/zapier
+    GOOGLE_CREDENTIALS   service_account_info(<url>/token)
+
+Usage:
+    python fake_services.py [--port 9100] [--openai-latency 2.0] [--error-rate 0.05]
+"""
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+SERVICES = ('openai', 'token', 'gmail', 'drive', 'zapier')
+
+# Seconds a call takes by default, roughly what the real services take
+DEFAULT_LATENCY = {'openai': 2.0, 'token': 0.05, 'gmail': 0.4, 'drive': 0.5, 'zapier': 0.2}
+
+# Returned by every chat completion; passes model_routing.check_result
+ANALYSIS_REPLY = {
+    "invoice_number": "INV-10042",
+    "date": "2024-03-14",
+    "amount": "128.40",
+    "customer_name": "N/A",
+    "vendor": "Bench Supplies Ltd",
+    "credit_card": "4242",
+    "description_of_items_or_services": "Printer paper, toner cartridge",
+    "billing_address": "1 Test Street, Springfield",
+    "payment_method": "Visa"
+}
+
+# Number of SSE chunks a streamed completion is split into
+STREAM_CHUNKS = 10
+
+
+class Behaviour:
+    """Latency and failures of one fake service"""
+
+    def __init__(self, latency=0.0, jitter=0.2, error_rate=0.0, error_status=500):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+    def delay(self):
+        """Seconds to wait before answering, latency +/- jitter"""
+        return max(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter), 0.0)
+
+    def fails(self):
+        return random.random() < self.error_rate
+
+
+class FakeServicesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Path patterns -> (service, handler method name)
+    ROUTES = (
+        ('POST', r'/v1/chat/completions', 'openai', 'chat_completion'),
+        ('POST', r'/token', 'token', 'token'),
+        ('GET', r'/gmail/v1/users/[^/]+/profile', 'gmail', 'gmail_profile'),
+        ('POST', r'(/upload)?/gmail/v1/users/[^/]+/messages/send', 'gmail', 'gmail_send'),
+        ('POST', r'(/upload)?/drive/v3/files', 'drive', 'drive_create'),
+        ('PUT', r'/upload/session/[0-9a-f]+', None, 'resumable_chunk'),
+        ('POST', r'/zapier', 'zapier', 'zapier'),
+    )
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_PUT(self):
+        self.route('PUT')
+
+    def route(self, method):
+        body = self.read_body()
+        path = urlparse(self.path).path
+        for route_method, pattern, service, handler in self.ROUTES:
+            if route_method == method and re.fullmatch(pattern, path):
+                break
+        else:
+            self.send_json(404, {'error': {'message': f'No fake for {method} {path}'}})
+            return
+
+        if service is None:
+            # Chunks of a resumable upload belong to the service that opened the session
+            session = self.server.sessions.get(path)
+            service = session['service'] if session else 'drive'
+        behaviour = self.server.behaviours[service]
+        time.sleep(behaviour.delay())
+        if behaviour.fails():
+            self.server.count(service, 'errors')
+            self.send_json(behaviour.error_status, {'error': {
+                'code': behaviour.error_status, 'message': f'Injected {service} failure'}})
+            return
+        self.server.count(service, 'calls', len(body))
+        getattr(self, handler)(body)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(parts)
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send_json(self, status, data, headers=None):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def chat_completion(self, body):
+        request = json.loads(body or b'{}')
+        model = request.get('model', 'gpt-4o-mini')
+        content = json.dumps(ANALYSIS_REPLY)
+        # Roughly what the real API would bill for the prompt and the reply
+        usage = {'prompt_tokens': len(body) // 4, 'completion_tokens': len(content) // 4}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        completion_id = f'chatcmpl-{uuid.uuid4().hex[:24]}'
+        if not request.get('stream'):
+            self.send_json(200, {
+                'id': completion_id, 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': content}}],
+                'usage': usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        step = -(-len(content) // STREAM_CHUNKS)
+        for start in range(0, len(content), step):
+            self.write_event(completion_id, model, [{
+                'index': 0, 'finish_reason': None, 'delta': {'content': content[start:start + step]}}])
+        self.write_event(completion_id, model, [{'index': 0, 'finish_reason': 'stop', 'delta': {}}])
+        if (request.get('stream_options') or {}).get('include_usage'):
+            self.write_event(completion_id, model, [], usage=usage)
+        self.write_chunk(b'data: [DONE]\n\n')
+        self.write_chunk(b'')
+
+    def write_event(self, completion_id, model, choices, **extra):
+        event = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                 'model': model, 'choices': choices, **extra}
+        self.write_chunk(f'data: {json.dumps(event)}\n\n'.encode())
+
+    def write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def token(self, body):
+        self.send_json(200, {'access_token': f'fake-{uuid.uuid4().hex}', 'expires_in': 3600,
+                             'token_type': 'Bearer'})
+
+    def gmail_profile(self, body):
+        self.send_json(200, {'emailAddress': 'bench@example.com', 'messagesTotal': 0})
+
+    def gmail_send(self, body):
+        if self.start_resumable('gmail'):
+            return
+        self.send_json(200, {'id': uuid.uuid4().hex[:16], 'threadId': uuid.uuid4().hex[:16],
+                             'labelIds': ['SENT']})
+
+    def drive_create(self, body):
+        if self.start_resumable('drive'):
+            return
+        self.send_json(200, {'id': uuid.uuid4().hex})
+
+    def zapier(self, body):
+        self.send_json(200, {'status': 'success', 'id': uuid.uuid4().hex})
+
+    def start_resumable(self, service):
+        """Open a resumable upload session if the client asked for one"""
+        if 'uploadType=resumable' not in self.path:
+            return False
+        path = f'/upload/session/{uuid.uuid4().hex}'
+        with self.server.lock:
+            self.server.sessions[path] = {'service': service}
+        host = self.headers.get('Host', f'127.0.0.1:{self.server.server_port}')
+        self.send_response(200)
+        self.send_header('Location', f'http://{host}{path}')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return True
+
+    def resumable_chunk(self, body):
+        path = urlparse(self.path).path
+        # Content-Range: bytes <first>-<last>/<total>, or bytes */<total> for a status query
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', self.headers.get('Content-Range', ''))
+        if match and match.group(3) != '*' and int(match.group(2)) + 1 < int(match.group(3)):
+            self.send_response(308)
+            self.send_header('Range', f'bytes=0-{match.group(2)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        with self.server.lock:
+            session = self.server.sessions.pop(path, {'service': 'drive'})
+        if session['service'] == 'gmail':
+            self.send_json(200, {'id': uuid.uuid4().hex[:16], 'threadId': uuid.uuid4().hex[:16]})
+        else:
+            self.send_json(200, {'id': uuid.uuid4().hex})
+
+
+class FakeServices(ThreadingHTTPServer):
+    """
+    The fake services on one port, served from background threads.
+
+    Usage:
+        with FakeServices(behaviours={'openai': Behaviour(latency=1.5)}) as fakes:
+            os.environ['OPENAI_BASE_URL'] = fakes.openai_base_url
+            ...
+    """
+    daemon_threads = True
+    # Many clients connect at once under load
+    request_queue_size = 256
+
+    def __init__(self, host='127.0.0.1', port=0, behaviours=None):
+        super().__init__((host, port), FakeServicesHandler)
+        self.behaviours = {name: Behaviour(latency=DEFAULT_LATENCY[name]) for name in SERVICES}
+        self.behaviours.update(behaviours or {})
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.stats = {name: {'calls': 0, 'errors': 0, 'bytes': 0} for name in SERVICES}
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_port}'
+
+    @property
+    def openai_base_url(self):
+        return f'{self.url}/v1'
+
+    @property
+    def google_api_endpoint(self):
+        return f'{self.url}/'
+
+    @property
+    def token_uri(self):
+        return f'{self.url}/token'
+
+    @property
+    def zapier_url(self):
+        return f'{self.url}/zapier'
+
+    def handle_error(self, request, client_address):
+        # Clients drop their keep-alive connections when the app stops
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def count(self, service, field, size=0):
+        with self.lock:
+            self.stats[service][field] += 1
+            self.stats[service]['bytes'] += size
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-services', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def service_account_info(token_uri, email='bench@bench-project.iam.gserviceaccount.com'):
+    """
+    Service account credentials with a throwaway key, for GOOGLE_CREDENTIALS.
+
+    google-auth signs its token requests with the key, so it must be a real
+    RSA key; the fake token endpoint accepts any signature.
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption()).decode()
+    return {
+        'type': 'service_account',
+        'project_id': 'bench-project',
+        'private_key_id': uuid.uuid4().hex,
+        'private_key': pem,
+        'client_email': email,
+        'client_id': '1',
+        'token_uri': token_uri,
+    }
+
+
+def add_arguments(parser):
+    """Latency and error options shared with benchmark_load.py"""
+    for name in SERVICES:
+        parser.add_argument(f'--{name}-latency', type=float, default=DEFAULT_LATENCY[name],
+                            help=f'Seconds a {name} call takes (default {DEFAULT_LATENCY[name]})')
+        parser.add_argument(f'--{name}-error-rate', type=float, default=None,
+                            help=f'Share of {name} calls that fail (default --error-rate)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of calls to every service that fail')
+    parser.add_argument('--error-status', type=int, default=500, help='HTTP status of injected failures')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Latency varies by +/- this share')
+
+
+def behaviours_from_args(args):
+    behaviours = {}
+    for name in SERVICES:
+        error_rate = getattr(args, f'{name}_error_rate')
+        behaviours[name] = Behaviour(latency=getattr(args, f'{name}_latency'), jitter=args.jitter,
+                                     error_rate=args.error_rate if error_rate is None else error_rate,
+                                     error_status=args.error_status)
+    return behaviours
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeServices(args.host, args.port, behaviours_from_args(args))
+    print(f"Fake services on {server.url}")
+    print(f"  OPENAI_BASE_URL={server.openai_base_url}")
+    print(f"  GOOGLE_API_ENDPOINT={server.google_api_endpoint}")
+    print(f"  ZAPIER_WEBHOOK_URL={server.zapier_url}")
+    print(f"  GOOGLE_CREDENTIALS='{json.dumps(service_account_info(server.token_uri))}'")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
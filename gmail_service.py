@@ -1,41 +1,35 @@
 from dotenv import load_dotenv
-from googleapiclient.discovery import build
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
-from email import encoders
+from email.generator import BytesGenerator
+import tempfile
 import base64
+import uuid
 import os
+import io
 import logging
 from datetime import datetime
-from authorize import get_credentials
+from authorize import get_credentials, get_service
+from resilience import call as call_api, get_status_code, CircuitOpenError, RateLimitTimeout
+from receipt_file import as_receipt_file
+import metrics
 
-# Configure logging
-log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
-# Create logs directory if it doesn't exist
-os.makedirs('logs', exist_ok=True)
-
-# File handler for all logs
-file_handler = logging.FileHandler('logs/all_processes.log')
-file_handler.setFormatter(log_formatter)
-
-# File handler for email-specific logs
-email_handler = logging.FileHandler('logs/email.log')
-email_handler.setFormatter(log_formatter)
-email_handler.addFilter(lambda record: 'email' in record.getMessage().lower())
-
-# Console handler
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(log_formatter)
-
-# Configure root logger
-logging.basicConfig(
-    level=logging.INFO,
-    handlers=[file_handler, email_handler, console_handler]
-)
 logger = logging.getLogger(__name__)
 
+# Streaming send settings
+# Messages are built in memory up to this size, then spill to a temp file
+MESSAGE_SPOOL_MAX_MEMORY = int(os.getenv('GMAIL_SPOOL_MAX_MEMORY', 1024 * 1024))
+# Attachment bytes read per step; a multiple of 57 so base64 lines stay 76 characters
+ATTACHMENT_READ_SIZE = 57 * 16 * 1024
+# Messages above this size are sent with a resumable upload in chunks of this size
+RESUMABLE_SEND_CHUNK_SIZE = int(os.getenv('GMAIL_RESUMABLE_CHUNK_SIZE', 4 * 1024 * 1024))
+
 # Gmail API service setup
 SCOPES = [
     'https://www.googleapis.com/auth/gmail.send',
@@ -45,128 +39,162 @@ SCOPES = [
 ]
 
 def get_gmail_service():
-    """Gets Gmail API service instance."""
+    """Gets the cached Gmail API service instance for this thread."""
     try:
-        logger.info("Getting Gmail service...")
-        
-        # Get credentials from authorize.py (this will handle service account and delegation)
-        credentials = get_credentials()
-        
-        # Build the Gmail service
-        service = build('gmail', 'v1', credentials=credentials)
-        
-        # Test the service by getting the user profile
-        user_profile = service.users().getProfile(userId='me').execute()
-        logger.info(f"Gmail service initialized successfully for {user_profile.get('emailAddress')}")
-        
-        return service
-        
+        return get_service('gmail', 'v1')
     except Exception as e:
         logger.error(f"Error getting Gmail service: {str(e)}")
         raise
 
-def create_message_with_attachment(sender, to, cc, subject, message_text, file_path=None):
-    """Create an email with optional attachment."""
-    try:
-        logger.info(f"Creating email - From: {sender}, To: {to}, CC: {cc}, Subject: {subject}")
-        
-        # Create message container
-        message = MIMEMultipart()
-        message['to'] = to
-        message['cc'] = cc
-        message['from'] = sender
-        message['subject'] = subject
-        
-        # Add body
-        message.attach(MIMEText(message_text))
-        logger.info("Email body attached")
-        
-        # Add attachment if provided
-        if file_path:
-            logger.info(f"Attempting to attach file: {file_path}")
-            if not os.path.isfile(file_path):
-                error_msg = f"Attachment file not found: {file_path}"
-                logger.error(error_msg)
-                raise FileNotFoundError(error_msg)
-            
-            # Determine MIME type based on file extension
-            file_ext = os.path.splitext(file_path)[1].lower()
-            mime_type = 'application/pdf' if file_ext == '.pdf' else 'image/jpeg' if file_ext in ['.jpg', '.jpeg'] else 'image/png' if file_ext == '.png' else 'application/octet-stream'
-            
-            with open(file_path, 'rb') as attachment:
-                part = MIMEBase(*mime_type.split('/'))
-                part.set_payload(attachment.read())
-                logger.info(f"File read successfully: {os.path.getsize(file_path)} bytes")
-            
-            # Encode the attachment
-            encoders.encode_base64(part)
-            
-            # Add header
-            filename = os.path.basename(file_path)
-            part.add_header(
-                'Content-Disposition',
-                f'attachment; filename= {filename}'
-            )
-            part.add_header('Content-Type', mime_type)
-            
-            # Attach the file
-            message.attach(part)
-            logger.info(f"File {filename} attached successfully as {mime_type}")
-        
-        # Convert to dict
-        raw_message = message.as_bytes()
-        raw_size = len(raw_message)
-        logger.info(f"Raw message size before encoding: {raw_size} bytes")
-        
-        if raw_size > 25 * 1024 * 1024:  # 25MB is Gmail's limit
-            logger.warning(f"Warning: Email size ({raw_size} bytes) is approaching Gmail's 25MB limit")
-        
-        raw = {
-            'raw': base64.urlsafe_b64encode(raw_message).decode()
-        }
-        logger.info(f"Email created successfully for {to}")
-        return raw
-        
-    except Exception as e:
-        error_msg = f"Error creating email: {str(e)}"
-        logger.error(error_msg)
-        raise
+def check_gmail_service():
+    """
+    Verify the cached Gmail client can reach the API.
+
+    Returns:
+        dict: Sender address and credential state.
+    """
+    service = get_gmail_service()
+    credentials = get_credentials()
+    user_profile = service.users().getProfile(userId='me').execute()
+    logger.info(f"Gmail service verified for {user_profile.get('emailAddress')}")
+    return {
+        'email': user_profile.get('emailAddress'),
+        'token_valid': credentials.valid,
+        'token_expiry': credentials.expiry.isoformat() if credentials.expiry else None
+    }
+
+def log_send_error(e):
+    """Log a failed send with a hint for the common causes"""
+    error_msg = f"An error occurred while sending the email: {str(e)}"
+    logger.error(error_msg)
+    logger.error(f"Full error details: {repr(e)}")
+
+    # Check for specific error types and provide more helpful messages
+    error_str = str(e).lower()
+    status = get_status_code(e)
+    if isinstance(e, CircuitOpenError):
+        logger.error("Gmail API is failing repeatedly; sends are paused. Please try again later.")
+    elif isinstance(e, RateLimitTimeout) or status == 429:
+        logger.error("Gmail API rate limit reached. Please try again later.")
+    elif status == 401 or 'unauthorized' in error_str:
+        logger.error("Authorization error. Please reauthorize at /authorize_gmail")
+    elif status == 403 and 'quota' in error_str:
+        logger.error("Gmail API quota exceeded. Please try again later.")
+    elif 'invalid' in error_str and 'recipient' in error_str:
+        logger.error("Invalid recipient email address")
+
+def get_peak_rss_mb():
+    """Peak resident memory of this process in MB, or None where unsupported"""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def get_attachment_mime_type(file_path):
+    """MIME type of an attachment based on its extension"""
+    file_ext = os.path.splitext(file_path)[1].lower()
+    return 'application/pdf' if file_ext == '.pdf' else 'image/jpeg' if file_ext in ['.jpg', '.jpeg'] else 'image/png' if file_ext == '.png' else 'application/octet-stream'
 
-def send_message(service, user_id, message):
-    """Send an email message.
+def create_message_stream(sender, to, cc, subject, message_text, file_path=None, attachments=None):
+    """
+    Build an email with optional attachments as a stream.
+
+    The headers and body are generated by the email package around
+    placeholders, and each attachment is base64-encoded into the stream a
+    chunk at a time, so no file is ever held in memory as a whole.
+
+    Args:
+        file_path: Single file (path or ReceiptFile) to attach.
+        attachments: List of (path or ReceiptFile, filename) tuples to attach instead.
+
+    Returns:
+        tuple: (file object positioned at the start, size in bytes)
+    """
+    logger.info(f"Creating email - From: {sender}, To: {to}, CC: {cc}, Subject: {subject}")
+
+    if attachments is None:
+        attachments = [(file_path, as_receipt_file(file_path).name)] if file_path else []
+
+    message = MIMEMultipart()
+    message['to'] = to
+    message['cc'] = cc
+    message['from'] = sender
+    message['subject'] = subject
+    message.attach(MIMEText(message_text))
+
+    placeholders = []
+    for path, filename in attachments:
+        receipt = as_receipt_file(path)
+        if not receipt.in_memory and not os.path.isfile(receipt.path):
+            error_msg = f"Attachment file not found: {receipt.path}"
+            logger.error(error_msg)
+            raise FileNotFoundError(error_msg)
+
+        mime_type = get_attachment_mime_type(filename)
+        placeholder = f"ATTACHMENT-{uuid.uuid4().hex}"
+        part = MIMEBase(*mime_type.split('/'))
+        part.set_payload(placeholder)
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header('Content-Disposition', f'attachment; filename= {filename}')
+        message.attach(part)
+        placeholders.append((placeholder, receipt, filename, mime_type))
+
+    skeleton = io.BytesIO()
+    BytesGenerator(skeleton, mangle_from_=False).flatten(message)
+    tail = skeleton.getvalue()
+
+    stream = tempfile.SpooledTemporaryFile(max_size=MESSAGE_SPOOL_MAX_MEMORY)
+    for placeholder, receipt, filename, mime_type in placeholders:
+        head, tail = tail.split(placeholder.encode(), 1)
+        stream.write(head)
+        with receipt.open() as attachment:
+            while True:
+                chunk = attachment.read(ATTACHMENT_READ_SIZE)
+                if not chunk:
+                    break
+                stream.write(base64.encodebytes(chunk))
+        # The placeholder was followed by a line break that encodebytes already wrote
+        if tail.startswith(b'\n'):
+            tail = tail[1:]
+        logger.info(f"File {filename} attached as {mime_type}")
+    stream.write(tail)
+
+    size = stream.tell()
+    stream.seek(0)
+    logger.info(f"Email message size: {size} bytes")
+    if size > 25 * 1024 * 1024:  # 25MB is Gmail's limit
+        logger.warning(f"Warning: Email size ({size} bytes) is approaching Gmail's 25MB limit")
+    return stream, size
+
+def send_message_stream(service, user_id, stream, size):
+    """
+    Send a message built by create_message_stream with a media upload.
 
     Args:
         service: Authorized Gmail API service instance.
         user_id: User's email address. The special value "me" can be used to indicate the authenticated user.
-        message: Message to be sent.
+        stream: File object holding the RFC 822 message.
+        size: Size of the message in bytes.
 
     Returns:
         Sent Message.
     """
+    # Imported on first use; googleapiclient is slow to import
+    from googleapiclient.http import MediaIoBaseUpload
     try:
-        logger.info("=== Starting Email Send Process ===")
-        logger.info(f"User ID: {user_id}")
         logger.info("Attempting to send email message...")
-        
-        # Log service details
-        logger.info(f"Service type: {type(service)}")
-        
-        message = service.users().messages().send(userId=user_id, body=message).execute()
+        # Small messages go in one request; larger ones are uploaded in chunks
+        resumable = size > RESUMABLE_SEND_CHUNK_SIZE
+        metrics.observe('payload_bytes', size, kind='email')
+        media = MediaIoBaseUpload(stream, mimetype='message/rfc822',
+                                  chunksize=RESUMABLE_SEND_CHUNK_SIZE, resumable=resumable)
+        request = service.users().messages().send(userId=user_id, body={}, media_body=media)
+        message = call_api('gmail', request.execute)
         logger.info(f'Message Id: {message["id"]} sent successfully')
-        logger.info("=== Email Send Process Completed ===")
+        logger.info(f"Peak RSS of worker {os.getpid()}: {get_peak_rss_mb()} MB")
         return message
     except Exception as e:
-        error_msg = f"An error occurred while sending the email: {str(e)}"
-        logger.error(error_msg)
-        logger.error(f"Full error details: {repr(e)}")
-        
-        # Check for specific error types and provide more helpful messages
-        error_str = str(e).lower()
-        if 'unauthorized' in error_str:
-            logger.error("Authorization error. Please reauthorize at /authorize_gmail")
-        elif 'quota' in error_str:
-            logger.error("Gmail API quota exceeded. Please try again later.")
-        elif 'invalid' in error_str and 'recipient' in error_str:
-            logger.error("Invalid recipient email address")
-        
+        log_send_error(e)
         return None
+    finally:
+        stream.close()
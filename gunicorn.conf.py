@@ -0,0 +1,65 @@
+"""
+Gunicorn settings that are not on the Procfile command line.
+
+Gunicorn reads this file from the working directory automatically; options
+given on the command line take precedence.
+
+Worker modes (GUNICORN_WORKER_CLASS):
+
+gthread (default)
+    Each worker serves GUNICORN_THREADS requests at once with OS threads.
+    Receipts are processed by JOB_WORKERS (4) background threads per
+    worker, so concurrency grows with memory as workers are added.
+
+gevent
+    Every request and receipt job is a greenlet. The OpenAI client
+    (httpx), the Google API clients (httplib2), the Zapier webhook
+    (requests), pdftoppm/pdftotext subprocesses, sleeps and locks all
+    yield while they wait, so one worker keeps dozens of receipts in
+    flight. Decoding rendered PDF pages and encoding images are
+    CPU-bound and run on CPU_THREADS (4) native threads
+    (concurrency.run_cpu_bound) so they never stall the loop. JOB_WORKERS
+    defaults to 64 and STAGE_WORKERS to 128; the API rate limiters in
+    resilience.py still bound the calls made:
+
+        GUNICORN_WORKER_CLASS=gevent GUNICORN_WORKER_CONNECTIONS=200
+
+    The standard library is monkey-patched below, before the app is
+    imported, so this also works with GUNICORN_PRELOAD.
+
+Several workers (WEB_CONCURRENCY) can serve the same jobs: job state is
+kept in DATA_DIR/jobs.db, so /jobs/<id> and its event stream work from
+any worker, and the API rate limits in DATA_DIR/rate_limits.db apply to
+all workers together. All workers must share DATA_DIR, i.e. run on one
+host.
+Under gevent one worker per core is enough.
+"""
+import os
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+# Concurrent requests per worker: threads for gthread, greenlets for gevent
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 200))
+
+if worker_class == 'gevent':
+    # Locks and threads created at import time must already be cooperative
+    from gevent import monkey
+    monkey.patch_all()
+
+# Import the app once in the master and fork every worker from it, so a new
+# worker (scale-up, or a restart after --timeout) starts without importing
+# anything. Code changes then need a full restart instead of a HUP.
+preload_app = os.getenv('GUNICORN_PRELOAD', 'false').lower() == 'true'
+
+
+def when_ready(server):
+    """Runs in the master before the first worker is forked"""
+    if preload_app:
+        from app import warm_up
+        warm_up()
+
+
+def post_worker_init(worker):
+    """Runs in each worker once the app is loaded, before it accepts requests"""
+    from app import start_background_threads
+    start_background_threads()
@@ -0,0 +1,359 @@
+import io
+import os
+import base64
+import logging
+import tempfile
+import subprocess
+from PIL import Image, ImageOps, ImageStat
+from receipt_file import as_receipt_file
+from concurrency import run_cpu_bound, map_cpu_bound
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Set poppler path based on environment
+if os.name == 'nt':  # Windows
+    POPPLER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'poppler', 'poppler-24.08.0', 'Library', 'bin')
+else:  # Linux
+    POPPLER_PATH = '/usr/bin'  # Default location for poppler-utils on Linux
+
+# PDF rendering settings
+PDF_RENDER_DPI = int(os.getenv('PDF_RENDER_DPI', 200))
+PDF_RENDER_GRAYSCALE = os.getenv('PDF_RENDER_GRAYSCALE', 'false').lower() == 'true'
+JPEG_QUALITY = int(os.getenv('JPEG_QUALITY', 75))
+# Multi-page PDFs: number of pages sent for analysis and pdftoppm processes used to render them
+PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', 5))
+PDF_RENDER_THREADS = int(os.getenv('PDF_RENDER_THREADS', 4))
+PDFTOPPM_TIMEOUT = 120
+
+# Preprocessing applied before images are sent to the vision model
+IMAGE_PREPROCESS_ENABLED = os.getenv('IMAGE_PREPROCESS_ENABLED', 'true').lower() == 'true'
+# Longest side in pixels; the API rescales anything larger than 2048 anyway
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', 2048))
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', 80))
+# 'auto' converts images with almost no colour to greyscale, 'true'/'false' force it
+IMAGE_GRAYSCALE = os.getenv('IMAGE_GRAYSCALE', 'auto').lower()
+# Mean saturation (0-255) below which an image counts as colourless
+IMAGE_GRAYSCALE_SATURATION = int(os.getenv('IMAGE_GRAYSCALE_SATURATION', 20))
+# Vision detail level: 'high', 'low' or 'auto'. Images that fit in 512x512 always use 'low'.
+IMAGE_DETAIL = os.getenv('IMAGE_DETAIL', 'high').lower()
+
+
+def encode_image(image_path):
+    """
+    Encode an image file to base64 string.
+
+    Args:
+        image_path (str): Path to the image file.
+    Returns:
+        str: Base64 encoded string of the image.
+    """
+    with open(image_path, "rb") as image_file:
+        return encode_image_bytes(image_file.read())
+
+
+def encode_image_bytes(image_bytes):
+    """
+    Encode in-memory image data to base64 string.
+
+    Args:
+        image_bytes (bytes): Encoded image data.
+    Returns:
+        str: Base64 encoded string of the image.
+    """
+    return base64.b64encode(image_bytes).decode("utf-8")
+
+
+def image_to_jpeg_bytes(image, quality=JPEG_QUALITY):
+    """
+    Encode a PIL image as JPEG into an in-memory buffer.
+
+    Args:
+        image (PIL.Image.Image): Image to encode.
+        quality (int): JPEG quality (1-95).
+    Returns:
+        bytes: JPEG data.
+    """
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def get_pdf_page_count(pdf_path):
+    """Number of pages in a PDF (path or bytes) according to pdfinfo"""
+    from pdf2image import pdfinfo_from_path, pdfinfo_from_bytes
+    if isinstance(pdf_path, bytes):
+        return int(pdfinfo_from_bytes(pdf_path, poppler_path=POPPLER_PATH)['Pages'])
+    return int(pdfinfo_from_path(pdf_path, poppler_path=POPPLER_PATH)['Pages'])
+
+
+def split_page_range(last_page, parts):
+    """Pages 1..last_page as up to parts contiguous (first, last) ranges"""
+    parts = max(1, min(parts, last_page))
+    size, extra = divmod(last_page, parts)
+    ranges = []
+    first = 1
+    for index in range(parts):
+        count = size + (1 if index < extra else 0)
+        ranges.append((first, first + count - 1))
+        first += count
+    return ranges
+
+
+def run_pdftoppm(pdf_path, page_ranges, dpi, grayscale):
+    """
+    Render page ranges with one pdftoppm process each, all running at once.
+
+    Called from the requesting thread or greenlet: under gevent the
+    subprocess module is cooperative there, but not on native threads.
+
+    Returns:
+        list: PPM (PGM when grayscale) output of each range, in order.
+    """
+    command = [os.path.join(POPPLER_PATH, 'pdftoppm'), '-r', str(dpi)] + (['-gray'] if grayscale else [])
+    processes = []
+    try:
+        for first, last in page_ranges:
+            processes.append(subprocess.Popen(command + ['-f', str(first), '-l', str(last), pdf_path],
+                                              stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+        outputs = []
+        for process in processes:
+            data, error = process.communicate(timeout=PDFTOPPM_TIMEOUT)
+            if process.returncode != 0:
+                raise RuntimeError(f"pdftoppm exited with {process.returncode}: "
+                                   f"{error.decode('utf-8', 'replace').strip()}")
+            outputs.append(data)
+        return outputs
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+
+def decode_pages(data, grayscale=False):
+    """PIL images from pdftoppm output, fully decoded (CPU-bound)"""
+    from pdf2image.parsers import parse_buffer_to_ppm, parse_buffer_to_pgm
+    images = parse_buffer_to_pgm(data) if grayscale else parse_buffer_to_ppm(data)
+    for image in images:
+        image.load()
+    return images
+
+
+def render_pdf_pages(pdf_path, max_pages=PDF_MAX_PAGES, dpi=PDF_RENDER_DPI, grayscale=PDF_RENDER_GRAYSCALE):
+    """
+    Render the first pages of a PDF in memory.
+
+    The page range is split across several pdftoppm processes that run in
+    parallel, and pages are read from their pipes. The processes are
+    started by the caller; only decoding the pages goes to
+    run_cpu_bound's native threads, so it never stalls the gevent loop.
+
+    Args:
+        pdf_path (str or bytes): Path to PDF file, or its content
+        max_pages (int): Maximum number of pages to render
+        dpi (int): Rendering resolution
+        grayscale (bool): Render in greyscale instead of colour
+    Returns:
+        list: PIL images of the rendered pages, in page order
+    """
+    try:
+        # A single page needs no pdfinfo call
+        max_pages = max(max_pages, 1)
+        last_page = 1 if max_pages == 1 else min(get_pdf_page_count(pdf_path), max_pages)
+        source = f"{len(pdf_path)} bytes" if isinstance(pdf_path, bytes) else pdf_path
+        logger.info(f"Converting PDF: {source} (pages=1-{last_page}, dpi={dpi}, grayscale={grayscale})")
+
+        page_ranges = split_page_range(last_page, PDF_RENDER_THREADS)
+        with metrics.timer('operation_seconds', operation='pdf_render'):
+            if isinstance(pdf_path, bytes):
+                # Every pdftoppm process reads the same copy
+                fd, temp_path = tempfile.mkstemp(prefix='render-', suffix='.pdf')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(pdf_path)
+                    outputs = run_pdftoppm(temp_path, page_ranges, dpi, grayscale)
+                finally:
+                    os.remove(temp_path)
+            else:
+                outputs = run_pdftoppm(pdf_path, page_ranges, dpi, grayscale)
+            if len(outputs) == 1:
+                decoded = [run_cpu_bound(decode_pages, outputs[0], grayscale)]
+            else:
+                decoded = map_cpu_bound(lambda data: decode_pages(data, grayscale), outputs, len(outputs))
+            return [image for images in decoded for image in images]
+    except Exception as e:
+        logger.error(f"Error converting PDF: {str(e)}")
+        raise
+
+
+def _map_pages(func, images):
+    """Apply func to every page, in parallel when there are several"""
+    if len(images) <= 1:
+        return [run_cpu_bound(func, image) for image in images]
+    return map_cpu_bound(func, images, min(PDF_RENDER_THREADS, len(images)))
+
+
+def convert_pdf_to_images(pdf_path, max_pages=PDF_MAX_PAGES, dpi=PDF_RENDER_DPI,
+                          grayscale=PDF_RENDER_GRAYSCALE, quality=JPEG_QUALITY):
+    """
+    Render the first pages of a PDF to JPEG in memory.
+
+    Args:
+        pdf_path (str): Path to PDF file
+        max_pages (int): Maximum number of pages to render
+        dpi (int): Rendering resolution
+        grayscale (bool): Render in greyscale instead of colour
+        quality (int): JPEG quality (1-95)
+    Returns:
+        list: JPEG data (bytes) of each rendered page, in page order
+    """
+    images = render_pdf_pages(pdf_path, max_pages=max_pages, dpi=dpi, grayscale=grayscale)
+    return _map_pages(lambda image: image_to_jpeg_bytes(image, quality), images)
+
+
+def convert_pdf_to_image(pdf_path, dpi=PDF_RENDER_DPI, grayscale=PDF_RENDER_GRAYSCALE, quality=JPEG_QUALITY):
+    """
+    Render the first page of a PDF to JPEG in memory.
+
+    Args:
+        pdf_path (str): Path to PDF file
+        dpi (int): Rendering resolution
+        grayscale (bool): Render in greyscale instead of colour
+        quality (int): JPEG quality (1-95)
+    Returns:
+        bytes: JPEG data of the first page, or None if nothing was rendered
+    """
+    pages = convert_pdf_to_images(pdf_path, max_pages=1, dpi=dpi, grayscale=grayscale, quality=quality)
+    return pages[0] if pages else None
+
+
+def is_mostly_grayscale(image, threshold=IMAGE_GRAYSCALE_SATURATION):
+    """True if the image carries almost no colour, e.g. a printed receipt"""
+    if image.mode in ('L', '1'):
+        return True
+    thumbnail = image.convert('RGB')
+    thumbnail.thumbnail((256, 256))
+    saturation = ImageStat.Stat(thumbnail.convert('HSV')).mean[1]
+    return saturation < threshold
+
+
+def choose_preprocess_settings(width, height, source_bytes=0, max_side=IMAGE_MAX_SIDE):
+    """
+    Pick preprocessing settings from the size of an image.
+
+    Args:
+        width (int): Image width in pixels.
+        height (int): Image height in pixels.
+        source_bytes (int): Size of the original file, 0 if unknown.
+        max_side (int): Cap on the longest side in pixels.
+    Returns:
+        dict: max_side, quality and detail to use.
+    """
+    longest = max(width, height)
+    quality = IMAGE_JPEG_QUALITY
+    if longest <= 1024:
+        # Small images have little detail to spare
+        quality = min(IMAGE_JPEG_QUALITY + 10, 95)
+    elif longest > 3000 or source_bytes > 3 * 1024 * 1024:
+        # Phone photos shrink a lot when downscaled and tolerate lower quality
+        quality = max(IMAGE_JPEG_QUALITY - 10, 50)
+
+    scale = min(1.0, max_side / float(longest))
+    detail = IMAGE_DETAIL
+    if width * scale <= 512 and height * scale <= 512:
+        # Low detail sees the same pixels for images this small, at a fraction of the tokens
+        detail = 'low'
+    return {'max_side': max_side, 'quality': quality, 'detail': detail}
+
+
+def prepare_image(image, source_bytes=0, max_side=None, quality=None, grayscale=None, detail=None):
+    """
+    Downscale, optionally greyscale and JPEG-encode an image for the vision model.
+
+    Settings not given explicitly are chosen by choose_preprocess_settings.
+
+    Args:
+        image (PIL.Image.Image): Image to prepare.
+        source_bytes (int): Size of the original file, 0 if unknown.
+        max_side (int): Cap on the longest side in pixels.
+        quality (int): JPEG quality (1-95).
+        grayscale (bool): Convert to greyscale; None applies IMAGE_GRAYSCALE.
+        detail (str): Vision detail level.
+    Returns:
+        tuple: (jpeg_bytes, info) where info describes what was done.
+    """
+    settings = choose_preprocess_settings(image.width, image.height, source_bytes,
+                                          max_side=max_side or IMAGE_MAX_SIDE)
+    max_side = settings['max_side']
+    quality = quality or settings['quality']
+    detail = detail or settings['detail']
+    if grayscale is None:
+        grayscale = IMAGE_GRAYSCALE == 'true' or (IMAGE_GRAYSCALE == 'auto' and is_mostly_grayscale(image))
+
+    original_size = image.size
+    if max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if grayscale:
+        image = image.convert('L')
+
+    data = image_to_jpeg_bytes(image, quality)
+    return data, {
+        'original_size': original_size,
+        'size': image.size,
+        'grayscale': grayscale,
+        'quality': quality,
+        'detail': detail,
+        'source_bytes': source_bytes,
+        'bytes': len(data)
+    }
+
+
+def _prepare_upload_image(receipt, source_bytes, overrides):
+    """Decode, orient and prepare an uploaded image; returns (format, rotated, prepared)"""
+    with receipt.open() as image_file, Image.open(image_file) as image:
+        source_format = image.format
+        rotated = image.getexif().get(0x0112, 1) != 1  # EXIF orientation tag
+        image = ImageOps.exif_transpose(image)
+        return source_format, rotated, prepare_image(image, source_bytes, **overrides)
+
+
+def prepare_file_for_vision(file_path, preprocess=IMAGE_PREPROCESS_ENABLED, **overrides):
+    """
+    Produce the JPEG images sent to the vision model for an upload.
+
+    PDFs are rendered page by page; other files are opened as images with
+    their EXIF orientation applied. With preprocessing off, images are
+    sent unchanged and PDF pages at JPEG_QUALITY.
+
+    Args:
+        file_path (str or ReceiptFile): The uploaded file.
+        preprocess (bool): Apply prepare_image (IMAGE_PREPROCESS_ENABLED).
+        **overrides: max_side, quality, grayscale or detail for prepare_image.
+    Returns:
+        list: (jpeg_bytes, info) tuples, one per image.
+    """
+    receipt = as_receipt_file(file_path)
+    if receipt.is_pdf:
+        pages = render_pdf_pages(receipt.path or receipt.getvalue())
+        if not preprocess:
+            return _map_pages(lambda page: (image_to_jpeg_bytes(page), {'detail': IMAGE_DETAIL}), pages)
+        return _map_pages(lambda page: prepare_image(page, **overrides), pages)
+
+    source_bytes = receipt.size
+    if not preprocess:
+        return [(receipt.getvalue(), {'detail': IMAGE_DETAIL, 'bytes': source_bytes})]
+
+    source_format, rotated, prepared = run_cpu_bound(_prepare_upload_image, receipt, source_bytes, overrides)
+    data, info = prepared
+    if (source_format == 'JPEG' and not rotated and info['size'] == info['original_size']
+            and info['bytes'] >= source_bytes):
+        # Re-encoding an already compact JPEG would only make it bigger
+        info.update(bytes=source_bytes, grayscale=False)
+        prepared = (receipt.getvalue(), info)
+    logger.info(f"Prepared {receipt.name}: {prepared[1]['original_size']} -> {prepared[1]['size']}, "
+                f"{source_bytes} -> {prepared[1]['bytes']} bytes")
+    return [prepared]
@@ -0,0 +1,591 @@
+import os
+import json
+import time
+import uuid
+import queue
+import sqlite3
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrency import gevent_active
+from db import get_connection, get_db_path
+from logging_setup import request_context
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Number of background threads processing receipts. Under gevent these are
+# greenlets waiting on network I/O, so many more are cheap.
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 64 if gevent_active() else 4))
+# How long finished jobs stay available on /jobs/<id>
+JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', 3600))
+# Threads shared by all jobs for running independent stages concurrently
+STAGE_WORKERS = int(os.getenv('STAGE_WORKERS', 128 if gevent_active() else 8))
+# Job state shared by all gunicorn workers, so any of them can report on a job
+JOBS_FILE = os.getenv('JOBS_FILE', get_db_path('jobs.db'))
+# The process running a job refreshes its heartbeat this often (seconds); an
+# unfinished job not refreshed for JOB_STALE_SECONDS is reported as failed
+JOB_HEARTBEAT_SECONDS = float(os.getenv('JOB_HEARTBEAT_SECONDS', 10))
+JOB_STALE_SECONDS = float(os.getenv('JOB_STALE_SECONDS', 60))
+# How often a worker streaming another worker's job checks for new events
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', 0.5))
+# Events only streamed by the process running the job (model output as it arrives)
+TRANSIENT_EVENTS = ('delta',)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    data TEXT NOT NULL,
+    children TEXT NOT NULL DEFAULT '[]',
+    version INTEGER NOT NULL DEFAULT 0,
+    owner TEXT NOT NULL,
+    heartbeat_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_owner ON jobs (owner, finished_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON jobs (finished_at);
+CREATE TABLE IF NOT EXISTS job_events (
+    job_id TEXT NOT NULL,
+    event_id INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (job_id, event_id)
+);
+"""
+
+
+def _conn():
+    return get_connection(JOBS_FILE, SCHEMA)
+
+
+_owner = None
+_owner_pid = None
+
+
+def get_owner():
+    """Id of this process in the jobs table; a restarted worker gets a new one"""
+    global _owner, _owner_pid
+    if _owner_pid != os.getpid():
+        _owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        _owner_pid = os.getpid()
+    return _owner
+
+
+def store_job(job_id, data, version, events, children=()):
+    """
+    Write a job's state and its new events to the shared store.
+
+    Args:
+        job_id (str): Job id.
+        data (dict): Job.to_dict() without the child jobs.
+        version (int): Number of events published so far; an older
+            snapshot never replaces a newer one.
+        events (list): (id, event, data) tuples not stored yet.
+        children (list): Ids of the child jobs of a batch.
+    """
+    now = time.time()
+    conn = _conn()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(
+            'INSERT INTO jobs (id, status, data, children, version, owner, heartbeat_at, created_at, finished_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET status = excluded.status, data = excluded.data, '
+            'children = excluded.children, version = excluded.version, heartbeat_at = excluded.heartbeat_at, '
+            'finished_at = excluded.finished_at WHERE excluded.version >= jobs.version',
+            (job_id, data['status'], json.dumps(data, default=str), json.dumps(list(children)), version, get_owner(),
+             now, data['created_at'], data['finished_at'])
+        )
+        conn.executemany(
+            'INSERT OR IGNORE INTO job_events (job_id, event_id, event, data) VALUES (?, ?, ?, ?)',
+            [(job_id, event_id, event, json.dumps(event_data, default=str)) for event_id, event, event_data in events]
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def _fail_stale(job_id):
+    """Mark a job failed if the process running it stopped sending heartbeats"""
+    conn = _conn()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None or row['finished_at'] is not None or row['heartbeat_at'] >= time.time() - JOB_STALE_SECONDS:
+            conn.execute('ROLLBACK')
+            return
+        error = 'The worker running this job stopped before it finished'
+        data = json.loads(row['data'])
+        data.update(status='failed', error=error, finished_at=time.time())
+        conn.execute('UPDATE jobs SET status = ?, data = ?, version = ?, finished_at = ? WHERE id = ?',
+                     ('failed', json.dumps(data), row['version'] + 1, data['finished_at'], job_id))
+        conn.execute('INSERT OR IGNORE INTO job_events (job_id, event_id, event, data) VALUES (?, ?, ?, ?)',
+                     (job_id, row['version'] + 1, 'error', json.dumps({'error': error})))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    logger.warning(f"Job {job_id} of {row['owner']} marked failed: no heartbeat since {row['heartbeat_at']:.0f}")
+
+
+def load_job(job_id):
+    """A StoredJob for a job of any worker, or None"""
+    row = _conn().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if row is None:
+        return None
+    if row['finished_at'] is None and row['heartbeat_at'] < time.time() - JOB_STALE_SECONDS:
+        _fail_stale(job_id)
+        row = _conn().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    return StoredJob(row)
+
+
+def load_events(job_id, last_id):
+    """Stored (id, event, data) tuples of a job after last_id"""
+    rows = _conn().execute(
+        'SELECT event_id, event, data FROM job_events WHERE job_id = ? AND event_id > ? ORDER BY event_id',
+        (job_id, last_id)
+    ).fetchall()
+    return [(row['event_id'], row['event'], json.loads(row['data'])) for row in rows]
+
+
+def heartbeat():
+    """Tell other workers this process is still running its unfinished jobs"""
+    _conn().execute('UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND finished_at IS NULL',
+                    (time.time(), get_owner()))
+
+
+def prune_stored_jobs(retention):
+    """Delete jobs that finished, or last sent a heartbeat, before the retention window"""
+    cutoff = time.time() - retention
+    conn = _conn()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM job_events WHERE job_id IN '
+                     '(SELECT id FROM jobs WHERE finished_at < ? OR heartbeat_at < ?)', (cutoff, cutoff))
+        conn.execute('DELETE FROM jobs WHERE finished_at < ? OR heartbeat_at < ?', (cutoff, cutoff))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+class Job:
+    """A queued unit of work with per-stage progress"""
+
+    def __init__(self, func, args, kwargs, stages):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.status = 'queued'
+        self.stages = OrderedDict((name, {'status': 'pending'}) for name in stages)
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.children = []
+        # (id, event, data) tuples streamed to /jobs/<id>/events
+        self.events = []
+        # Events already written to the shared store
+        self._stored_events = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def _emit(self, event, data):
+        # Callers hold self._lock
+        self.events.append((len(self.events) + 1, event, data))
+        self._changed.notify_all()
+
+    def emit(self, event, data):
+        """Publish a progress event, e.g. streamed model output"""
+        with self._lock:
+            self._emit(event, data)
+        if event not in TRANSIENT_EVENTS:
+            self.save()
+
+    def save(self):
+        """Write the job's state and new events to the store shared by all workers"""
+        with self._lock:
+            data = self._snapshot()
+            version = len(self.events)
+            events = [e for e in self.events[self._stored_events:] if e[1] not in TRANSIENT_EVENTS]
+            self._stored_events = version
+        try:
+            store_job(self.id, data, version, events, [child.id for child in self.children])
+        except sqlite3.Error as e:
+            # Only other workers lose sight of the job; it keeps running here
+            logger.error(f"Error storing job {self.id}: {str(e)}")
+
+    def _emit_stage(self, name):
+        data = {key: value for key, value in self.stages[name].items() if not key.endswith('_at')}
+        data['name'] = name
+        self._emit('stage', data)
+
+    @property
+    def done(self):
+        return self.status in ('completed', 'failed')
+
+    def wait_for_events(self, last_id, timeout):
+        """
+        Events published after last_id, waiting up to timeout seconds for one.
+
+        Returns:
+            list: (id, event, data) tuples; empty on timeout or once the job is done.
+        """
+        with self._lock:
+            if len(self.events) <= last_id and not self.done:
+                self._changed.wait(timeout)
+            return self.events[last_id:]
+
+    def _stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'status': 'pending'}
+        return self.stages[name]
+
+    def start_stage(self, name):
+        """Mark a stage as running"""
+        with self._lock:
+            stage = self._stage(name)
+            stage['status'] = 'running'
+            stage['started_at'] = time.time()
+            self._emit_stage(name)
+        self.save()
+
+    def finish_stage(self, name, detail=None):
+        """Mark a stage as completed"""
+        with self._lock:
+            stage = self._stage(name)
+            stage['status'] = 'completed'
+            stage['finished_at'] = time.time()
+            if 'started_at' in stage:
+                stage['duration'] = round(stage['finished_at'] - stage['started_at'], 3)
+            if detail is not None:
+                stage['detail'] = detail
+            self._emit_stage(name)
+        self.save()
+
+    def fail_stage(self, name, error):
+        """Mark a stage as failed"""
+        with self._lock:
+            stage = self._stage(name)
+            stage['status'] = 'failed'
+            stage['finished_at'] = time.time()
+            if 'started_at' in stage:
+                stage['duration'] = round(stage['finished_at'] - stage['started_at'], 3)
+            stage['error'] = str(error)
+            self._emit_stage(name)
+        self.save()
+
+    def skip_stage(self, name, reason=None):
+        """Mark a stage as skipped (e.g. disabled in settings)"""
+        with self._lock:
+            stage = self._stage(name)
+            stage['status'] = 'skipped'
+            if reason:
+                stage['detail'] = reason
+            self._emit_stage(name)
+        self.save()
+
+    def _snapshot(self):
+        # Callers hold self._lock
+        data = {
+            'job_id': self.id,
+            'status': self.status,
+            'stages': [dict(stage, name=name) for name, stage in self.stages.items()],
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+        if self.status == 'completed':
+            data['result'] = self.result
+        elif self.status == 'failed':
+            data['error'] = self.error
+        return data
+
+    def to_dict(self):
+        """JSON-serialisable view of the job for the status endpoint"""
+        with self._lock:
+            data = self._snapshot()
+        if self.children:
+            data['jobs'] = [child.to_dict() for child in self.children]
+        return data
+
+
+class StoredJob:
+    """
+    A job read from the shared store, e.g. one run by another worker.
+
+    Offers the same to_dict(), done and wait_for_events() as Job. Events
+    are polled from the store every JOB_POLL_SECONDS, and model output
+    (TRANSIENT_EVENTS) is only streamed by the worker running the job.
+    """
+
+    def __init__(self, row):
+        self.id = row['id']
+        self._load(row)
+
+    def _load(self, row):
+        self.data = json.loads(row['data'])
+        self.status = row['status']
+        self.child_ids = json.loads(row['children'])
+
+    def refresh(self):
+        """Re-read the job, marking it failed if its worker has stopped"""
+        job = load_job(self.id)
+        if job is not None:
+            self.data, self.status, self.child_ids = job.data, job.status, job.child_ids
+
+    @property
+    def done(self):
+        return self.status in ('completed', 'failed')
+
+    def wait_for_events(self, last_id, timeout):
+        """
+        Events stored after last_id, polling up to timeout seconds for one.
+
+        Returns:
+            list: (id, event, data) tuples; empty on timeout or once the job is done.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            # Status first: once the job is seen done, its last events are already stored
+            self.refresh()
+            events = load_events(self.id, last_id)
+            if events or self.done:
+                return events
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            time.sleep(min(JOB_POLL_SECONDS, remaining))
+
+    def to_dict(self):
+        """JSON-serialisable view of the job for the status endpoint"""
+        data = dict(self.data)
+        children = [load_job(child_id) for child_id in self.child_ids]
+        if children:
+            data['jobs'] = [child.to_dict() for child in children if child is not None]
+        return data
+
+
+class JobQueue:
+    """In-process job queue drained by a pool of worker threads.
+
+    Jobs run in the process that accepted them, and every change is
+    written to the shared jobs database, so the status and event
+    endpoints work from any gunicorn worker. A job whose process died
+    (a restart or a --timeout kill) is reported as failed once its
+    heartbeat is JOB_STALE_SECONDS old.
+    """
+
+    def __init__(self, num_workers=JOB_WORKERS, retention=JOB_RETENTION_SECONDS):
+        self.num_workers = num_workers
+        self.retention = retention
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._heartbeat_pid = None
+        self._next_store_prune = 0.0
+
+    def _ensure_workers(self):
+        # Threads are started on first use so they are created in the
+        # serving process rather than before a fork
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.num_workers:
+                thread = threading.Thread(
+                    target=self._worker,
+                    name=f"job-worker-{len(self._threads) + 1}",
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _ensure_heartbeat(self):
+        with self._lock:
+            if self._heartbeat_pid == os.getpid():
+                return
+            threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True).start()
+            self._heartbeat_pid = os.getpid()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                heartbeat()
+            except sqlite3.Error as e:
+                logger.error(f"Error updating job heartbeat: {str(e)}")
+
+    def create(self, func, *args, stages=(), **kwargs):
+        """Register func(job, *args, **kwargs) as a job without queueing it"""
+        job = Job(func, args, kwargs, stages)
+        self._prune()
+        self._ensure_heartbeat()
+        with self._lock:
+            self._jobs[job.id] = job
+        job.save()
+        return job
+
+    def submit(self, func, *args, stages=(), **kwargs):
+        """Queue func(job, *args, **kwargs) and return the Job"""
+        return self.enqueue(self.create(func, *args, stages=stages, **kwargs))
+
+    def enqueue(self, job):
+        """Queue a job created with create()"""
+        self._ensure_workers()
+        if job.children:
+            job.save()
+        self._queue.put(job)
+        logger.info(f"Queued job {job.id} ({self._queue.qsize()} waiting)")
+        return job
+
+    def get(self, job_id):
+        """
+        Look up a job by id.
+
+        Returns:
+            Job for a job of this process, StoredJob for one of another
+            worker, or None.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        try:
+            return load_job(job_id)
+        except sqlite3.Error as e:
+            logger.error(f"Error loading job {job_id}: {str(e)}")
+            return None
+
+    def _prune(self):
+        """Forget finished jobs older than the retention window"""
+        cutoff = time.time() - self.retention
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at and job.finished_at < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+            # The shared store is pruned at most once a minute per process
+            prune_store = time.monotonic() >= self._next_store_prune
+            if prune_store:
+                self._next_store_prune = time.monotonic() + 60
+        if prune_store:
+            try:
+                prune_stored_jobs(self.retention)
+            except sqlite3.Error as e:
+                logger.error(f"Error pruning stored jobs: {str(e)}")
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def run_job(self, job):
+        """Run a job created with create() in the calling thread"""
+        self._run(job)
+        return job
+
+    def _run(self, job):
+        with request_context(job.id):
+            self._run_job(job)
+
+    def _run_job(self, job):
+        job.status = 'running'
+        job.started_at = time.time()
+        job.save()
+        logger.info(f"Starting job {job.id}")
+        try:
+            result = job.func(job, *job.args, **job.kwargs)
+            with job._lock:
+                job.result = result
+                job.status = 'completed'
+                job._emit('result', result)
+            logger.info(f"Job {job.id} completed in {time.time() - job.started_at:.2f}s")
+        except Exception as e:
+            with job._lock:
+                job.error = str(e)
+                job.status = 'failed'
+                job._emit('error', {'error': str(e)})
+            logger.error(f"Job {job.id} failed: {str(e)}")
+        finally:
+            job.finished_at = time.time()
+            job.save()
+            metrics.inc('jobs_total', status=job.status)
+            # Drop references to the arguments once the job is done
+            job.args = ()
+            job.kwargs = {}
+
+
+_stage_executor = None
+_stage_executor_lock = threading.Lock()
+
+
+def get_stage_executor():
+    """Shared thread pool for stages, created on first use"""
+    global _stage_executor
+    with _stage_executor_lock:
+        if _stage_executor is None:
+            _stage_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS,
+                                                 thread_name_prefix='stage')
+        return _stage_executor
+
+
+def run_stages(job, stages, details=None):
+    """
+    Start independent stages together and wait for all of them.
+
+    Args:
+        job (Job): Job the stages report progress to.
+        stages (dict): Stage name -> callable taking no arguments.
+        details (dict): Optional stage name -> detail shown once the stage completes.
+    Returns:
+        tuple: (results, errors) dicts keyed by stage name. A stage that
+        raised appears in errors instead of results.
+    """
+    def timed(name, func):
+        job.start_stage(name)
+        logger.debug(f"Stage {name} started")
+        start = time.time()
+        try:
+            result = func()
+        except Exception as e:
+            job.fail_stage(name, e)
+            logger.error(f"Stage {name} failed after {time.time() - start:.2f}s: {str(e)}")
+            metrics.observe('stage_seconds', time.time() - start, stage=name, outcome='error')
+            metrics.inc('errors_total', source='stage', reason=name)
+            raise
+        metrics.observe('stage_seconds', time.time() - start, stage=name, outcome='ok')
+        job.finish_stage(name, details.get(name))
+        logger.debug(f"Stage {name} finished in {time.time() - start:.2f}s")
+        return result
+
+    details = details or {}
+    start = time.time()
+    executor = get_stage_executor()
+    # Each stage runs in a copy of this context, so its log records keep the job id
+    futures = {name: executor.submit(contextvars.copy_context().run, timed, name, func)
+               for name, func in stages.items()}
+
+    results, errors = {}, {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            errors[name] = e
+
+    durations = [job.stages[name].get('duration', 0) for name in stages]
+    logger.info(f"Stages {', '.join(stages)} finished in {time.time() - start:.2f}s "
+                f"(sum of stages {sum(durations):.2f}s)")
+    return results, errors
+
+
+job_queue = JobQueue()
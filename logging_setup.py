@@ -0,0 +1,231 @@
+"""
+Logging configuration shared by the app and the command line tools.
+
+Records are put on an in-memory queue by the calling thread and written
+to stdout and the log files by a single listener thread, so a request
+never waits on disk or pipe I/O. Each record carries the id of the
+request or job it belongs to (see request_context).
+"""
+import os
+import sys
+import json
+import zlib
+import queue
+import atexit
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 'json' for one JSON object per line, 'text' for the classic format
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_DIR = os.getenv('LOG_DIR', 'logs')
+# Write logs/all_processes.log and logs/email.log besides stdout
+LOG_FILES_ENABLED = os.getenv('LOG_FILES_ENABLED', 'true').lower() == 'true'
+# Records waiting for the listener; further records are dropped and counted
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Share of requests/jobs whose DEBUG lines (e.g. per-stage timings) are kept.
+# The choice is made per id, so a sampled request keeps all of its lines.
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 1.0))
+
+# Loggers whose records also go to logs/email.log
+EMAIL_LOGGERS = ('gmail_service', 'digest')
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+
+# Id of the request or job being handled by the current thread/greenlet
+request_id_var = contextvars.ContextVar('request_id', default='-')
+
+
+@contextmanager
+def request_context(request_id):
+    """
+    Tag every record logged inside the block with an id.
+
+    Usage:
+        with request_context(job.id):
+            ...
+    """
+    token = request_id_var.set(request_id)
+    try:
+        yield
+    finally:
+        request_id_var.reset(token)
+
+
+def is_sampled(request_id, rate=None):
+    """True if the DEBUG lines of this request/job are kept"""
+    rate = LOG_DEBUG_SAMPLE_RATE if rate is None else rate
+    if rate >= 1:
+        return True
+    if rate <= 0:
+        return False
+    return zlib.crc32(request_id.encode()) % 10000 < rate * 10000
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds request_id to records and applies DEBUG sampling.
+
+    Runs in the logging thread, before the record is queued, because the
+    listener thread does not see the caller's context.
+    """
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        if record.levelno <= logging.DEBUG and not is_sampled(record.request_id):
+            return False
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class NameFilter(logging.Filter):
+    """Keep records from the given loggers only"""
+
+    def __init__(self, names):
+        super().__init__()
+        self.names = tuple(names)
+
+    def filter(self, record):
+        return record.name.startswith(self.names)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue, max_size=LOG_QUEUE_SIZE):
+        super().__init__(log_queue)
+        self.max_size = max_size
+        self.dropped = 0
+        self.handled = 0
+
+    def prepare(self, record):
+        # Format the message here, where the arguments are still valid,
+        # but leave the final formatting to the listener's handlers
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if _pid != os.getpid():
+            _restart_after_fork()
+        # SimpleQueue is unbounded but much cheaper to put to than queue.Queue
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+        self.handled += 1
+
+
+_handler = None
+_listener = None
+_log_format = LOG_FORMAT
+_pid = None
+_lock = threading.Lock()
+
+
+def _build_handlers(log_format):
+    formatter = JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT)
+    console_handler = logging.StreamHandler(sys.stdout)
+    handlers = [console_handler]
+    if LOG_FILES_ENABLED:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        file_handler = logging.FileHandler(os.path.join(LOG_DIR, 'all_processes.log'))
+        email_handler = logging.FileHandler(os.path.join(LOG_DIR, 'email.log'))
+        email_handler.addFilter(NameFilter(EMAIL_LOGGERS))
+        handlers += [file_handler, email_handler]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+def _start_listener(log_format):
+    global _listener, _pid, _log_format
+    _log_format = log_format
+    _listener = QueueListener(_handler.queue, *_build_handlers(log_format), respect_handler_level=True)
+    _listener.start()
+    _pid = os.getpid()
+
+
+def _reset_lock_after_fork():
+    global _lock
+    _lock = threading.Lock()
+
+
+def _restart_after_fork():
+    # The listener thread does not survive fork (gunicorn --preload); the
+    # child gets a fresh queue and listener, the parent's are left alone.
+    # This runs on the child's first record rather than in a fork hook:
+    # subprocesses run fork hooks before exec, and starting a thread there
+    # lets gevent resume the parent's greenlets in the child.
+    with _lock:
+        if _handler is not None and _pid != os.getpid():
+            _handler.queue = queue.SimpleQueue()
+            _start_listener(_log_format)
+
+
+def setup_logging(level=None, log_format=None):
+    """
+    Configure the root logger once per process.
+
+    Args:
+        level (str): Log level, LOG_LEVEL by default.
+        log_format (str): 'json' or 'text', LOG_FORMAT by default.
+    Returns:
+        DroppingQueueHandler: The handler installed on the root logger.
+    """
+    global _handler
+    with _lock:
+        if _handler is not None:
+            return _handler
+        _handler = DroppingQueueHandler(queue.SimpleQueue())
+        _handler.addFilter(ContextFilter())
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(_handler)
+        root.setLevel(level or LOG_LEVEL)
+        _start_listener(log_format or LOG_FORMAT)
+        atexit.register(stop_logging)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_reset_lock_after_fork)
+        return _handler
+
+
+def stop_logging():
+    """Write out the queued records and stop the listener"""
+    if _listener is not None and _pid == os.getpid():
+        try:
+            _listener.stop()
+        except Exception:
+            pass
+
+
+def logging_stats():
+    """Records handled and dropped by this process, and the current queue length"""
+    if _handler is None:
+        return {'handled': 0, 'dropped': 0, 'queued': 0}
+    return {'handled': _handler.handled, 'dropped': _handler.dropped, 'queued': _handler.queue.qsize()}
+
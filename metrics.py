@@ -0,0 +1,279 @@
+import os
+import time
+import math
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from db import get_connection, get_db_path
+
+logger = logging.getLogger(__name__)
+
+METRICS_FILE = os.getenv('METRICS_FILE', get_db_path('metrics.db'))
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+# Each worker's background thread adds what it measured to the shared database this often
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', 5))
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 512 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 32 * 1024 ** 2)
+
+PREFIX = 'receipts_'
+
+# name -> (type, help, buckets)
+METRICS = {
+    'http_request_seconds': ('histogram', 'HTTP request latency by endpoint and status', LATENCY_BUCKETS),
+    'http_stream_seconds': ('histogram', 'How long streamed responses (job events) stayed open', LATENCY_BUCKETS),
+    'stage_seconds': ('histogram', 'Receipt pipeline stage latency (drive_upload, analysis, email, zapier)',
+                      LATENCY_BUCKETS),
+    'operation_seconds': ('histogram', 'Latency of steps inside a stage, e.g. pdf_render or base64_encode',
+                          LATENCY_BUCKETS),
+    'external_call_seconds': ('histogram', 'Latency of OpenAI, Gmail, Drive and Zapier calls', LATENCY_BUCKETS),
+    'payload_bytes': ('histogram', 'Size of uploads, OpenAI requests and emails', SIZE_BUCKETS),
+    'errors_total': ('counter', 'Errors by source and reason', None),
+    'openai_tokens_total': ('counter', 'OpenAI tokens reported in response.usage', None),
+    'analysis_cache_total': ('counter', 'Analysis cache lookups by result', None),
+    'jobs_total': ('counter', 'Finished jobs by status', None),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metric_values (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    value REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, labels, bucket)
+);
+"""
+
+
+def _conn():
+    return get_connection(METRICS_FILE, SCHEMA)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    """Canonical Prometheus label string, e.g. 'api="openai",outcome="ok"'"""
+    return ','.join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()))
+
+
+# Deltas measured by this process since the last flush: (name, labels, bucket) -> value
+_pending = {}
+_lock = threading.Lock()
+# Thread writing the deltas, and the process that started it
+_flusher = None
+_flusher_pid = None
+
+
+def _add(name, labels, bucket, value):
+    key = (name, labels, bucket)
+    _pending[key] = _pending.get(key, 0) + value
+
+
+def inc(name, value=1, **labels):
+    """Add to a counter"""
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        _add(name, _format_labels(labels), '', value)
+    _ensure_flusher()
+
+
+def observe(name, value, **labels):
+    """Record one value in a histogram"""
+    if not METRICS_ENABLED:
+        return
+    buckets = METRICS[name][2]
+    # Buckets are stored as plain counts and made cumulative when exported
+    bucket = next((str(bound) for bound in buckets if value <= bound), '+Inf')
+    label_string = _format_labels(labels)
+    with _lock:
+        _add(name, label_string, bucket, 1)
+        _add(name, label_string, 'sum', value)
+    _ensure_flusher()
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the duration of the block, labelled outcome="ok" or "error" """
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, outcome=outcome, **labels)
+
+
+def _ensure_flusher():
+    """Start the flush thread on the first measurement of each process"""
+    global _flusher, _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher = threading.Thread(target=_flush_loop, name='metrics-flusher', daemon=True)
+        _flusher.start()
+        _flusher_pid = os.getpid()
+
+
+def _flush_loop():
+    # Request threads only add to _pending; the database write happens here
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        flush()
+
+
+def flush():
+    """Add this process's pending deltas to the shared database"""
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return
+    try:
+        conn = _conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT INTO metric_values (name, labels, bucket, value) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (name, labels, bucket) DO UPDATE SET value = value + excluded.value',
+                [(name, labels, bucket, value) for (name, labels, bucket), value in pending.items()]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception as e:
+        # Put the deltas back so they are written with the next flush
+        with _lock:
+            for key, value in pending.items():
+                _pending[key] = _pending.get(key, 0) + value
+        logger.error(f"Error flushing metrics: {str(e)}")
+
+
+def _reset_after_fork():
+    # A preloaded parent's pending deltas are its own; the child starts empty
+    global _pending, _lock
+    _pending = {}
+    _lock = threading.Lock()
+
+
+atexit.register(flush)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _load():
+    """name -> labels -> {bucket: value} for every stored metric"""
+    flush()
+    data = {}
+    for row in _conn().execute('SELECT name, labels, bucket, value FROM metric_values ORDER BY name, labels'):
+        data.setdefault(row['name'], {}).setdefault(row['labels'], {})[row['bucket']] = row['value']
+    return data
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def _histogram_buckets(name, values):
+    """(bound, cumulative count) pairs ending with +Inf"""
+    cumulative = 0
+    result = []
+    for bound in METRICS[name][2]:
+        cumulative += values.get(str(bound), 0)
+        result.append((bound, cumulative))
+    cumulative += values.get('+Inf', 0)
+    result.append((math.inf, cumulative))
+    return result
+
+
+def render_prometheus():
+    """All metrics of every worker in the Prometheus text format"""
+    data = _load()
+    lines = []
+    for name, (kind, help_text, _) in METRICS.items():
+        full_name = PREFIX + name
+        lines.append(f'# HELP {full_name} {help_text}')
+        lines.append(f'# TYPE {full_name} {kind}')
+        for labels, values in data.get(name, {}).items():
+            if kind == 'counter':
+                lines.append(f'{full_name}{{{labels}}} {_format_value(values.get("", 0))}')
+                continue
+            separator = ',' if labels else ''
+            buckets = _histogram_buckets(name, values)
+            for bound, count in buckets:
+                le = '+Inf' if bound == math.inf else _format_value(bound)
+                lines.append(f'{full_name}_bucket{{{labels}{separator}le="{le}"}} {_format_value(count)}')
+            lines.append(f'{full_name}_sum{{{labels}}} {_format_value(values.get("sum", 0))}')
+            lines.append(f'{full_name}_count{{{labels}}} {_format_value(buckets[-1][1])}')
+    return '\n'.join(lines) + '\n'
+
+
+def estimate_quantile(buckets, quantile):
+    """
+    Estimate a quantile from cumulative histogram buckets.
+
+    Interpolates linearly inside the bucket, as Prometheus'
+    histogram_quantile does; values above the last bound report that bound.
+    """
+    total = buckets[-1][1]
+    if not total:
+        return None
+    rank = quantile * total
+    lower_bound, lower_count = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == math.inf:
+                return lower_bound
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+def get_percentiles(name, data=None):
+    """
+    p50/p95/p99, count and mean of a histogram, for the admin dashboard.
+
+    Returns:
+        list: One dict per label set, sorted by label string.
+    """
+    summaries = []
+    for labels, values in (data if data is not None else _load()).get(name, {}).items():
+        buckets = _histogram_buckets(name, values)
+        count = buckets[-1][1]
+        summaries.append({
+            'labels': labels.replace('"', ''),
+            'count': int(count),
+            'mean': values.get('sum', 0) / count if count else None,
+            'p50': estimate_quantile(buckets, 0.5),
+            'p95': estimate_quantile(buckets, 0.95),
+            'p99': estimate_quantile(buckets, 0.99),
+        })
+    return summaries
+
+
+def get_counters(name, data=None):
+    """label string -> value of a counter, for the admin dashboard"""
+    data = data if data is not None else _load()
+    return {labels.replace('"', ''): values.get('', 0) for labels, values in data.get(name, {}).items()}
+
+
+def get_dashboard():
+    """Percentiles of every histogram and every counter, read in one go"""
+    data = _load()
+    return {
+        'histograms': {name: get_percentiles(name, data)
+                       for name, (kind, _, _) in METRICS.items() if kind == 'histogram'},
+        'counters': {name: get_counters(name, data)
+                     for name, (kind, _, _) in METRICS.items() if kind == 'counter'},
+    }
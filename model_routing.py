@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import time
+import logging
+from datetime import datetime
+import analysis_stats
+
+logger = logging.getLogger(__name__)
+
+# Models tried in order; the next one is used only when a reply fails the checks
+MODEL_TIERS = [m.strip() for m in os.getenv('MODEL_TIERS', 'gpt-4o-mini,gpt-4-turbo').split(',') if m.strip()] or ['gpt-4-turbo']
+# Tiers for PDFs analysed from their text layer
+TEXT_MODEL_TIERS = [m.strip() for m in os.getenv('TEXT_MODEL_TIERS', '').split(',') if m.strip()] or MODEL_TIERS
+# Share of the key fields a reply must fill in to be accepted without escalation
+MODEL_MIN_CONFIDENCE = float(os.getenv('MODEL_MIN_CONFIDENCE', 0.75))
+
+EXPECTED_FIELDS = (
+    'invoice_number', 'date', 'amount', 'customer_name', 'vendor', 'credit_card',
+    'description_of_items_or_services', 'billing_address', 'payment_method'
+)
+# Fields every receipt is expected to have; confidence is the share found
+KEY_FIELDS = ('invoice_number', 'date', 'amount', 'vendor')
+
+# Date formats accepted in a reply; any time of day is removed first (TIME_SUFFIX)
+DATE_FORMATS = (
+    '%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%d/%m/%Y', '%m-%d-%Y', '%d-%m-%Y', '%Y/%m/%d',
+    '%Y.%m.%d', '%d.%m.%Y', '%d-%b-%Y', '%d-%B-%Y', '%d-%b-%y',
+    '%B %d, %Y', '%b %d, %Y', '%b. %d, %Y', '%d %B %Y', '%d %b %Y', '%B %d %Y', '%b %d %Y',
+    '%A, %B %d, %Y', '%a, %b %d, %Y'
+)
+# "14:32", "2:32:05 PM", "14:32:00.123Z" or "2:32 pm EST" after the date
+TIME_SUFFIX = re.compile(
+    r'(?:T|,? (?:at )?)\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?: ?[ap]\.?m\.?)?'
+    r'(?: ?(?:Z|[+-]\d{2}:?\d{2}|[A-Z]{2,5}))?$',
+    re.IGNORECASE
+)
+
+
+def is_missing(value):
+    return value is None or str(value).strip() in ('', 'N/A')
+
+
+def parse_amount(value):
+    """The amount as a float, or None if it is not a number"""
+    cleaned = re.sub(r'[^\d.,-]', '', str(value)).replace(',', '')
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+
+def parse_date(value):
+    """The date as a datetime at midnight, or None if no known format matches"""
+    text = ' '.join(str(value).replace(',', ', ').split()).replace(' ,', ',')
+    text = TIME_SUFFIX.sub('', text)
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+    return None
+
+
+def check_result(content):
+    """
+    Validate a model reply against the schema and sanity rules.
+
+    Args:
+        content (str): Reply with any markdown fences removed.
+    Returns:
+        tuple: (problems, confidence). problems lists the failed checks;
+        confidence is the share of KEY_FIELDS that were found.
+    """
+    try:
+        result = json.loads(content)
+    except (TypeError, json.JSONDecodeError):
+        return ['invalid_json'], 0.0
+    if not isinstance(result, dict):
+        return ['not_an_object'], 0.0
+
+    problems = []
+    if any(field not in result for field in EXPECTED_FIELDS):
+        problems.append('missing_fields')
+    if not is_missing(result.get('amount')) and parse_amount(result['amount']) is None:
+        problems.append('bad_amount')
+    if not is_missing(result.get('date')) and parse_date(result['date']) is None:
+        problems.append('bad_date')
+    card = result.get('credit_card')
+    if not is_missing(card) and not re.fullmatch(r'\d{1,4}', re.sub(r'[\s*xX•.-]', '', str(card))):
+        problems.append('bad_card_digits')
+
+    confidence = sum(1 for field in KEY_FIELDS if not is_missing(result.get(field))) / len(KEY_FIELDS)
+    if confidence < MODEL_MIN_CONFIDENCE:
+        problems.append('low_confidence')
+    return problems, confidence
+
+
+def analyze_with_tiers(request, tiers=None, progress=None):
+    """
+    Ask the cheapest model first and escalate while replies fail the checks.
+
+    Args:
+        request (callable): request(model) returning the cleaned reply.
+        tiers (list): Models in escalation order (MODEL_TIERS).
+        progress (callable): Told about each escalation with a 'route' event.
+    Returns:
+        tuple: (content, model) of the accepted reply, or of the last tier
+        when every tier failed the checks.
+    """
+    tiers = tiers or MODEL_TIERS
+    for index, model in enumerate(tiers):
+        last_tier = index == len(tiers) - 1
+        start = time.time()
+        try:
+            content = request(model)
+        except Exception as e:
+            if last_tier:
+                raise
+            # e.g. the model is unavailable to this account; the next tier may still work
+            logger.error(f"{model} request failed: {str(e)}")
+            content = None
+        elapsed = time.time() - start
+        analysis_stats.record('tier', model, elapsed)
+
+        problems, confidence = check_result(content) if content is not None else (['error'], 0.0)
+        if not problems:
+            logger.info(f"Accepted {model} reply in {elapsed:.2f}s (confidence {confidence:.2f})")
+            return content, model
+        if last_tier:
+            logger.warning(f"{model} reply failed checks {problems}; no larger model left")
+            return content, model
+
+        logger.info(f"Escalating from {model} after {elapsed:.2f}s: {', '.join(problems)}")
+        for problem in problems:
+            analysis_stats.record('escalation', problem)
+        if progress:
+            progress('route', {'route': 'escalated', 'model': tiers[index + 1], 'reasons': problems})
@@ -0,0 +1,73 @@
+import os
+import re
+import logging
+import subprocess
+from image_processing import POPPLER_PATH, PDF_MAX_PAGES
+from receipt_file import as_receipt_file
+
+logger = logging.getLogger(__name__)
+
+# Use the PDF text layer instead of the vision model when it holds enough text
+TEXT_LAYER_ENABLED = os.getenv('TEXT_LAYER_ENABLED', 'true').lower() == 'true'
+# Letters and digits needed before the text layer is trusted; scans have none
+TEXT_LAYER_MIN_CHARS = int(os.getenv('TEXT_LAYER_MIN_CHARS', 200))
+# Text beyond this is cut off before it is sent to the model
+TEXT_LAYER_MAX_CHARS = int(os.getenv('TEXT_LAYER_MAX_CHARS', 12000))
+PDFTOTEXT_TIMEOUT = 30
+
+
+def extract_pdf_text(pdf_path, max_pages=PDF_MAX_PAGES):
+    """
+    Extract the text layer of the first pages of a PDF with pdftotext.
+
+    Args:
+        pdf_path (str or bytes): Path to PDF file, or its content (piped to pdftotext)
+        max_pages (int): Number of pages to read
+    Returns:
+        str: Text of the pages with their layout kept, '' if there is none
+    """
+    in_memory = isinstance(pdf_path, bytes)
+    command = [os.path.join(POPPLER_PATH, 'pdftotext'), '-layout', '-enc', 'UTF-8',
+               '-f', '1', '-l', str(max(max_pages, 1)), '-' if in_memory else pdf_path, '-']
+    try:
+        result = subprocess.run(command, input=pdf_path if in_memory else None,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                timeout=PDFTOTEXT_TIMEOUT, check=True)
+    except (OSError, subprocess.SubprocessError) as e:
+        source = f"{len(pdf_path)} bytes" if in_memory else pdf_path
+        logger.error(f"Error extracting PDF text from {source}: {str(e)}")
+        return ''
+    return result.stdout.decode('utf-8', 'replace')
+
+
+def has_usable_text(text, min_chars=TEXT_LAYER_MIN_CHARS):
+    """True if the text layer has enough content to analyse without the image"""
+    meaningful = len(re.findall(r'\w', text))
+    # An invoice without a single digit has no amount or date to extract
+    return meaningful >= min_chars and re.search(r'\d', text) is not None
+
+
+def clean_pdf_text(text, max_chars=TEXT_LAYER_MAX_CHARS):
+    """Collapse the padding pdftotext uses for layout and cap the length"""
+    lines = [re.sub(r' {3,}', '   ', line.rstrip()) for line in text.replace('\f', '\n').splitlines()]
+    text = re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+    return text[:max_chars]
+
+
+def get_text_layer(pdf_path):
+    """
+    Text to analyse instead of the rendered pages.
+
+    Args:
+        pdf_path (str or ReceiptFile): The uploaded file.
+    Returns:
+        str: Cleaned text layer, or None for scanned or image-only PDFs.
+    """
+    receipt = as_receipt_file(pdf_path)
+    if not TEXT_LAYER_ENABLED or not receipt.is_pdf:
+        return None
+    text = extract_pdf_text(receipt.path or receipt.getvalue())
+    if not has_usable_text(text):
+        logger.info(f"No usable text layer in {receipt.name} ({len(text.strip())} chars), using vision")
+        return None
+    return clean_pdf_text(text)
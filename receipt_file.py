@@ -0,0 +1,165 @@
+import io
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import weakref
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Uploads up to this size stay in memory; larger ones go to a private temp file
+INGEST_MAX_MEMORY = int(os.getenv('INGEST_MAX_MEMORY', 4 * 1024 * 1024))
+# Directory for those temp files (system default if unset)
+INGEST_TEMP_DIR = os.getenv('INGEST_TEMP_DIR') or None
+
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f"Error removing temp file {path}: {str(e)}")
+
+
+class ReceiptFile:
+    """
+    An uploaded receipt owned by one request.
+
+    The content is held in memory, or in a uniquely named temp file when it
+    is larger than INGEST_MAX_MEMORY, so concurrent uploads with the same
+    name never share a file. Stages that run in parallel each get their own
+    reader from open(). close() removes the temp file, and it is removed
+    even if close() is never called once the object is garbage collected.
+    Reading a closed receipt raises ValueError.
+    """
+
+    def __init__(self, name, data=None, path=None, owned=True):
+        self.name = name
+        self._data = data
+        self.path = path
+        self.closed = False
+        self._in_memory = data is not None
+        self._md5 = None
+        self._lock = threading.Lock()
+        self._finalizer = weakref.finalize(self, _remove_file, path) if path and owned else None
+
+    @classmethod
+    def from_upload(cls, file_storage, name):
+        """
+        Take an uploaded file out of the request.
+
+        Args:
+            file_storage (FileStorage): File from request.files.
+            name (str): Secure file name to use for the receipt.
+        Returns:
+            ReceiptFile: Receipt that stays valid after the request ends.
+        """
+        stream = file_storage.stream
+        head = stream.read(INGEST_MAX_MEMORY + 1)
+        if len(head) <= INGEST_MAX_MEMORY:
+            metrics.observe('payload_bytes', len(head), kind='upload')
+            return cls(name, data=head)
+
+        fd, path = tempfile.mkstemp(prefix='receipt-', suffix=os.path.splitext(name)[1], dir=INGEST_TEMP_DIR)
+        receipt = cls(name, path=path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(head)
+                shutil.copyfileobj(stream, f, COPY_BUFFER_SIZE)
+        except Exception:
+            receipt.close()
+            raise
+        size = os.path.getsize(path)
+        metrics.observe('payload_bytes', size, kind='upload')
+        logger.info(f"Spooled {name} to {path} ({size} bytes)")
+        return receipt
+
+    @classmethod
+    def from_path(cls, path, name=None):
+        """Wrap an existing file; it is read in place and never deleted"""
+        return cls(name or os.path.basename(path), path=path, owned=False)
+
+    @property
+    def extension(self):
+        return os.path.splitext(self.name)[1].lower()
+
+    @property
+    def is_pdf(self):
+        return self.extension == '.pdf'
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError(f"Receipt {self.name} is closed")
+
+    @property
+    def size(self):
+        self._check_open()
+        if self._data is not None:
+            return len(self._data)
+        return os.path.getsize(self.path)
+
+    @property
+    def in_memory(self):
+        """True if the content is (or was, before close) held in memory"""
+        return self._in_memory
+
+    def open(self):
+        """A new binary reader positioned at the start"""
+        self._check_open()
+        if self._data is not None:
+            return io.BytesIO(self._data)
+        return open(self.path, 'rb')
+
+    def getvalue(self):
+        """The whole content as bytes"""
+        self._check_open()
+        if self._data is not None:
+            return self._data
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    @property
+    def md5(self):
+        """MD5 of the content, computed once"""
+        with self._lock:
+            if self._md5 is None:
+                hasher = hashlib.md5()
+                with self.open() as f:
+                    for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+                        hasher.update(chunk)
+                self._md5 = hasher.hexdigest()
+            return self._md5
+
+    def save_as(self, path):
+        """Write a copy of the content to path"""
+        with self.open() as source, open(path, 'wb') as target:
+            shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+
+    def close(self):
+        """Release the content and remove the temp file, if any"""
+        self.closed = True
+        self._data = None
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        where = 'memory' if self.in_memory else self.path
+        state = ', closed' if self.closed else ''
+        return f"<ReceiptFile {self.name} ({where}{state})>"
+
+
+def as_receipt_file(source):
+    """A ReceiptFile for either a ReceiptFile or a path"""
+    return source if isinstance(source, ReceiptFile) else ReceiptFile.from_path(source)
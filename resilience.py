@@ -0,0 +1,279 @@
+import os
+import time
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+import metrics
+from db import get_connection, get_db_path
+
+logger = logging.getLogger(__name__)
+
+# Token bucket state, shared by every gunicorn worker on the host
+RATE_LIMITS_FILE = os.getenv('RATE_LIMITS_FILE', get_db_path('rate_limits.db'))
+# Requests per minute and burst size allowed to each API, across all worker processes
+API_RATE_LIMITS = {
+    'openai': (float(os.getenv('OPENAI_RATE_LIMIT', 60)), int(os.getenv('OPENAI_RATE_BURST', 5))),
+    # A Gmail send costs 100 of the 250 quota units per user per second
+    'gmail': (float(os.getenv('GMAIL_RATE_LIMIT', 120)), int(os.getenv('GMAIL_RATE_BURST', 2))),
+    'drive': (float(os.getenv('DRIVE_RATE_LIMIT', 600)), int(os.getenv('DRIVE_RATE_BURST', 10))),
+}
+# Longest a call waits for the rate limiter before giving up (seconds)
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', 120))
+# Times a call rejected with 429 is retried after honouring Retry-After
+RATE_LIMIT_RETRIES = int(os.getenv('RATE_LIMIT_RETRIES', 3))
+# Consecutive failures that open a circuit (counted per worker process), and how long it stays open
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_SECONDS = float(os.getenv('CIRCUIT_RESET_SECONDS', 30))
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    paused_until REAL NOT NULL DEFAULT 0
+);
+"""
+
+
+def _conn():
+    return get_connection(RATE_LIMITS_FILE, SCHEMA)
+
+
+class RateLimitTimeout(Exception):
+    """The rate limiter could not grant a slot within the allowed wait"""
+
+
+class CircuitOpenError(Exception):
+    """The API failed repeatedly and calls are being rejected for a while"""
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter shared by every worker process.
+
+    Callers block until a token is free, so a burst is spread out at the
+    configured rate instead of failing. pause() stops all callers until
+    a time given by the API, e.g. from a Retry-After header. The bucket
+    lives in RATE_LIMITS_FILE, so the limit holds for the whole host
+    however many gunicorn workers make calls.
+    """
+
+    def __init__(self, name, rate_per_minute, burst):
+        self.name = name
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(burst, 1)
+
+    def _update(self, change):
+        """
+        Apply change(tokens, paused_until, now) to the stored bucket.
+
+        The bucket is refilled for the time elapsed first; change returns
+        the new (tokens, paused_until) and the value to hand back.
+        """
+        conn = _conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = conn.execute('SELECT tokens, updated, paused_until FROM rate_limits WHERE name = ?',
+                               (self.name,)).fetchone()
+            if row is None:
+                tokens, paused_until = float(self.capacity), 0.0
+            else:
+                elapsed = max(now - row['updated'], 0.0)
+                tokens = min(self.capacity, row['tokens'] + elapsed * self.rate)
+                paused_until = row['paused_until']
+            tokens, paused_until, result = change(tokens, paused_until, now)
+            conn.execute('INSERT OR REPLACE INTO rate_limits (name, tokens, updated, paused_until) '
+                         'VALUES (?, ?, ?, ?)', (self.name, tokens, now, paused_until))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+    def _reserve(self):
+        """Take a token, returning how long the caller must wait for it"""
+        def take(tokens, paused_until, now):
+            # Tokens may go negative: each waiting caller reserves its own future slot
+            tokens -= 1
+            wait = -tokens / self.rate if tokens < 0 else 0.0
+            return tokens, paused_until, max(wait, paused_until - now)
+        return self._update(take)
+
+    def acquire(self, max_wait=RATE_LIMIT_MAX_WAIT):
+        """Block until a request may be made"""
+        wait = self._reserve()
+        if wait > max_wait:
+            self._update(lambda tokens, paused_until, now: (tokens + 1, paused_until, None))
+            raise RateLimitTimeout(f"Rate limiter would wait {wait:.1f}s (limit {max_wait:.0f}s)")
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """Hold back every caller, in every worker, for the given number of seconds"""
+        self._update(lambda tokens, paused_until, now: (tokens, max(paused_until, now + seconds), None))
+
+
+class CircuitBreaker:
+    """
+    Rejects calls for CIRCUIT_RESET_SECONDS after repeated failures.
+
+    Once the timeout has passed a single trial call is let through: success
+    closes the circuit again, failure keeps it open for another period.
+    """
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError if the call must not be made"""
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                logger.info(f"Circuit for {self.name} half-open, trying one call")
+                return
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            raise CircuitOpenError(f"{self.name} is unavailable, retrying in {max(remaining, 0):.0f}s")
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logger.info(f"Circuit for {self.name} closed")
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    logger.error(f"Circuit for {self.name} opened after {self.failures} failure(s)")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+_buckets = {name: TokenBucket(name, rate, burst) for name, (rate, burst) in API_RATE_LIMITS.items()}
+_breakers = {name: CircuitBreaker(name) for name in API_RATE_LIMITS}
+
+
+def get_status_code(error):
+    """HTTP status of an OpenAI, googleapiclient or requests error, if any"""
+    status = getattr(error, 'status_code', None)
+    if status is None and getattr(error, 'resp', None) is not None:
+        status = getattr(error.resp, 'status', None)
+    if status is None and getattr(error, 'response', None) is not None:
+        status = getattr(error.response, 'status_code', None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def get_retry_after(error):
+    """Seconds requested by a Retry-After header, or None"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or getattr(error, 'resp', None)
+    if not headers:
+        return None
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limited(error):
+    """True for 429s and Google's 403 rate limit errors"""
+    status = get_status_code(error)
+    if status == 429:
+        return True
+    if status == 403:
+        content = getattr(error, 'content', b'') or b''
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'ignore')
+        return 'ratelimitexceeded' in content.lower()
+    return False
+
+
+def is_dependency_failure(error):
+    """True if the error means the API itself is unhealthy"""
+    if isinstance(error, (RateLimitTimeout, CircuitOpenError)):
+        return False
+    status = get_status_code(error)
+    # No status: connection error or timeout
+    return status is None or status >= 500
+
+
+def call(api, func, *args, **kwargs):
+    """
+    Call an external API through its rate limiter and circuit breaker.
+
+    Rate limited responses are retried after the delay the API asked for
+    (exponential if it gave none) and pause every other caller of the
+    same API meanwhile, in all workers. Server errors and connection failures count
+    towards opening the circuit; other client errors are raised as is.
+
+    Args:
+        api (str): 'openai', 'gmail' or 'drive'.
+        func (callable): The API call.
+    Returns:
+        Whatever func returns.
+    Raises:
+        CircuitOpenError: The API is failing and the call was not made.
+        RateLimitTimeout: The call would have waited too long for a slot.
+    """
+    bucket = _buckets[api]
+    breaker = _breakers[api]
+    attempt = 0
+    while True:
+        # Wait for the rate limiter first: a half-open breaker lets exactly
+        # one trial call through, which must then be made and resolved
+        waited = bucket.acquire()
+        if waited > 1:
+            logger.info(f"Waited {waited:.1f}s for the {api} rate limiter")
+        breaker.before_call()
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            metrics.observe('external_call_seconds', time.perf_counter() - start, api=api, outcome='error')
+            metrics.inc('errors_total', source=api, reason=get_status_code(e) or type(e).__name__)
+            if is_rate_limited(e) and attempt < RATE_LIMIT_RETRIES:
+                attempt += 1
+                delay = get_retry_after(e)
+                if delay is None:
+                    delay = min(2 ** attempt, 60)
+                logger.warning(f"{api} rate limited, retrying in {delay:.1f}s (attempt {attempt})")
+                bucket.pause(delay)
+                # Count the retry as a success for the breaker: the API is up
+                breaker.record_success()
+                continue
+            if is_dependency_failure(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        metrics.observe('external_call_seconds', time.perf_counter() - start, api=api, outcome='ok')
+        breaker.record_success()
+        return result
+
+
+def get_status():
+    """State of every circuit breaker, e.g. for the admin dashboard"""
+    return {name: {'state': breaker.state, 'failures': breaker.failures}
+            for name, breaker in _breakers.items()}
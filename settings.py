@@ -1,37 +1,173 @@
+import copy
 import json
+import logging
 import os
+import threading
+import time
 from config import CREDIT_CARD_EMAILS, ADDITIONAL_RECIPIENTS
 
-# Use environment variables for settings
-def get_credit_card_emails():
-    """Get credit card email mappings"""
-    env_settings = os.environ.get('APP_SETTINGS')
-    if env_settings:
+logger = logging.getLogger(__name__)
+
+# Settings edited from the admin dashboard, shared by all gunicorn workers.
+# Not shipped with the code: the first save from the dashboard creates it
+SETTINGS_FILE = os.getenv('SETTINGS_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'settings.json'))
+# Shipped defaults (recipients and card mappings), used below APP_SETTINGS
+SETTINGS_EXAMPLE_FILE = os.getenv('SETTINGS_EXAMPLE_FILE',
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'settings.example.json'))
+# Seconds between checks of the settings file for changes
+SETTINGS_CHECK_INTERVAL = float(os.getenv('SETTINGS_CHECK_INTERVAL', 1.0))
+
+DEFAULT_SETTINGS = {
+    'credit_card_emails': CREDIT_CARD_EMAILS,
+    'additional_recipients': ADDITIONAL_RECIPIENTS,
+    # Recipients who get one digest per interval instead of an email per receipt
+    'digest_recipients': [],
+    'settings': {
+        'emails_enabled': True,
+        'zapier_enabled': True
+    }
+}
+
+
+class SettingsStore:
+    """
+    Settings parsed once and held in memory.
+
+    Values are layered: config.py defaults, then the tracked
+    settings.example.json, then the APP_SETTINGS environment variable,
+    then settings.json. A fresh checkout starts from the shipped example,
+    and APP_SETTINGS replaces any of its top-level keys. Once an admin has
+    saved from the dashboard, settings.json's top-level keys take
+    precedence over APP_SETTINGS; a warning names the keys it overrides.
+    Delete settings.json to go back to APP_SETTINGS and the example.
+
+    settings.json is re-read only when its modification time, size or
+    inode changes, and that is checked at most once per
+    SETTINGS_CHECK_INTERVAL, so reads on the request path do no JSON
+    parsing. Every worker sees an admin edit within that interval.
+    """
+
+    def __init__(self, path=SETTINGS_FILE, check_interval=SETTINGS_CHECK_INTERVAL, example_path=SETTINGS_EXAMPLE_FILE):
+        self.path = path
+        self.example_path = example_path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._base = None
+        self._data = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def _file_version(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _load_base(self):
+        """Defaults overlaid with the example file and APP_SETTINGS, parsed once per process"""
+        base = copy.deepcopy(DEFAULT_SETTINGS)
+        if self.example_path:
+            try:
+                with open(self.example_path, 'r') as f:
+                    base.update(json.load(f))
+            except FileNotFoundError:
+                pass
+            except (OSError, json.JSONDecodeError) as e:
+                logger.error(f"Error reading {self.example_path}: {str(e)}")
+        env_settings = os.environ.get('APP_SETTINGS')
+        if env_settings:
+            try:
+                base.update(json.loads(env_settings))
+            except json.JSONDecodeError:
+                pass
+        return base
+
+    def _reload(self, version):
+        if self._base is None:
+            self._base = self._load_base()
+        data = copy.deepcopy(self._base)
+        if version is not None:
+            try:
+                with open(self.path, 'r') as f:
+                    file_settings = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                # Keep serving the last good settings while the file is unreadable
+                if self._data is not None:
+                    return
+            else:
+                data.update(file_settings)
+                self._warn_overrides(file_settings)
+        self._data = data
+        self._version = version
+
+    def _warn_overrides(self, file_settings):
+        """Log the APP_SETTINGS keys that the settings file replaces"""
         try:
-            settings = json.loads(env_settings)
-            return settings.get('credit_card_emails', CREDIT_CARD_EMAILS)
+            env_settings = json.loads(os.environ.get('APP_SETTINGS') or '{}')
         except json.JSONDecodeError:
-            return CREDIT_CARD_EMAILS
-    return CREDIT_CARD_EMAILS
+            return
+        overridden = sorted(key for key in file_settings
+                            if key in env_settings and env_settings[key] != file_settings[key])
+        if overridden:
+            logger.warning(f"{self.path} overrides APP_SETTINGS for: {', '.join(overridden)}")
+
+    def get(self):
+        """Current settings; treat the returned dict as read-only"""
+        now = time.monotonic()
+        if self._data is None or now - self._checked_at >= self.check_interval:
+            with self._lock:
+                if self._data is None or now - self._checked_at >= self.check_interval:
+                    version = self._file_version()
+                    if self._data is None or version != self._version:
+                        self._reload(version)
+                    self._checked_at = now
+        return self._data
+
+    def save(self, data):
+        """Write settings atomically and make them visible immediately"""
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(temp_path, self.path)
+        with self._lock:
+            self._reload(self._file_version())
+            self._checked_at = time.monotonic()
+
+
+settings_store = SettingsStore()
+
+
+def load_all_settings():
+    """Copy of the full settings document, safe to modify"""
+    return copy.deepcopy(settings_store.get())
+
+
+def save_all_settings(data):
+    """Persist the full settings document"""
+    settings_store.save(data)
+
+
+def get_credit_card_emails():
+    """Get credit card email mappings"""
+    return settings_store.get().get('credit_card_emails', CREDIT_CARD_EMAILS)
+
 
 def get_additional_recipients():
     """Get additional recipients list"""
-    env_settings = os.environ.get('APP_SETTINGS')
-    if env_settings:
-        try:
-            settings = json.loads(env_settings)
-            return settings.get('additional_recipients', ADDITIONAL_RECIPIENTS)
-        except json.JSONDecodeError:
-            return ADDITIONAL_RECIPIENTS
-    return ADDITIONAL_RECIPIENTS
+    return settings_store.get().get('additional_recipients', ADDITIONAL_RECIPIENTS)
+
+
+def get_digest_recipients():
+    """Recipients in digest mode"""
+    return settings_store.get().get('digest_recipients', [])
+
+
+def get_delivery_mode(recipient):
+    """'digest' or 'immediate' (the default) for a recipient"""
+    return 'digest' if recipient in get_digest_recipients() else 'immediate'
+
 
 def get_settings():
     """Get system settings"""
-    env_settings = os.environ.get('APP_SETTINGS')
-    if env_settings:
-        try:
-            settings = json.loads(env_settings)
-            return settings.get('settings', {'emails_enabled': True, 'zapier_enabled': True})
-        except json.JSONDecodeError:
-            return {'emails_enabled': True, 'zapier_enabled': True}
-    return {'emails_enabled': True, 'zapier_enabled': True}
+    return settings_store.get().get('settings', DEFAULT_SETTINGS['settings'])
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# Module-level settings are read at import, so point them away from the
+# project's data/ and logs/ before any app module is imported
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='receipts-tests-'))
+os.environ.setdefault('LOG_FILES_ENABLED', 'false')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,148 @@
+import os
+import time
+import pytest
+import digest
+
+RECIPIENT = 'finance@example.com'
+
+# The background flusher looks this up on every round; keep the real one for the tests
+flush_due = digest.flush_due
+
+
+@pytest.fixture
+def sent(tmp_path, monkeypatch):
+    """Digests accepted by a fake Gmail, as (recipient, filenames)"""
+    monkeypatch.setattr(digest, 'DIGEST_STORE_FILE', str(tmp_path / 'digest.db'))
+    monkeypatch.setattr(digest, 'DIGEST_SPOOL_DIR', str(tmp_path / 'spool'))
+    monkeypatch.setattr(digest, 'start_flusher', lambda: None)
+    monkeypatch.setattr(digest, 'flush_due', lambda: None)
+    monkeypatch.setattr(digest, 'get_settings', lambda: {'emails_enabled': True})
+    digests = []
+
+    def send_digest(recipient, items):
+        digests.append((recipient, [item['filename'] for item in items]))
+        return True
+
+    monkeypatch.setattr(digest, 'send_digest', send_digest)
+    return digests
+
+
+@pytest.fixture
+def receipt(tmp_path):
+    def make(name='receipt.pdf', size=10):
+        path = tmp_path / name
+        path.write_bytes(b'x' * size)
+        return str(path)
+    return make
+
+
+def rows():
+    return [dict(row) for row in digest._conn().execute('SELECT * FROM digest_items ORDER BY id')]
+
+
+def summary(vendor='Shop'):
+    return {'user_name': 'Ann', 'credit_card': '1234', 'expense_reason': 'Lunch',
+            'analysis': {'vendor': vendor, 'amount': '12.50'}}
+
+
+def test_queued_receipt_is_spooled(sent, receipt):
+    path = receipt()
+    digest.queue_receipt(RECIPIENT, summary(), path, 'receipt.pdf')
+    os.remove(path)
+    item, = rows()
+    assert item['claimed_by'] is None
+    assert item['file_size'] == 10
+    assert os.path.exists(item['attachment_path'])
+    assert digest.pending_digests()[0]['receipts'] == 1
+    assert sent == []
+
+
+def test_due_after_interval(sent, receipt, monkeypatch):
+    monkeypatch.setattr(digest, 'DIGEST_INTERVAL_MINUTES', 60)
+    digest.queue_receipt(RECIPIENT, summary(), receipt(), 'receipt.pdf')
+    assert digest.due_recipients() == []
+    assert digest.due_recipients(now=time.time() + 3601) == [RECIPIENT]
+
+    digest._conn().execute('UPDATE digest_items SET created_at = created_at - 3601')
+    flush_due()
+    assert sent == [(RECIPIENT, ['receipt.pdf'])]
+
+
+def test_claim_respects_batch_limits(sent, receipt, monkeypatch):
+    monkeypatch.setattr(digest, 'DIGEST_MAX_RECEIPTS', 3)
+    monkeypatch.setattr(digest, 'DIGEST_MAX_BYTES', 25)
+    for index, size in enumerate((10, 10, 10, 40)):
+        digest._conn().execute(
+            'INSERT INTO digest_items (recipient, summary, attachment_path, filename, file_size, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)', (RECIPIENT, '{}', receipt(f'{index}.pdf', size), f'{index}.pdf', size, 0))
+
+    assert [item['filename'] for item in digest._claim(RECIPIENT)] == ['0.pdf', '1.pdf']
+    # A file over the byte limit still goes, on its own
+    assert [item['filename'] for item in digest._claim(RECIPIENT)] == ['2.pdf']
+    assert [item['filename'] for item in digest._claim(RECIPIENT)] == ['3.pdf']
+    assert digest._claim(RECIPIENT) == []
+
+
+def test_stale_claim_is_released(sent, receipt):
+    digest.queue_receipt(RECIPIENT, summary(), receipt(), 'receipt.pdf')
+    assert digest._claim(RECIPIENT)
+    assert digest._claim(RECIPIENT) == []
+    # The worker that claimed the receipt died before sending it
+    digest._conn().execute('UPDATE digest_items SET claimed_at = ?', (time.time() - digest.DIGEST_CLAIM_TIMEOUT - 1,))
+    assert len(digest._claim(RECIPIENT)) == 1
+
+
+def test_flush_sends_and_removes(sent, receipt, monkeypatch):
+    for name in ('a.pdf', 'b.pdf', 'c.pdf'):
+        digest.queue_receipt(RECIPIENT, summary(), receipt(name), name)
+    monkeypatch.setattr(digest, 'DIGEST_MAX_RECEIPTS', 2)
+    spooled = [item['attachment_path'] for item in rows()]
+    assert digest.flush_all() == 3
+    assert sent == [(RECIPIENT, ['a.pdf', 'b.pdf']), (RECIPIENT, ['c.pdf'])]
+    assert rows() == []
+    assert not any(os.path.exists(path) for path in spooled)
+
+
+@pytest.mark.parametrize('failure', [False, ConnectionError('Gmail is down')])
+def test_failed_digest_stays_queued(sent, receipt, monkeypatch, failure):
+    def send_digest(recipient, items):
+        if isinstance(failure, Exception):
+            raise failure
+        return failure
+
+    monkeypatch.setattr(digest, 'send_digest', send_digest)
+    digest.queue_receipt(RECIPIENT, summary(), receipt(), 'receipt.pdf')
+    assert digest.flush_recipient(RECIPIENT) == 0
+    item, = rows()
+    assert item['claimed_by'] is None
+    assert os.path.exists(item['attachment_path'])
+    # Retried on the next flush
+    monkeypatch.setattr(digest, 'send_digest', lambda recipient, items: True)
+    assert digest.flush_recipient(RECIPIENT) == 1
+
+
+def test_threshold_sends_right_away(sent, receipt, monkeypatch):
+    monkeypatch.setattr(digest, 'DIGEST_MAX_RECEIPTS', 2)
+    digest.queue_receipt(RECIPIENT, summary('A'), receipt('a.pdf'), 'a.pdf')
+    assert sent == []
+    digest.queue_receipt(RECIPIENT, summary('B'), receipt('b.pdf'), 'b.pdf')
+    assert sent == [(RECIPIENT, ['a.pdf', 'b.pdf'])]
+    assert rows() == []
+
+
+def test_nothing_sent_while_emails_disabled(sent, receipt, monkeypatch):
+    monkeypatch.setattr(digest, 'get_settings', lambda: {'emails_enabled': False})
+    digest.queue_receipt(RECIPIENT, summary(), receipt(), 'receipt.pdf')
+    assert digest.flush_all() == 0
+    assert sent == []
+    assert len(rows()) == 1
+
+
+def test_digest_body_lists_each_receipt():
+    items = [{'summary': '{"analysis": {"vendor": "A"}, "drive_link": "https://drive/a"}', 'filename': 'a.pdf'},
+             {'summary': '{"user_name": "Bob"}', 'filename': 'b.pdf'}]
+    body = digest.format_digest_body(items)
+    assert body.startswith('2 invoice(s)')
+    assert '1. A - Invoice N/A' in body
+    assert 'Google Drive: https://drive/a' in body
+    assert 'User: Bob' in body
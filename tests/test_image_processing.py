@@ -0,0 +1,104 @@
+import os
+import sys
+import shutil
+import subprocess
+import textwrap
+import pytest
+from PIL import Image
+import image_processing
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stand-ins for poppler's tools: pdfinfo reports 5 pages and pdftoppm
+# prints one small PPM (PGM with -gray) per requested page
+FAKE_PDFINFO = """
+print('Pages:          5')
+"""
+FAKE_PDFTOPPM = """
+import sys
+args = sys.argv[1:]
+first, last = int(args[args.index('-f') + 1]), int(args[args.index('-l') + 1])
+gray = '-gray' in args
+for page in range(first, last + 1):
+    header = b'P5\\n4 3\\n255\\n' if gray else b'P6\\n4 3\\n255\\n'
+    sys.stdout.buffer.write(header + bytes([page]) * (12 if gray else 36))
+"""
+
+
+@pytest.fixture
+def fake_poppler(tmp_path):
+    for name, source in (('pdfinfo', FAKE_PDFINFO), ('pdftoppm', FAKE_PDFTOPPM)):
+        path = tmp_path / name
+        path.write_text(f'#!{sys.executable}\n{textwrap.dedent(source)}')
+        path.chmod(0o755)
+    return str(tmp_path)
+
+
+def run_under_gevent(source, poppler_path, tmp_path):
+    script = textwrap.dedent("""
+        from gevent import monkey; monkey.patch_all()
+        import image_processing
+        image_processing.POPPLER_PATH = {poppler_path!r}
+    """).format(poppler_path=poppler_path) + textwrap.dedent(source)
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, LOG_FILES_ENABLED='false', DATA_DIR=str(tmp_path))
+    return subprocess.run([sys.executable, '-c', script], cwd=tmp_path, env=env,
+                          capture_output=True, text=True, timeout=60)
+
+
+@pytest.mark.parametrize('last_page, parts, expected', [
+    (1, 4, [(1, 1)]),
+    (5, 1, [(1, 5)]),
+    (5, 4, [(1, 2), (3, 3), (4, 4), (5, 5)]),
+    (8, 4, [(1, 2), (3, 4), (5, 6), (7, 8)]),
+    (3, 0, [(1, 3)]),
+])
+def test_split_page_range(last_page, parts, expected):
+    assert image_processing.split_page_range(last_page, parts) == expected
+
+
+def test_render_pdf_pages(fake_poppler, monkeypatch):
+    monkeypatch.setattr(image_processing, 'POPPLER_PATH', fake_poppler)
+    pages = image_processing.render_pdf_pages('receipt.pdf', max_pages=5)
+    assert [page.getpixel((0, 0)) for page in pages] == [(n, n, n) for n in range(1, 6)]
+    gray = image_processing.render_pdf_pages(b'%PDF-1.4', max_pages=2, grayscale=True)
+    assert [page.mode for page in gray] == ['L', 'L']
+
+
+def test_render_failure_is_raised(tmp_path, monkeypatch):
+    failing = tmp_path / 'pdftoppm'
+    failing.write_text('#!/bin/sh\necho "Syntax Error" >&2\nexit 1\n')
+    failing.chmod(0o755)
+    monkeypatch.setattr(image_processing, 'POPPLER_PATH', str(tmp_path))
+    with pytest.raises(RuntimeError, match='Syntax Error'):
+        image_processing.render_pdf_pages('broken.pdf', max_pages=1)
+
+
+def test_render_under_gevent(fake_poppler, tmp_path):
+    pytest.importorskip('gevent')
+    # pdftoppm started on one of gevent's native threads fails with
+    # "child watchers are only available on the default loop"
+    result = run_under_gevent("""
+        import gevent
+        jobs = [gevent.spawn(image_processing.render_pdf_pages, 'receipt.pdf', max_pages=5) for _ in range(3)]
+        gevent.joinall(jobs, raise_error=True)
+        print([len(job.value) for job in jobs])
+    """, fake_poppler, tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '[5, 5, 5]'
+
+
+@pytest.mark.skipif(shutil.which('pdftoppm') is None, reason='poppler-utils is not installed')
+def test_render_real_pdf_under_gevent(tmp_path):
+    pytest.importorskip('gevent')
+    pdf_path = tmp_path / 'two_pages.pdf'
+    first, second = Image.new('RGB', (200, 100), 'white'), Image.new('RGB', (200, 100), 'black')
+    first.save(pdf_path, 'PDF', resolution=72, save_all=True, append_images=[second])
+    poppler_path = os.path.dirname(shutil.which('pdftoppm'))
+    result = run_under_gevent(f"""
+        pages = image_processing.render_pdf_pages({str(pdf_path)!r}, max_pages=2, dpi=72)
+        with open({str(pdf_path)!r}, 'rb') as f:
+            in_memory = image_processing.render_pdf_pages(f.read(), max_pages=2, dpi=72)
+        print(len(pages), pages[0].size, len(in_memory))
+    """, poppler_path, tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '2 (200, 100) 2'
@@ -0,0 +1,79 @@
+import os
+import threading
+import pytest
+from jobs import JobQueue
+
+for var in ('ADMIN_USERNAME', 'ADMIN_PASSWORD', 'OPENAI_API_KEY', 'GMAIL_SENDER_EMAIL'):
+    os.environ.setdefault(var, 'test')
+for var in ('APP_SETTINGS', 'GOOGLE_CREDENTIALS'):
+    os.environ.setdefault(var, '{}')
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app_module, '_sse_slots', threading.BoundedSemaphore(1))
+    return app_module.app.test_client()
+
+
+def finished_job(queue):
+    def run(job):
+        job.start_stage('analysis')
+        job.finish_stage('analysis')
+        return {'vendor': 'Shop'}
+    return queue.run_job(queue.create(run, stages=('analysis',)))
+
+
+def read_stream(client, job_id, **headers):
+    response = client.get(f'/jobs/{job_id}/events', headers=headers)
+    body = response.get_data(as_text=True)
+    response.close()
+    return response, body
+
+
+def test_stream_of_a_job_run_by_another_worker(client):
+    job = finished_job(JobQueue())
+    response, body = read_stream(client, job.id)
+    assert response.status_code == 200
+    assert body.rstrip().endswith('data: {"vendor": "Shop"}')
+    assert 'event: stage' in body
+
+
+def test_stream_resumes_after_last_event_id(client):
+    job = finished_job(JobQueue())
+    _, body = read_stream(client, job.id, **{'Last-Event-ID': '2'})
+    assert 'event: stage' not in body
+    assert 'event: result' in body
+
+
+def test_slot_is_released_when_stream_closes(client):
+    job = finished_job(app_module.job_queue)
+    for _ in range(3):
+        response, _ = read_stream(client, job.id)
+        assert response.status_code == 200
+
+
+def test_refused_without_a_free_slot(client):
+    app_module._sse_slots.acquire()
+    job = finished_job(app_module.job_queue)
+    response, _ = read_stream(client, job.id)
+    assert response.status_code == 503
+    assert response.headers['Retry-After']
+    assert response.get_json()['status_url'] == f'/jobs/{job.id}'
+
+
+def test_stream_ends_after_max_seconds(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'SSE_MAX_SECONDS', 0.2)
+    job = app_module.job_queue.create(lambda job: None)
+    response, body = read_stream(client, job.id)
+    assert response.status_code == 200
+    assert body.startswith(': connected')
+    assert 'event: result' not in body
+    # The stream's slot was given back
+    assert read_stream(client, job.id)[0].status_code == 200
+
+
+def test_unknown_job(client):
+    assert client.get('/jobs/missing').status_code == 404
+    assert client.get('/jobs/missing/events').status_code == 404
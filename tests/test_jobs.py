@@ -0,0 +1,114 @@
+import json
+import time
+import pytest
+import jobs
+from jobs import JobQueue, StoredJob
+
+
+@pytest.fixture(autouse=True)
+def job_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, 'JOBS_FILE', str(tmp_path / 'jobs.db'))
+    monkeypatch.setattr(jobs, 'JOB_POLL_SECONDS', 0.01)
+
+
+def analyse(job, text):
+    job.start_stage('analysis')
+    job.emit('delta', {'text': text[:2]})
+    job.emit('route', {'route': 'text'})
+    job.finish_stage('analysis')
+    return {'vendor': text}
+
+
+def fail(job):
+    raise ValueError('bad receipt')
+
+
+def test_other_worker_sees_finished_job():
+    worker, other_worker = JobQueue(num_workers=1), JobQueue(num_workers=1)
+    job = worker.run_job(worker.create(analyse, 'Shop', stages=('saved', 'analysis')))
+
+    stored = other_worker.get(job.id)
+    assert isinstance(stored, StoredJob)
+    assert stored.done
+    assert stored.to_dict() == json.loads(json.dumps(job.to_dict()))
+    assert stored.to_dict()['result'] == {'vendor': 'Shop'}
+
+
+def test_stored_events_keep_ids_and_skip_model_output():
+    worker = JobQueue(num_workers=1)
+    job = worker.run_job(worker.create(analyse, 'Shop', stages=('analysis',)))
+
+    stored = JobQueue().get(job.id)
+    events = stored.wait_for_events(0, timeout=1)
+    assert [event for _, event, _ in events] == ['stage', 'route', 'stage', 'result']
+    assert [event_id for event_id, _, _ in events] == [1, 3, 4, 5]
+    assert [(i, e, d) for i, e, d in job.events if e != 'delta'] == events
+    # Resuming after Last-Event-ID only returns what came after it
+    assert stored.wait_for_events(3, timeout=1) == events[2:]
+
+
+def test_failed_job_is_stored():
+    worker = JobQueue(num_workers=1)
+    job = worker.run_job(worker.create(fail))
+    stored = JobQueue().get(job.id)
+    assert stored.status == 'failed'
+    assert stored.to_dict()['error'] == 'bad receipt'
+    assert stored.wait_for_events(0, timeout=1)[-1][1:] == ('error', {'error': 'bad receipt'})
+
+
+def test_waiting_on_a_running_job_sees_new_events():
+    worker = JobQueue(num_workers=1)
+    job = worker.create(analyse, 'Shop', stages=('analysis',))
+    stored = JobQueue().get(job.id)
+    assert not stored.done
+    assert stored.wait_for_events(0, timeout=0.05) == []
+    worker.run_job(job)
+    assert stored.wait_for_events(0, timeout=1)
+    assert stored.done
+
+
+def test_batch_lists_its_children():
+    worker = JobQueue(num_workers=1)
+    children = [worker.create(analyse, name, stages=('analysis',)) for name in ('A', 'B')]
+    batch = worker.create(lambda job: [worker.run_job(child) for child in children] and None)
+    batch.children = children
+    worker.enqueue(batch)
+    for _ in range(200):
+        if batch.done:
+            break
+        time.sleep(0.01)
+    stored = JobQueue().get(batch.id)
+    assert [child['result'] for child in stored.to_dict()['jobs']] == [{'vendor': 'A'}, {'vendor': 'B'}]
+
+
+def test_job_of_a_dead_worker_is_reported_failed(monkeypatch):
+    worker = JobQueue(num_workers=1)
+    job = worker.create(analyse, 'Shop', stages=('analysis',))
+    # The worker stops sending heartbeats
+    monkeypatch.setattr(jobs, 'JOB_STALE_SECONDS', 0)
+    stored = JobQueue().get(job.id)
+    assert stored.status == 'failed'
+    assert 'stopped' in stored.to_dict()['error']
+    assert stored.wait_for_events(0, timeout=1)[-1][1] == 'error'
+
+
+def test_heartbeat_keeps_unfinished_jobs_alive(monkeypatch):
+    worker = JobQueue(num_workers=1)
+    job = worker.create(analyse, 'Shop', stages=('analysis',))
+    jobs._conn().execute('UPDATE jobs SET heartbeat_at = 0 WHERE id = ?', (job.id,))
+    jobs.heartbeat()
+    assert not JobQueue().get(job.id).done
+
+
+def test_unknown_job():
+    assert JobQueue().get('missing') is None
+
+
+def test_prune_removes_old_jobs():
+    worker = JobQueue(num_workers=1)
+    job = worker.run_job(worker.create(analyse, 'Shop'))
+    jobs.prune_stored_jobs(retention=3600)
+    assert JobQueue().get(job.id) is not None
+    jobs.prune_stored_jobs(retention=-1)
+    assert JobQueue().get(job.id) is None
+    assert jobs.load_events(job.id, 0) == []
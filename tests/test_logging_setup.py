@@ -0,0 +1,79 @@
+import os
+import sys
+import logging
+import subprocess
+import textwrap
+import pytest
+import logging_setup
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_script(source, tmp_path):
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, LOG_FILES_ENABLED='false')
+    return subprocess.run([sys.executable, '-c', textwrap.dedent(source)], cwd=tmp_path, env=env,
+                          capture_output=True, text=True, timeout=60)
+
+
+def test_forked_child_logs_through_its_own_listener(tmp_path):
+    result = run_script("""
+        import os, logging, threading, logging_setup
+        logging_setup.setup_logging(log_format='text')
+        log = logging.getLogger('t')
+        pid = os.fork()
+        if pid == 0:
+            # Nothing is started by the fork itself
+            started = [t.name for t in threading.enumerate() if t is not threading.main_thread()]
+            log.info(f'threads before logging: {started}')
+            logging_setup.stop_logging()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        log.info('parent still logs')
+    """, tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert 'threads before logging: []' in result.stdout
+    assert 'parent still logs' in result.stdout
+
+
+def test_subprocess_under_gevent_does_not_run_parent_greenlets(tmp_path):
+    pytest.importorskip('gevent')
+    # A fork hook that starts a thread lets gevent switch to the parent's
+    # greenlets in the child between fork and exec
+    result = run_script("""
+        from gevent import monkey; monkey.patch_all()
+        import os, subprocess, gevent, logging_setup
+        logging_setup.setup_logging(log_format='text')
+        parent = os.getpid()
+        def busy():
+            while True:
+                if os.getpid() != parent:
+                    os.write(2, b'greenlet ran in child\\n')
+                gevent.sleep(0.001)
+        gevent.spawn(busy)
+        gevent.sleep(0.01)
+        for _ in range(5):
+            try:
+                subprocess.run(['/nonexistent-binary'])
+            except FileNotFoundError:
+                pass
+        print('done')
+    """, tmp_path)
+    assert 'done' in result.stdout, result.stderr
+    assert 'greenlet ran in child' not in result.stderr
+
+
+def test_request_context_tags_records():
+    record = logging.LogRecord('t', logging.INFO, __file__, 1, 'message', None, None)
+    with logging_setup.request_context('abc123'):
+        assert logging_setup.ContextFilter().filter(record)
+    assert record.request_id == 'abc123'
+    assert logging_setup.request_id_var.get() == '-'
+
+
+@pytest.mark.parametrize('rate, expected', [(1.0, True), (0.0, False)])
+def test_is_sampled_extremes(rate, expected):
+    assert logging_setup.is_sampled('any-id', rate) is expected
+
+
+def test_is_sampled_is_stable_per_id():
+    assert len({logging_setup.is_sampled('job-42', 0.5) for _ in range(10)}) == 1
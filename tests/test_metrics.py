@@ -0,0 +1,127 @@
+import os
+import math
+import threading
+import pytest
+import metrics
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """An empty metrics database and no pending deltas"""
+    monkeypatch.setattr(metrics, 'METRICS_FILE', str(tmp_path / 'metrics.db'))
+    monkeypatch.setattr(metrics, 'METRICS_ENABLED', True)
+    monkeypatch.setattr(metrics, '_pending', {})
+
+
+def buckets(*pairs):
+    return list(pairs) + [(math.inf, pairs[-1][1])]
+
+
+@pytest.mark.parametrize('quantile, expected', [
+    (0.5, 1.0),
+    (0.25, 0.5),
+    (0.75, 1.5),
+    (1.0, 2.0),
+])
+def test_estimate_quantile_interpolates(quantile, expected):
+    # 2 values in (0, 1], 2 in (1, 2]
+    assert metrics.estimate_quantile(buckets((1, 2), (2, 4)), quantile) == pytest.approx(expected)
+
+
+def test_estimate_quantile_empty():
+    assert metrics.estimate_quantile(buckets((1, 0), (2, 0)), 0.5) is None
+
+
+def test_estimate_quantile_above_last_bound():
+    assert metrics.estimate_quantile([(1, 0), (2, 0), (math.inf, 3)], 0.99) == 2
+
+
+def test_observe_does_not_write_until_flushed(store):
+    metrics.observe('stage_seconds', 0.3, stage='email')
+    assert not os.path.exists(metrics.METRICS_FILE)
+    metrics.flush()
+    assert os.path.exists(metrics.METRICS_FILE)
+
+
+def test_flush_runs_on_background_thread(store, monkeypatch):
+    monkeypatch.setattr(metrics, '_flusher_pid', None)
+    monkeypatch.setattr(metrics, 'METRICS_FLUSH_SECONDS', 0.01)
+    flushed_by = []
+    flushed = threading.Event()
+
+    def fake_flush():
+        flushed_by.append(threading.current_thread().name)
+        flushed.set()
+
+    monkeypatch.setattr(metrics, 'flush', fake_flush)
+    metrics.inc('jobs_total', status='completed')
+    assert flushed.wait(5)
+    assert set(flushed_by) == {'metrics-flusher'}
+    assert metrics._flusher_pid == os.getpid()
+
+
+def test_render_prometheus(store):
+    metrics.inc('jobs_total', status='completed')
+    metrics.inc('jobs_total', 2, status='completed')
+    for value in (0.003, 0.3, 200):
+        metrics.observe('external_call_seconds', value, api='openai', outcome='ok')
+    lines = metrics.render_prometheus().splitlines()
+
+    assert '# TYPE receipts_jobs_total counter' in lines
+    assert 'receipts_jobs_total{status="completed"} 3' in lines
+    assert '# TYPE receipts_external_call_seconds histogram' in lines
+    labels = 'api="openai",outcome="ok"'
+    assert f'receipts_external_call_seconds_bucket{{{labels},le="0.005"}} 1' in lines
+    assert f'receipts_external_call_seconds_bucket{{{labels},le="0.25"}} 1' in lines
+    assert f'receipts_external_call_seconds_bucket{{{labels},le="0.5"}} 2' in lines
+    assert f'receipts_external_call_seconds_bucket{{{labels},le="120"}} 2' in lines
+    assert f'receipts_external_call_seconds_bucket{{{labels},le="+Inf"}} 3' in lines
+    assert f'receipts_external_call_seconds_count{{{labels}}} 3' in lines
+    assert f'receipts_external_call_seconds_sum{{{labels}}} 200.303' in lines
+
+
+def test_label_values_are_escaped(store):
+    metrics.inc('errors_total', source='analysis', reason='bad "json"\n')
+    assert 'reason="bad \\"json\\"\\n"' in metrics.render_prometheus()
+
+
+def test_percentiles_for_dashboard(store):
+    for _ in range(99):
+        metrics.observe('stage_seconds', 0.2, stage='analysis')
+    metrics.observe('stage_seconds', 50, stage='analysis')
+    summary, = metrics.get_dashboard()['histograms']['stage_seconds']
+    assert summary['labels'] == 'stage=analysis'
+    assert summary['count'] == 100
+    assert 0.1 < summary['p50'] <= 0.25
+    assert summary['p99'] <= 0.25
+    assert summary['mean'] == pytest.approx((99 * 0.2 + 50) / 100)
+
+
+@pytest.fixture
+def app_module(store):
+    for var in ('ADMIN_USERNAME', 'ADMIN_PASSWORD', 'OPENAI_API_KEY', 'GMAIL_SENDER_EMAIL'):
+        os.environ.setdefault(var, 'test')
+    for var in ('APP_SETTINGS', 'GOOGLE_CREDENTIALS'):
+        os.environ.setdefault(var, '{}')
+    import app
+    return app
+
+
+def test_metrics_endpoint_needs_token_or_admin(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'METRICS_TOKEN', 'secret')
+    client = app_module.app.test_client()
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+    with client.session_transaction() as session:
+        session['admin_logged_in'] = True
+    assert client.get('/metrics').status_code == 200
+
+
+def test_metrics_endpoint_closed_without_token(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'METRICS_TOKEN', None)
+    client = app_module.app.test_client()
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer '}).status_code == 401
+    monkeypatch.setattr(app_module, 'METRICS_PUBLIC', True)
+    assert client.get('/metrics').status_code == 200
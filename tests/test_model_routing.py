@@ -0,0 +1,79 @@
+import json
+from datetime import datetime
+import pytest
+from model_routing import parse_date, parse_amount, check_result
+
+JAN_15 = datetime(2024, 1, 15)
+
+
+@pytest.mark.parametrize('value', [
+    '2024-01-15',
+    '01/15/2024',
+    '01/15/24',
+    '15/01/2024',
+    '01-15-2024',
+    '2024/01/15',
+    '2024.01.15',
+    '15.01.2024',
+    '15-Jan-2024',
+    '15-JAN-2024',
+    '15-January-2024',
+    '15-Jan-24',
+    'January 15, 2024',
+    'Jan 15, 2024',
+    'Jan. 15, 2024',
+    'Jan 15,2024',
+    '15 January 2024',
+    '15 Jan 2024',
+    'January 15 2024',
+    'Monday, January 15, 2024',
+    'Mon, Jan 15, 2024',
+    '  Jan   15,  2024 ',
+])
+def test_parse_date_formats(value):
+    assert parse_date(value) == JAN_15
+
+
+@pytest.mark.parametrize('value', [
+    '2024-01-15 14:32',
+    '2024-01-15 14:32:00',
+    '2024-01-15T14:32:00',
+    '2024-01-15T14:32:00Z',
+    '2024-01-15T14:32:00.123+00:00',
+    '01/15/2024 14:32',
+    '01/15/2024 14:32:00',
+    '01/15/2024 2:32 PM',
+    '01/15/2024 2:32:05 pm',
+    '01/15/2024 2:32 p.m.',
+    'Jan 15, 2024 2:32 PM EST',
+    'Jan 15, 2024, 14:32',
+    'January 15, 2024 at 2:32 PM',
+    '15-Jan-2024 14:32:00',
+])
+def test_parse_date_ignores_time_of_day(value):
+    assert parse_date(value) == JAN_15
+
+
+@pytest.mark.parametrize('value', ['', 'N/A', 'yesterday', '2024-13-45', '14:32', '15 Foo 2024'])
+def test_parse_date_rejects(value):
+    assert parse_date(value) is None
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('12.50', 12.5),
+    ('$1,234.56', 1234.56),
+    ('USD 99', 99.0),
+    ('-5.00', -5.0),
+    ('free', None),
+])
+def test_parse_amount(value, expected):
+    assert parse_amount(value) == expected
+
+
+def test_check_result_accepts_date_with_time():
+    result = dict.fromkeys(['invoice_number', 'date', 'amount', 'customer_name', 'vendor', 'credit_card',
+                            'description_of_items_or_services', 'billing_address', 'payment_method'], 'N/A')
+    result.update(invoice_number='A-1', date='2024-01-15 14:32:00', amount='12.50', vendor='Shop')
+    problems, confidence = check_result(json.dumps(result))
+    assert 'bad_date' not in problems
+    assert confidence == 1.0
@@ -0,0 +1,83 @@
+import os
+import json
+import pytest
+import jobs
+from jobs import JobQueue
+from receipt_file import ReceiptFile
+
+for var in ('ADMIN_USERNAME', 'ADMIN_PASSWORD', 'OPENAI_API_KEY', 'GMAIL_SENDER_EMAIL'):
+    os.environ.setdefault(var, 'test')
+for var in ('APP_SETTINGS', 'GOOGLE_CREDENTIALS'):
+    os.environ.setdefault(var, '{}')
+
+import app as app_module  # noqa: E402
+
+ANALYSIS = json.dumps({'invoice_number': 'INV-1', 'vendor': 'Shop', 'amount': '12.50'})
+
+
+@pytest.fixture
+def calls(tmp_path, monkeypatch):
+    """Emails sent and webhooks queued by the pipeline"""
+    monkeypatch.setattr(jobs, 'JOBS_FILE', str(tmp_path / 'jobs.db'))
+    monkeypatch.setenv('ZAPIER_WEBHOOK_URL', 'https://hooks.example.com/catch/1')
+    monkeypatch.setattr(app_module, 'get_delivery_mode', lambda recipient: 'immediate')
+    monkeypatch.setattr(app_module, 'upload_file_to_drive', lambda receipt, filename: 'drive-id')
+    monkeypatch.setattr(app_module, 'analyze_image', lambda receipt, progress=None: (ANALYSIS, receipt))
+    recorded = {'email': [], 'zapier': []}
+    monkeypatch.setattr(app_module, 'send_email',
+                        lambda recipient, subject, *args, **kwargs: recorded['email'].append(subject) or True)
+    monkeypatch.setattr(app_module, 'enqueue_webhook',
+                        lambda url, payload: recorded['zapier'].append(payload) or 1)
+    return recorded
+
+
+def process(emails_enabled=True):
+    queue = JobQueue(num_workers=1)
+    receipt = ReceiptFile('receipt.pdf', data=b'%PDF-1.4')
+    job = queue.create(app_module.process_receipt, receipt, 'receipt.pdf', '1234', 'Lunch', 'Ann',
+                       'finance@example.com', emails_enabled, True,
+                       stages=('drive_upload', 'analysis', 'email', 'zapier'))
+    return queue.run_job(job)
+
+
+def stage_events(job):
+    return [(data['name'], data['status']) for _, event, data in job.events if event == 'stage']
+
+
+def test_receipt_is_emailed_and_queued_for_zapier(calls):
+    job = process()
+    assert job.status == 'completed'
+    assert calls['email'] == ['Expense Receipt - INV-1 - Shop']
+    assert calls['zapier'][0]['vendor'] == 'Shop'
+    assert job.stages['zapier']['detail'] == 'Queued for delivery'
+    # Every stage finishes once
+    finished = [stage for stage, status in stage_events(job) if status == 'completed']
+    assert sorted(finished) == ['analysis', 'drive_upload', 'email', 'zapier']
+
+
+def test_failed_analysis_sends_nothing(calls, monkeypatch):
+    monkeypatch.setattr(app_module, 'analyze_image',
+                        lambda receipt, progress=None: ('Error analyzing image: boom', receipt))
+    job = process()
+    assert job.status == 'failed'
+    assert 'Error analyzing image: boom' in job.error
+    assert job.stages['analysis']['status'] == 'failed'
+    assert calls == {'email': [], 'zapier': []}
+
+
+def test_failed_email_fails_the_job(calls, monkeypatch):
+    monkeypatch.setattr(app_module, 'send_email', lambda *args, **kwargs: False)
+    job = process()
+    assert job.status == 'failed'
+    assert job.error == 'Failed to send email'
+    assert [status for stage, status in stage_events(job) if stage == 'email'] == ['running', 'failed']
+
+
+def test_digest_stage_finishes_once(calls, monkeypatch):
+    monkeypatch.setattr(app_module, 'get_delivery_mode', lambda recipient: 'digest')
+    monkeypatch.setattr(app_module.digest, 'queue_receipt', lambda *args: 1)
+    job = process()
+    assert job.status == 'completed'
+    assert calls['email'] == []
+    assert [status for stage, status in stage_events(job) if stage == 'email'] == ['running', 'completed']
+    assert job.stages['email']['detail'] == 'Queued for the digest to finance@example.com'
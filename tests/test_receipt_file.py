@@ -0,0 +1,84 @@
+import io
+import os
+import gc
+import hashlib
+import pytest
+from werkzeug.datastructures import FileStorage
+import receipt_file
+from receipt_file import ReceiptFile
+
+
+@pytest.fixture(autouse=True)
+def small_memory_limit(monkeypatch, tmp_path):
+    monkeypatch.setattr(receipt_file, 'INGEST_MAX_MEMORY', 16)
+    monkeypatch.setattr(receipt_file, 'INGEST_TEMP_DIR', str(tmp_path))
+
+
+def upload(content, name='receipt.jpg'):
+    return ReceiptFile.from_upload(FileStorage(stream=io.BytesIO(content), filename=name), name)
+
+
+def test_small_upload_stays_in_memory(tmp_path):
+    receipt = upload(b'small')
+    assert receipt.in_memory
+    assert receipt.path is None
+    assert receipt.getvalue() == b'small'
+    assert os.listdir(tmp_path) == []
+
+
+def test_large_upload_spills_to_disk(tmp_path):
+    content = b'x' * 100
+    receipt = upload(content, 'scan.pdf')
+    assert not receipt.in_memory
+    assert os.path.dirname(receipt.path) == str(tmp_path)
+    assert receipt.path.endswith('.pdf')
+    assert receipt.size == 100
+    assert receipt.getvalue() == content
+    assert receipt.md5 == hashlib.md5(content).hexdigest()
+    with receipt.open() as first, receipt.open() as second:
+        assert first.read(10) == second.read(10)
+
+
+def test_same_name_uploads_get_separate_files():
+    first = upload(b'a' * 100)
+    second = upload(b'b' * 100)
+    assert first.path != second.path
+    assert first.getvalue() != second.getvalue()
+
+
+def test_close_removes_temp_file():
+    receipt = upload(b'x' * 100)
+    path = receipt.path
+    receipt.close()
+    assert not os.path.exists(path)
+    # Closing twice is harmless
+    receipt.close()
+
+
+def test_temp_file_removed_when_collected():
+    receipt = upload(b'x' * 100)
+    path = receipt.path
+    del receipt
+    gc.collect()
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize('content', [b'small', b'x' * 100])
+def test_closed_receipt_raises_clear_error(content):
+    with upload(content) as receipt:
+        in_memory = receipt.in_memory
+    assert receipt.closed
+    assert receipt.in_memory is in_memory
+    with pytest.raises(ValueError, match='closed'):
+        receipt.getvalue()
+    with pytest.raises(ValueError, match='closed'):
+        receipt.open()
+
+
+def test_from_path_is_never_deleted(tmp_path):
+    path = tmp_path / 'kept.png'
+    path.write_bytes(b'png')
+    receipt = ReceiptFile.from_path(str(path))
+    assert receipt.name == 'kept.png'
+    receipt.close()
+    assert path.exists()
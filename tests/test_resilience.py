@@ -0,0 +1,166 @@
+import pytest
+import resilience
+from resilience import CircuitBreaker, CircuitOpenError, RateLimitTimeout, TokenBucket
+
+
+class ApiError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f'HTTP {status_code}')
+        self.status_code = status_code
+        self.response = type('Response', (), {'status_code': status_code, 'headers': headers or {}})()
+
+
+@pytest.fixture(autouse=True)
+def rate_limits(tmp_path, monkeypatch):
+    monkeypatch.setattr(resilience, 'RATE_LIMITS_FILE', str(tmp_path / 'rate_limits.db'))
+
+
+def stored(bucket):
+    return dict(resilience._conn().execute('SELECT * FROM rate_limits WHERE name = ?', (bucket.name,)).fetchone())
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """A fresh bucket and breaker registered as the 'test' API"""
+    bucket = TokenBucket('test', rate_per_minute=6000, burst=5)
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05)
+    monkeypatch.setitem(resilience._buckets, 'test', bucket)
+    monkeypatch.setitem(resilience._breakers, 'test', breaker)
+    return bucket, breaker
+
+
+def fail(status):
+    def func():
+        raise ApiError(status)
+    return func
+
+
+def test_breaker_opens_after_threshold(api):
+    _, breaker = api
+    for _ in range(2):
+        with pytest.raises(ApiError):
+            resilience.call('test', fail(503))
+    assert breaker.state == 'open'
+    calls = []
+    with pytest.raises(CircuitOpenError):
+        resilience.call('test', calls.append, 1)
+    assert calls == []
+
+
+def test_client_errors_do_not_open_breaker(api):
+    _, breaker = api
+    for _ in range(3):
+        with pytest.raises(ApiError):
+            resilience.call('test', fail(400))
+    assert breaker.state == 'closed'
+    assert breaker.failures == 0
+
+
+def test_half_open_success_closes(api):
+    _, breaker = api
+    breaker.state, breaker.failures, breaker.opened_at = 'open', 2, 0.0
+    assert resilience.call('test', lambda: 'ok') == 'ok'
+    assert breaker.state == 'closed'
+    assert breaker.failures == 0
+
+
+def test_half_open_failure_reopens(api):
+    _, breaker = api
+    breaker.state, breaker.opened_at = 'open', 0.0
+    with pytest.raises(ApiError):
+        resilience.call('test', fail(500))
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_rate_limit_timeout_does_not_strand_half_open(api):
+    bucket, breaker = api
+    breaker.state, breaker.opened_at = 'open', 0.0
+    bucket.pause(resilience.RATE_LIMIT_MAX_WAIT + 60)
+    with pytest.raises(RateLimitTimeout):
+        resilience.call('test', lambda: 'ok')
+    # The trial call was never let through, so the next caller still gets it
+    assert breaker.state == 'open'
+    resilience._conn().execute('UPDATE rate_limits SET paused_until = 0')
+    assert resilience.call('test', lambda: 'ok') == 'ok'
+    assert breaker.state == 'closed'
+
+
+def test_rate_limited_call_is_retried(api, monkeypatch):
+    bucket, breaker = api
+    monkeypatch.setattr(resilience.time, 'sleep', lambda seconds: None)
+    responses = [ApiError(429, {'retry-after': '2'}), 'ok']
+
+    def func():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert resilience.call('test', func) == 'ok'
+    assert stored(bucket)['paused_until'] > 0
+    assert breaker.state == 'closed'
+
+
+def test_bucket_allows_burst_then_waits(monkeypatch):
+    bucket = TokenBucket('test', rate_per_minute=60, burst=2)
+    slept = []
+    monkeypatch.setattr(resilience.time, 'sleep', slept.append)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == pytest.approx(1.0, abs=0.05)
+    assert slept == [pytest.approx(1.0, abs=0.05)]
+
+
+def test_bucket_timeout_returns_token():
+    bucket = TokenBucket('test', rate_per_minute=60, burst=1)
+    bucket.acquire()
+    with pytest.raises(RateLimitTimeout):
+        bucket.acquire(max_wait=0.1)
+    # The rejected caller gave its reservation back
+    assert stored(bucket)['tokens'] > -1
+
+
+def test_bucket_pause_holds_callers():
+    bucket = TokenBucket('test', rate_per_minute=6000, burst=5)
+    bucket.pause(30)
+    with pytest.raises(RateLimitTimeout):
+        bucket.acquire(max_wait=1)
+
+
+def test_buckets_of_one_api_share_tokens():
+    # Two worker processes each hold their own bucket for the API
+    first, second = TokenBucket('test', rate_per_minute=1, burst=2), TokenBucket('test', rate_per_minute=1, burst=2)
+    assert first.acquire() == 0
+    assert second.acquire() == 0
+    with pytest.raises(RateLimitTimeout):
+        first.acquire(max_wait=1)
+
+
+def test_pause_reaches_other_workers():
+    first, second = TokenBucket('test', rate_per_minute=6000, burst=5), TokenBucket('test', rate_per_minute=6000, burst=5)
+    first.pause(30)
+    with pytest.raises(RateLimitTimeout):
+        second.acquire(max_wait=1)
+    assert TokenBucket('other', rate_per_minute=6000, burst=5).acquire(max_wait=1) == 0
+
+
+@pytest.mark.parametrize('status, expected', [(429, True), (503, False), (400, False)])
+def test_is_rate_limited(status, expected):
+    assert resilience.is_rate_limited(ApiError(status)) is expected
+
+
+@pytest.mark.parametrize('error, expected', [
+    (ApiError(500), True),
+    (ConnectionError('reset'), True),
+    (ApiError(404), False),
+    (RateLimitTimeout('slow'), False),
+])
+def test_is_dependency_failure(error, expected):
+    assert resilience.is_dependency_failure(error) is expected
+
+
+def test_get_retry_after_seconds():
+    assert resilience.get_retry_after(ApiError(429, {'retry-after': '7'})) == 7.0
+    assert resilience.get_retry_after(ApiError(429)) is None
@@ -0,0 +1,52 @@
+import json
+import logging
+from settings import SettingsStore
+
+
+def make_store(tmp_path, monkeypatch, env_settings):
+    monkeypatch.setenv('APP_SETTINGS', json.dumps(env_settings))
+    return SettingsStore(path=str(tmp_path / 'settings.json'), check_interval=0)
+
+
+def test_app_settings_used_without_file(tmp_path, monkeypatch):
+    store = make_store(tmp_path, monkeypatch, {'additional_recipients': ['env@example.com']})
+    assert store.get()['additional_recipients'] == ['env@example.com']
+    assert store.get()['settings']['emails_enabled'] is True
+
+
+def test_saved_file_overrides_app_settings_and_warns(tmp_path, monkeypatch, caplog):
+    store = make_store(tmp_path, monkeypatch, {'additional_recipients': ['env@example.com']})
+    with caplog.at_level(logging.WARNING, logger='settings'):
+        store.save({'additional_recipients': ['admin@example.com']})
+    assert store.get()['additional_recipients'] == ['admin@example.com']
+    assert 'overrides APP_SETTINGS for: additional_recipients' in caplog.text
+
+
+def test_file_keys_not_in_app_settings_do_not_warn(tmp_path, monkeypatch, caplog):
+    store = make_store(tmp_path, monkeypatch, {'additional_recipients': ['env@example.com']})
+    with caplog.at_level(logging.WARNING, logger='settings'):
+        store.save({'digest_recipients': ['digest@example.com']})
+    assert store.get()['additional_recipients'] == ['env@example.com']
+    assert store.get()['digest_recipients'] == ['digest@example.com']
+    assert caplog.text == ''
+
+
+def test_shipped_example_is_the_fallback(tmp_path, monkeypatch):
+    example = tmp_path / 'settings.example.json'
+    example.write_text(json.dumps({'additional_recipients': ['example@example.com'],
+                                   'credit_card_emails': {'Card-1234': 'card@example.com'}}))
+    monkeypatch.delenv('APP_SETTINGS', raising=False)
+    store = SettingsStore(path=str(tmp_path / 'settings.json'), check_interval=0, example_path=str(example))
+    assert store.get()['additional_recipients'] == ['example@example.com']
+
+    monkeypatch.setenv('APP_SETTINGS', json.dumps({'additional_recipients': ['env@example.com']}))
+    store = SettingsStore(path=str(tmp_path / 'settings.json'), check_interval=0, example_path=str(example))
+    assert store.get()['additional_recipients'] == ['env@example.com']
+    assert store.get()['credit_card_emails'] == {'Card-1234': 'card@example.com'}
+
+
+def test_repository_ships_an_example():
+    import settings
+    with open(settings.SETTINGS_EXAMPLE_FILE) as f:
+        example = json.load(f)
+    assert set(example) >= {'credit_card_emails', 'additional_recipients', 'settings'}
@@ -0,0 +1,49 @@
+import os
+import pytest
+import upload_store
+import upload_to_drive
+
+
+@pytest.fixture
+def uploads_dir(tmp_path, monkeypatch):
+    """Run process_uploads in tmp_path with a fresh store and a fake Drive"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(upload_store, 'UPLOAD_STORE_FILE', str(tmp_path / 'uploads.db'))
+    uploaded = []
+
+    def fake_upload(file_path, file_name, file_hash, stat):
+        uploaded.append(file_name)
+        return {'hash': file_hash, 'drive_id': f'id-{file_name}', 'upload_date': None,
+                'file_size': stat.st_size, 'mtime': stat.st_mtime}
+
+    monkeypatch.setattr(upload_to_drive, 'upload_new_file', fake_upload)
+    os.makedirs('uploads')
+    for name in ('first.jpg', 'copy.jpg'):
+        with open(os.path.join('uploads', name), 'wb') as f:
+            f.write(b'same content')
+    return uploaded
+
+
+def upload_copy_in_second_run():
+    os.rename(os.path.join('uploads', 'copy.jpg'), 'copy.jpg')
+    upload_to_drive.process_uploads()
+    os.rename('copy.jpg', os.path.join('uploads', 'copy.jpg'))
+    upload_to_drive.process_uploads()
+
+
+def test_same_content_under_new_name_is_uploaded(uploads_dir):
+    upload_copy_in_second_run()
+    assert uploads_dir == ['first.jpg', 'copy.jpg']
+
+
+def test_unchanged_files_are_not_uploaded_again(uploads_dir):
+    upload_to_drive.process_uploads()
+    upload_to_drive.process_uploads()
+    assert len(uploads_dir) == 2
+
+
+def test_content_dedup_is_opt_in(uploads_dir, monkeypatch):
+    monkeypatch.setattr(upload_to_drive, 'DEDUP_BY_CONTENT', True)
+    upload_copy_in_second_run()
+    assert uploads_dir == ['first.jpg']
+    assert upload_store.get_upload('copy.jpg')['drive_id'] == 'id-first.jpg'
@@ -0,0 +1,150 @@
+import time
+import pytest
+import webhook_outbox
+from webhook_outbox import WebhookDispatcher
+
+URL = 'https://hooks.example.com/catch/1'
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = f'status {status_code}'
+
+
+class FakeSession:
+    """Records posts and answers with the queued status codes (200 when empty)"""
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.posts = []
+
+    def post(self, url, json, timeout):
+        self.posts.append((url, json))
+        return FakeResponse(self.statuses.pop(0) if self.statuses else 200)
+
+
+@pytest.fixture(autouse=True)
+def outbox(tmp_path, monkeypatch):
+    monkeypatch.setattr(webhook_outbox, 'WEBHOOK_OUTBOX_FILE', str(tmp_path / 'outbox.db'))
+    # Events are dispatched by the tests, not by the background thread,
+    # which may already run if an earlier test started the app's threads
+    monkeypatch.setattr(webhook_outbox.dispatcher, 'start', lambda: None)
+    monkeypatch.setattr(webhook_outbox.dispatcher, 'dispatch_due', lambda: 0)
+
+
+def make_dispatcher(*statuses, batch_size=1):
+    dispatcher = WebhookDispatcher(batch_size=batch_size)
+    dispatcher._session = FakeSession(*statuses)
+    return dispatcher
+
+
+def rows():
+    return [dict(row) for row in webhook_outbox._conn().execute('SELECT * FROM webhook_outbox ORDER BY id')]
+
+
+def test_sent_event_is_removed():
+    webhook_outbox.enqueue_webhook(URL, {'receipt': 1})
+    dispatcher = make_dispatcher()
+    assert dispatcher.dispatch_due() == 1
+    assert dispatcher._session.posts == [(URL, {'receipt': 1})]
+    assert rows() == []
+    assert dispatcher.dispatch_due() == 0
+
+
+def test_batch_groups_events_of_one_url():
+    for index in range(3):
+        webhook_outbox.enqueue_webhook(URL, {'receipt': index})
+    webhook_outbox.enqueue_webhook('https://other.example.com', {'receipt': 'other'})
+    dispatcher = make_dispatcher(batch_size=2)
+    while dispatcher.dispatch_due():
+        pass
+    assert dispatcher._session.posts == [
+        (URL, [{'receipt': 0}, {'receipt': 1}]),
+        (URL, {'receipt': 2}),
+        ('https://other.example.com', {'receipt': 'other'}),
+    ]
+
+
+def test_server_error_is_retried_later():
+    webhook_outbox.enqueue_webhook(URL, {'receipt': 1})
+    dispatcher = make_dispatcher(503)
+    assert dispatcher.dispatch_due() == 1
+    row, = rows()
+    assert row['status'] == 'pending'
+    assert row['attempts'] == 1
+    assert row['claimed_by'] is None
+    assert row['next_attempt_at'] > time.time()
+    assert 'status code 503' in row['last_error']
+    # Not due yet
+    assert dispatcher.dispatch_due() == 0
+    webhook_outbox._conn().execute('UPDATE webhook_outbox SET next_attempt_at = 0')
+    assert dispatcher.dispatch_due() == 1
+    assert rows() == []
+
+
+@pytest.mark.parametrize('status', [408, 429])
+def test_timeouts_and_rate_limits_are_retried(status):
+    webhook_outbox.enqueue_webhook(URL, {'receipt': 1})
+    make_dispatcher(status).dispatch_due()
+    assert rows()[0]['status'] == 'pending'
+
+
+def test_client_error_goes_to_dead_letters():
+    webhook_outbox.enqueue_webhook(URL, {'receipt': 1})
+    make_dispatcher(400).dispatch_due()
+    dead, = webhook_outbox.dead_letters()
+    assert dead['attempts'] == 1
+    assert webhook_outbox.outbox_stats() == {'pending': 0, 'dead': 1}
+
+
+def test_dead_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(webhook_outbox, 'ZAPIER_MAX_ATTEMPTS', 3)
+    webhook_outbox.enqueue_webhook(URL, {'receipt': 1})
+    dispatcher = make_dispatcher(500, 500, 500)
+    for _ in range(3):
+        webhook_outbox._conn().execute('UPDATE webhook_outbox SET next_attempt_at = 0')
+        dispatcher.dispatch_due()
+    assert rows()[0]['status'] == 'dead'
+    assert rows()[0]['attempts'] == 3
+
+
+def test_dead_letter_retry_and_delete():
+    first = webhook_outbox.enqueue_webhook(URL, {'receipt': 1})
+    second = webhook_outbox.enqueue_webhook(URL, {'receipt': 2})
+    dispatcher = make_dispatcher(400, 400)
+    dispatcher.dispatch_due()
+    dispatcher.dispatch_due()
+
+    assert webhook_outbox.retry_dead_letter(first) == 1
+    retried = next(row for row in rows() if row['id'] == first)
+    assert (retried['status'], retried['attempts']) == ('pending', 0)
+    assert dispatcher.dispatch_due() == 1
+    assert webhook_outbox.delete_dead_letter(second) == 1
+    assert rows() == []
+
+
+def test_claimed_events_are_not_sent_twice():
+    webhook_outbox.enqueue_webhook(URL, {'receipt': 1})
+    first, second = make_dispatcher(), make_dispatcher()
+    claimed = first._claim()
+    assert len(claimed) == 1
+    assert second._claim() == []
+
+
+def test_stale_claim_is_released():
+    webhook_outbox.enqueue_webhook(URL, {'receipt': 1})
+    make_dispatcher()._claim()
+    # The worker that claimed the event died before sending it
+    webhook_outbox._conn().execute('UPDATE webhook_outbox SET claimed_at = ?',
+                                   (time.time() - webhook_outbox.OUTBOX_CLAIM_TIMEOUT - 1,))
+    dispatcher = make_dispatcher()
+    assert dispatcher.dispatch_due() == 1
+    assert rows() == []
+
+
+def test_backoff_doubles_up_to_the_cap(monkeypatch):
+    monkeypatch.setattr(webhook_outbox.random, 'uniform', lambda low, high: 1.0)
+    monkeypatch.setattr(webhook_outbox, 'ZAPIER_BACKOFF_BASE', 5)
+    monkeypatch.setattr(webhook_outbox, 'ZAPIER_BACKOFF_MAX', 30)
+    assert [webhook_outbox.backoff_delay(n) for n in range(1, 6)] == [5, 10, 20, 30, 30]
@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import logging
+from db import get_connection, get_db_path
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_STORE_FILE = os.getenv('UPLOAD_STORE_FILE', get_db_path('upload_history.db'))
+# Legacy history imported once into the store
+UPLOAD_HISTORY_FILE = 'upload_history.json'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    file_name TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    drive_id TEXT,
+    upload_date TEXT,
+    file_size INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS idx_uploads_hash ON uploads (hash);
+CREATE INDEX IF NOT EXISTS idx_uploads_drive_id ON uploads (drive_id);
+CREATE TABLE IF NOT EXISTS upload_store_meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _conn():
+    return get_connection(UPLOAD_STORE_FILE, SCHEMA)
+
+
+def _row_to_entry(row):
+    return dict(row) if row is not None else None
+
+
+def get_upload(file_name):
+    """History entry for a file name, or None"""
+    row = _conn().execute('SELECT * FROM uploads WHERE file_name = ?', (file_name,)).fetchone()
+    return _row_to_entry(row)
+
+
+def find_by_hash(file_hash):
+    """An entry whose content hash matches, or None"""
+    row = _conn().execute('SELECT * FROM uploads WHERE hash = ? LIMIT 1', (file_hash,)).fetchone()
+    return _row_to_entry(row)
+
+
+def find_by_drive_id(drive_id):
+    """The entry for a Google Drive file ID, or None"""
+    row = _conn().execute('SELECT * FROM uploads WHERE drive_id = ? LIMIT 1', (drive_id,)).fetchone()
+    return _row_to_entry(row)
+
+
+def record_upload(file_name, entry):
+    """
+    Insert or replace the history entry of a file.
+
+    Every call is its own transaction, so uploads recorded before a crash
+    are kept.
+
+    Args:
+        file_name (str): Name of the uploaded file.
+        entry (dict): hash, drive_id, upload_date, file_size and mtime.
+    """
+    _conn().execute(
+        'INSERT INTO uploads (file_name, hash, drive_id, upload_date, file_size, mtime) '
+        'VALUES (?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT (file_name) DO UPDATE SET hash = excluded.hash, drive_id = excluded.drive_id, '
+        'upload_date = excluded.upload_date, file_size = excluded.file_size, mtime = excluded.mtime',
+        (file_name, entry['hash'], entry.get('drive_id'), entry.get('upload_date'),
+         entry.get('file_size'), entry.get('mtime'))
+    )
+
+
+def update_stat(file_name, file_size, mtime):
+    """Refresh the size and modification time stored for a file"""
+    _conn().execute('UPDATE uploads SET file_size = ?, mtime = ? WHERE file_name = ?',
+                    (file_size, mtime, file_name))
+
+
+def count_uploads():
+    """Number of files tracked"""
+    return _conn().execute('SELECT COUNT(*) FROM uploads').fetchone()[0]
+
+
+def import_json_history(path=UPLOAD_HISTORY_FILE):
+    """
+    Import the legacy upload_history.json into the store, once.
+
+    Args:
+        path (str): Path to the JSON history.
+    Returns:
+        int: Number of entries imported (0 if already imported or missing).
+    """
+    conn = _conn()
+    if conn.execute("SELECT 1 FROM upload_store_meta WHERE name = 'json_imported'").fetchone():
+        return 0
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, 'r') as f:
+        history = json.load(f)
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Another process may have imported while we were reading the file
+        if conn.execute("SELECT 1 FROM upload_store_meta WHERE name = 'json_imported'").fetchone():
+            conn.execute('ROLLBACK')
+            return 0
+        conn.executemany(
+            'INSERT OR IGNORE INTO uploads (file_name, hash, drive_id, upload_date, file_size, mtime) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            [(name, entry['hash'], entry.get('drive_id'), entry.get('upload_date'),
+              entry.get('file_size'), entry.get('mtime')) for name, entry in history.items()]
+        )
+        conn.execute("INSERT INTO upload_store_meta (name, value) VALUES ('json_imported', ?)", (path,))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    logger.info(f"Imported {len(history)} entries from {path}")
+    return len(history)
+
+
+if __name__ == "__main__":
+    source = sys.argv[1] if len(sys.argv) > 1 else UPLOAD_HISTORY_FILE
+    print(f"Imported {import_json_history(source)} entries from {source}")
+    print(f"Total files tracked: {count_uploads()}")
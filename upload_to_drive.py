@@ -1,20 +1,29 @@
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from authorize import get_credentials
+from authorize import get_service as get_api_service
+import upload_store
+from resilience import call as call_api
+from receipt_file import as_receipt_file
 import os
+import logging
 import mimetypes
-import json
 import hashlib
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
 
 # Target folder ID for uploads
 TARGET_FOLDER_ID = '1adzLMJObHtkliMT1GA2k1msS8x2RK1oQ'
-UPLOAD_HISTORY_FILE = 'upload_history.json'
+# Parallel uploads used by process_uploads
+UPLOAD_WORKERS = int(os.getenv('DRIVE_UPLOAD_WORKERS', 8))
+# Files up to this size go in a single request; larger ones use a resumable session
+RESUMABLE_THRESHOLD = int(os.getenv('DRIVE_RESUMABLE_THRESHOLD', 5 * 1024 * 1024))
+RESUMABLE_CHUNK_SIZE = int(os.getenv('DRIVE_RESUMABLE_CHUNK_SIZE', 8 * 1024 * 1024))
+# Skip a new file whose content was already uploaded under another name (off by default)
+DEDUP_BY_CONTENT = os.getenv('DRIVE_DEDUP_BY_CONTENT', 'false').lower() == 'true'
 
 def get_service():
-    """Get authorized Google Drive service"""
-    credentials = get_credentials()
-    return build('drive', 'v3', credentials=credentials)
+    """Get the cached Google Drive service for this thread"""
+    return get_api_service('drive', 'v3')
 
 def get_file_hash(file_path):
     """Calculate MD5 hash of file to track changes"""
@@ -26,18 +35,6 @@ def get_file_hash(file_path):
             buf = f.read(65536)
     return hasher.hexdigest()
 
-def load_upload_history():
-    """Load the history of uploaded files"""
-    if os.path.exists(UPLOAD_HISTORY_FILE):
-        with open(UPLOAD_HISTORY_FILE, 'r') as f:
-            return json.load(f)
-    return {}
-
-def save_upload_history(history):
-    """Save the upload history to file"""
-    with open(UPLOAD_HISTORY_FILE, 'w') as f:
-        json.dump(history, f, indent=2)
-
 def get_mime_type(file_path):
     """Get the MIME type based on file extension"""
     mime_type, _ = mimetypes.guess_type(file_path)
@@ -49,82 +46,130 @@ def upload_file_to_drive(file_path, file_name=None, folder_id=TARGET_FOLDER_ID):
     """
     Uploads a file to Google Drive.
 
-    :param file_path: Path to the file
+    :param file_path: Path to the file, or a ReceiptFile
     :param file_name: Name to save the file as in Google Drive (optional)
     :param folder_id: ID of the folder to upload to (defaults to TARGET_FOLDER_ID)
     :return: ID of the uploaded file
     """
+    # Imported on first use; googleapiclient is slow to import
+    from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
     service = get_service()
+    receipt = as_receipt_file(file_path)
     
     if not file_name:
-        file_name = os.path.basename(file_path)
+        file_name = receipt.name
     
     file_metadata = {
         'name': file_name,
         'parents': [folder_id]
     }
     
-    mime_type = get_mime_type(file_path)
-    media = MediaFileUpload(file_path, mimetype=mime_type, resumable=True)
+    mime_type = get_mime_type(receipt.name)
+    # Small files need one request; a resumable session costs an extra round trip
+    resumable = receipt.size > RESUMABLE_THRESHOLD
+    chunksize = RESUMABLE_CHUNK_SIZE if resumable else -1
+    if receipt.in_memory:
+        media = MediaIoBaseUpload(receipt.open(), mimetype=mime_type, resumable=resumable, chunksize=chunksize)
+    else:
+        media = MediaFileUpload(receipt.path, mimetype=mime_type, resumable=resumable, chunksize=chunksize)
     
     try:
-        file = service.files().create(
+        request = service.files().create(
             body=file_metadata,
             media_body=media,
             fields='id'
-        ).execute()
+        )
+        file = call_api('drive', request.execute)
         return file.get('id')
     except Exception as e:
-        print(f"Error uploading {file_name}: {str(e)}")
+        logger.error(f"Error uploading {file_name}: {str(e)}")
         return None
 
+def is_unchanged(entry, stat):
+    """True if a history entry matches the file's size and modification time"""
+    return (entry is not None
+            and entry.get('file_size') == stat.st_size
+            and entry.get('mtime') == stat.st_mtime)
+
+def upload_new_file(file_path, file_name, file_hash, stat):
+    """Upload one file and build its history entry"""
+    file_id = upload_file_to_drive(file_path)
+    if not file_id:
+        raise Exception("Drive did not return a file ID")
+    return {
+        'hash': file_hash,
+        'drive_id': file_id,
+        'upload_date': datetime.now().isoformat(),
+        'file_size': stat.st_size,
+        'mtime': stat.st_mtime
+    }
+
 def process_uploads():
     """Process files in the uploads directory and only upload new or modified files"""
     test_dir = 'uploads'
     if not os.path.exists(test_dir):
         os.makedirs(test_dir)
     
-    # Load upload history
-    upload_history = load_upload_history()
+    # Bring in the legacy JSON history on first run
+    upload_store.import_json_history()
     
     # Get list of files in uploads directory
     files = [f for f in os.listdir(test_dir) if os.path.isfile(os.path.join(test_dir, f))]
     
     if not files:
-        print(f"No files found in {test_dir} directory")
+        logger.info(f"No files found in {test_dir} directory")
         return
     
-    print(f"Checking {len(files)} files for new uploads...")
-    new_uploads = 0
+    logger.info(f"Checking {len(files)} files for new uploads...")
+    to_upload = []
     
     for file_name in files:
         file_path = os.path.join(test_dir, file_name)
+        stat = os.stat(file_path)
+        entry = upload_store.get_upload(file_name)
+
+        # Same size and modification time as last time: skip without hashing
+        if is_unchanged(entry, stat):
+            continue
+
         file_hash = get_file_hash(file_path)
         
         # Check if file has been uploaded before and hasn't changed
-        if file_name in upload_history and upload_history[file_name]['hash'] == file_hash:
-            print(f"Skipping {file_name} (already uploaded)")
+        if entry is not None and entry['hash'] == file_hash:
+            logger.info(f"Skipping {file_name} (already uploaded)")
+            # Remember the stat so the next run can skip it without hashing
+            upload_store.update_stat(file_name, stat.st_size, stat.st_mtime)
             continue
-        
-        try:
-            file_id = upload_file_to_drive(file_path)
-            # Update upload history
-            upload_history[file_name] = {
-                'hash': file_hash,
-                'drive_id': file_id,
-                'upload_date': datetime.now().isoformat(),
-                'file_size': os.path.getsize(file_path)
-            }
-            new_uploads += 1
-            print(f"Successfully uploaded new file: {file_name}")
-        except Exception as e:
-            print(f"Error uploading {file_name}: {str(e)}")
+
+        # Same content already uploaded under another name
+        duplicate = upload_store.find_by_hash(file_hash) if DEDUP_BY_CONTENT and entry is None else None
+        if duplicate is not None and duplicate['drive_id']:
+            logger.info(f"Skipping {file_name} (same content as {duplicate['file_name']})")
+            upload_store.record_upload(file_name, dict(duplicate, file_size=stat.st_size, mtime=stat.st_mtime))
+            continue
+
+        to_upload.append((file_path, file_name, file_hash, stat))
+
+    logger.info(f"Uploading {len(to_upload)} new or modified files with {UPLOAD_WORKERS} workers...")
+    new_uploads = 0
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+        futures = {pool.submit(upload_new_file, *args): args[1] for args in to_upload}
+        for future in as_completed(futures):
+            file_name = futures[future]
+            try:
+                # Record each upload as soon as it finishes
+                upload_store.record_upload(file_name, future.result())
+                new_uploads += 1
+                logger.info(f"Successfully uploaded new file: {file_name}")
+            except Exception as e:
+                logger.error(f"Error uploading {file_name}: {str(e)}")
     
-    # Save updated upload history
-    save_upload_history(upload_history)
-    print(f"\nUpload session complete:")
-    print(f"- New files uploaded: {new_uploads}")
-    print(f"- Total files tracked: {len(upload_history)}")
+    logger.info("Upload session complete:")
+    logger.info(f"- New files uploaded: {new_uploads}")
+    logger.info(f"- Total files tracked: {upload_store.count_uploads()}")
 
 if __name__ == "__main__":
+    from logging_setup import setup_logging
+    setup_logging(log_format='text')
     process_uploads()
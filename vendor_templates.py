@@ -0,0 +1,219 @@
+import re
+import os
+import json
+import time
+import logging
+from db import get_connection, get_db_path
+
+logger = logging.getLogger(__name__)
+
+VENDOR_TEMPLATES_FILE = os.getenv('VENDOR_TEMPLATES_FILE', get_db_path('vendor_templates.db'))
+VENDOR_TEMPLATES_ENABLED = os.getenv('VENDOR_TEMPLATES_ENABLED', 'true').lower() == 'true'
+
+# Fields of the analysis result, in the order the prompt lists them
+RESULT_FIELDS = [
+    'invoice_number', 'date', 'amount', 'customer_name', 'vendor', 'credit_card',
+    'description_of_items_or_services', 'billing_address', 'payment_method'
+]
+# A template result without these is rejected and the LLM is used instead
+REQUIRED_FIELDS = ('invoice_number', 'date', 'amount')
+# Fields whose pattern may match several times; every match is kept
+LIST_FIELDS = ('description_of_items_or_services',)
+
+# Templates installed on first use. Patterns run on the pdftotext -layout output.
+SEED_TEMPLATES = [
+    {
+        'name': 'amazon',
+        'vendor': 'Amazon.com',
+        'match_pattern': r'amazon\.com',
+        'fields': {
+            'invoice_number': r'(\d{3}-\d{7}-\d{7})',
+            'date': r'Order Placed:\s*([A-Z][a-z]+\.? \d{1,2}, \d{4})',
+            'amount': r'(?:Grand|Order) Total:\s*\$?\s*([\d,]+\.\d{2})',
+            'customer_name': r'Billing address\s*\n\s*(\S.*?)(?: {3,}|\n)',
+            'credit_card': r'(?:ending in|Last digits:)\s*(\d{4})',
+            'payment_method': r'\b(Visa|Mastercard|MasterCard|American Express|Discover|Amazon Pay|Gift Card)\b',
+            'description_of_items_or_services': r'^\s*\d+ of:\s*(.+?)(?: {3,}|$)'
+        }
+    }
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vendor_templates (
+    name TEXT PRIMARY KEY,
+    vendor TEXT NOT NULL,
+    match_pattern TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    matches INTEGER NOT NULL DEFAULT 0,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS vendor_templates_meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class TemplateError(ValueError):
+    """A template definition is invalid"""
+
+
+_seeded = False
+
+
+def _conn():
+    conn = get_connection(VENDOR_TEMPLATES_FILE, SCHEMA)
+    if not _seeded:
+        seed_templates(conn)
+    return conn
+
+
+def seed_templates(conn):
+    """Install SEED_TEMPLATES once, so a deleted seed template stays deleted"""
+    global _seeded
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if not conn.execute("SELECT 1 FROM vendor_templates_meta WHERE name = 'seeded'").fetchone():
+            now = time.time()
+            conn.executemany(
+                'INSERT OR IGNORE INTO vendor_templates (name, vendor, match_pattern, fields, created_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(t['name'], t['vendor'], t['match_pattern'], json.dumps(t['fields']), now) for t in SEED_TEMPLATES]
+            )
+            conn.execute("INSERT INTO vendor_templates_meta (name, value) VALUES ('seeded', '1')")
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    _seeded = True
+
+
+def validate_template(name, vendor, match_pattern, fields):
+    """
+    Check a template definition before it is stored.
+
+    Raises:
+        TemplateError: With a message suitable for the admin dashboard.
+    """
+    if not name or not vendor or not match_pattern:
+        raise TemplateError('Name, vendor and match pattern are required')
+    patterns = {'match pattern': match_pattern}
+    for field, pattern in fields.items():
+        if field not in RESULT_FIELDS:
+            raise TemplateError(f"Unknown field '{field}', expected one of {', '.join(RESULT_FIELDS)}")
+        patterns[field] = pattern
+    missing = [field for field in REQUIRED_FIELDS if field not in fields]
+    if missing:
+        raise TemplateError(f"Patterns are required for {', '.join(missing)}")
+    for label, pattern in patterns.items():
+        try:
+            compiled = re.compile(pattern, re.IGNORECASE | re.MULTILINE)
+        except re.error as e:
+            raise TemplateError(f"Invalid pattern for {label}: {str(e)}")
+        if label != 'match pattern' and compiled.groups != 1:
+            raise TemplateError(f"The pattern for {label} must have exactly one group")
+
+
+def save_template(name, vendor, match_pattern, fields):
+    """Add or replace a template. Raises TemplateError if it is invalid."""
+    validate_template(name, vendor, match_pattern, fields)
+    _conn().execute(
+        'INSERT INTO vendor_templates (name, vendor, match_pattern, fields, created_at) VALUES (?, ?, ?, ?, ?) '
+        'ON CONFLICT (name) DO UPDATE SET vendor = excluded.vendor, match_pattern = excluded.match_pattern, '
+        'fields = excluded.fields',
+        (name, vendor, match_pattern, json.dumps(fields), time.time())
+    )
+    _compiled_templates.clear()
+
+
+def delete_template(name):
+    """Remove a template. Returns True if it existed."""
+    deleted = _conn().execute('DELETE FROM vendor_templates WHERE name = ?', (name,)).rowcount > 0
+    _compiled_templates.clear()
+    return deleted
+
+
+def list_templates():
+    """Every template with its hit rate, for the admin dashboard"""
+    rows = _conn().execute('SELECT * FROM vendor_templates ORDER BY name').fetchall()
+    templates = []
+    for row in rows:
+        template = dict(row)
+        template['fields'] = json.loads(template['fields'])
+        template['hit_rate'] = round(row['hits'] / row['matches'], 3) if row['matches'] else 0.0
+        templates.append(template)
+    return templates
+
+
+# Compiled patterns keyed by (name, match_pattern, fields), so edits from another worker are picked up
+_compiled_templates = {}
+
+
+def _compile(row):
+    key = (row['name'], row['match_pattern'], row['fields'])
+    compiled = _compiled_templates.get(key)
+    if compiled is None:
+        flags = re.IGNORECASE | re.MULTILINE
+        compiled = (re.compile(row['match_pattern'], flags),
+                    {field: re.compile(pattern, flags) for field, pattern in json.loads(row['fields']).items()})
+        _compiled_templates[key] = compiled
+    return compiled
+
+
+def apply_template(row, text):
+    """Extract a result from text with one template; None if required fields are missing"""
+    _, patterns = _compile(row)
+    result = {field: 'N/A' for field in RESULT_FIELDS}
+    result['vendor'] = row['vendor']
+    for field, pattern in patterns.items():
+        if field in LIST_FIELDS:
+            values = [value.strip() for value in pattern.findall(text) if value.strip()]
+            if values:
+                result[field] = values
+        else:
+            match = pattern.search(text)
+            if match and match.group(1).strip():
+                result[field] = ' '.join(match.group(1).split())
+    return result if is_valid_result(result) else None
+
+
+def is_valid_result(result):
+    """True if the required fields were found and the amount is a number"""
+    if any(result.get(field, 'N/A') == 'N/A' for field in REQUIRED_FIELDS):
+        return False
+    amount = re.sub(r'[^\d.,-]', '', str(result['amount']))
+    try:
+        float(amount.replace(',', ''))
+    except ValueError:
+        return False
+    result['amount'] = amount
+    return True
+
+
+def extract_with_templates(text):
+    """
+    Recognise the vendor of a document and extract it without the LLM.
+
+    Args:
+        text (str): Text layer of the document.
+    Returns:
+        tuple: (result dict, template name), or (None, None) when no
+        template matched or the matching template's result was invalid.
+    """
+    if not VENDOR_TEMPLATES_ENABLED or not text:
+        return None, None
+    conn = _conn()
+    for row in conn.execute('SELECT name, vendor, match_pattern, fields FROM vendor_templates ORDER BY name').fetchall():
+        match_pattern, _ = _compile(row)
+        if not match_pattern.search(text):
+            continue
+        result = apply_template(row, text)
+        conn.execute('UPDATE vendor_templates SET matches = matches + 1, hits = hits + ? WHERE name = ?',
+                     (1 if result else 0, row['name']))
+        if result:
+            logger.info(f"Extracted invoice with the {row['name']} template")
+            return result, row['name']
+        logger.info(f"The {row['name']} template matched but its result failed validation")
+        return None, row['name']
+    return None, None
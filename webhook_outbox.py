@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from db import get_connection, get_db_path
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_OUTBOX_FILE = os.getenv('WEBHOOK_OUTBOX_FILE', get_db_path('webhook_outbox.db'))
+# Events sent in one POST as a JSON array; Zapier catch hooks run once per element
+ZAPIER_BATCH_SIZE = int(os.getenv('ZAPIER_BATCH_SIZE', 1))
+# Attempts before an event is moved to the dead-letter list
+ZAPIER_MAX_ATTEMPTS = int(os.getenv('ZAPIER_MAX_ATTEMPTS', 8))
+# Retry delay doubles from the base up to the cap (seconds)
+ZAPIER_BACKOFF_BASE = float(os.getenv('ZAPIER_BACKOFF_BASE', 5))
+ZAPIER_BACKOFF_MAX = float(os.getenv('ZAPIER_BACKOFF_MAX', 1800))
+ZAPIER_TIMEOUT = float(os.getenv('ZAPIER_TIMEOUT', 10))
+# Longest the dispatcher sleeps when nothing is due
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', 30))
+# Events claimed by a worker that died mid-send are released after this
+OUTBOX_CLAIM_TIMEOUT = 300
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    claimed_by TEXT,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_webhook_outbox_due ON webhook_outbox (status, next_attempt_at);
+"""
+
+
+class PermanentWebhookError(Exception):
+    """The endpoint rejected the request; retrying will not help"""
+
+
+def _conn():
+    return get_connection(WEBHOOK_OUTBOX_FILE, SCHEMA)
+
+
+def backoff_delay(attempts):
+    """Seconds to wait before the next attempt, with jitter"""
+    delay = min(ZAPIER_BACKOFF_BASE * (2 ** max(attempts - 1, 0)), ZAPIER_BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+class WebhookDispatcher:
+    """
+    Delivers outbox events from a background thread.
+
+    Each gunicorn worker runs its own dispatcher; events are claimed in a
+    transaction, so every event is sent by one worker only. HTTP
+    connections are reused through a single pooled session.
+    """
+
+    def __init__(self, batch_size=ZAPIER_BATCH_SIZE):
+        self.batch_size = max(batch_size, 1)
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            # Imported here so that importing the app stays fast
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+            session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+            self._session = session
+        return self._session
+
+    def start(self):
+        """Start the dispatcher thread, once per process"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            # A forked worker must not share the parent's connections
+            self._session = None
+            self._thread = threading.Thread(target=self._loop, name='webhook-dispatcher', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def wake(self):
+        """Ask the dispatcher to look for due events now"""
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            try:
+                while self.dispatch_due():
+                    pass
+            except Exception as e:
+                logger.error(f"Webhook dispatcher error: {str(e)}")
+            self._wake.wait(self._seconds_until_due())
+            self._wake.clear()
+
+    def _seconds_until_due(self):
+        row = _conn().execute(
+            "SELECT MIN(next_attempt_at) FROM webhook_outbox WHERE status = 'pending' AND claimed_by IS NULL"
+        ).fetchone()
+        if row[0] is None:
+            return OUTBOX_POLL_SECONDS
+        return min(max(row[0] - time.time(), 0.1), OUTBOX_POLL_SECONDS)
+
+    def _claim(self):
+        """Claim the due events of the URL with the oldest due event"""
+        token = uuid.uuid4().hex
+        now = time.time()
+        conn = _conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('UPDATE webhook_outbox SET claimed_by = NULL, claimed_at = NULL '
+                         "WHERE status = 'pending' AND claimed_at < ?", (now - OUTBOX_CLAIM_TIMEOUT,))
+            first = conn.execute(
+                "SELECT url FROM webhook_outbox WHERE status = 'pending' AND claimed_by IS NULL "
+                'AND next_attempt_at <= ? ORDER BY id LIMIT 1', (now,)
+            ).fetchone()
+            events = []
+            if first is not None:
+                events = [dict(row) for row in conn.execute(
+                    "SELECT * FROM webhook_outbox WHERE status = 'pending' AND claimed_by IS NULL "
+                    'AND next_attempt_at <= ? AND url = ? ORDER BY id LIMIT ?',
+                    (now, first['url'], self.batch_size)
+                ).fetchall()]
+                conn.executemany('UPDATE webhook_outbox SET claimed_by = ?, claimed_at = ? WHERE id = ?',
+                                 [(token, now, event['id']) for event in events])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return events
+
+    def _post(self, url, events):
+        payloads = [json.loads(event['payload']) for event in events]
+        body = payloads[0] if len(payloads) == 1 else payloads
+        with metrics.timer('external_call_seconds', api='zapier'):
+            response = self._get_session().post(url, json=body, timeout=ZAPIER_TIMEOUT)
+        if 200 <= response.status_code < 300:
+            return
+        metrics.inc('errors_total', source='zapier', reason=response.status_code)
+        message = f"Zapier returned status code {response.status_code}: {response.text[:200]}"
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            raise PermanentWebhookError(message)
+        raise Exception(message)
+
+    def dispatch_due(self):
+        """
+        Send one batch of due events.
+
+        Returns:
+            int: Number of events handled (0 when nothing was due).
+        """
+        events = self._claim()
+        if not events:
+            return 0
+        url = events[0]['url']
+        ids = [event['id'] for event in events]
+        start = time.time()
+        try:
+            self._post(url, events)
+        except Exception as e:
+            self._record_failure(events, e)
+            return len(events)
+
+        _conn().executemany('DELETE FROM webhook_outbox WHERE id = ?', [(event_id,) for event_id in ids])
+        logger.info(f"Sent {len(events)} webhook event(s) to Zapier in {time.time() - start:.2f}s")
+        return len(events)
+
+    def _record_failure(self, events, error):
+        now = time.time()
+        updates = []
+        for event in events:
+            attempts = event['attempts'] + 1
+            dead = isinstance(error, PermanentWebhookError) or attempts >= ZAPIER_MAX_ATTEMPTS
+            updates.append(('dead' if dead else 'pending', attempts, now + backoff_delay(attempts),
+                            str(error), event['id']))
+            if dead:
+                logger.error(f"Webhook event {event['id']} moved to dead letters after {attempts} attempt(s): {str(error)}")
+            else:
+                logger.warning(f"Webhook event {event['id']} failed (attempt {attempts}), will retry: {str(error)}")
+        _conn().executemany(
+            'UPDATE webhook_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, '
+            'claimed_by = NULL, claimed_at = NULL WHERE id = ?', updates
+        )
+
+
+dispatcher = WebhookDispatcher()
+
+
+def enqueue_webhook(url, payload):
+    """
+    Store a webhook event for delivery by the dispatcher.
+
+    Args:
+        url (str): Webhook URL.
+        payload (dict): JSON body of the event.
+    Returns:
+        int: Id of the outbox event.
+    """
+    now = time.time()
+    cursor = _conn().execute(
+        'INSERT INTO webhook_outbox (url, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)',
+        (url, json.dumps(payload), now, now)
+    )
+    dispatcher.start()
+    dispatcher.wake()
+    return cursor.lastrowid
+
+
+def outbox_stats():
+    """Number of pending and dead events"""
+    rows = _conn().execute('SELECT status, COUNT(*) AS count FROM webhook_outbox GROUP BY status').fetchall()
+    counts = {row['status']: row['count'] for row in rows}
+    return {'pending': counts.get('pending', 0), 'dead': counts.get('dead', 0)}
+
+
+def dead_letters(limit=50):
+    """Most recent events that could not be delivered"""
+    rows = _conn().execute(
+        "SELECT id, url, payload, attempts, last_error, created_at FROM webhook_outbox "
+        "WHERE status = 'dead' ORDER BY id DESC LIMIT ?", (limit,)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def retry_dead_letter(event_id=None):
+    """
+    Queue dead events for delivery again.
+
+    Args:
+        event_id (int): Event to retry, or None for all of them.
+    Returns:
+        int: Number of events requeued.
+    """
+    query = "UPDATE webhook_outbox SET status = 'pending', attempts = 0, next_attempt_at = ? WHERE status = 'dead'"
+    params = [time.time()]
+    if event_id is not None:
+        query += ' AND id = ?'
+        params.append(event_id)
+    count = _conn().execute(query, params).rowcount
+    if count:
+        dispatcher.start()
+        dispatcher.wake()
+    return count
+
+
+def delete_dead_letter(event_id):
+    """Discard a dead event"""
+    return _conn().execute("DELETE FROM webhook_outbox WHERE status = 'dead' AND id = ?", (event_id,)).rowcount